@@ -1,819 +1,4762 @@
-# -*- coding: utf-8 -*-
-"""
-    Script to track Fiery jobs on a PaperCut server.
-
-    This script should be run on the PaperCut server.
-    
-    Uses Fiery cost accounting API
-
-    Viewing Fiery jobs in PaperCut
-    -------------------------------
-    The easiest way to view the Fiery jobs on PaperCut is with a web browser.
-
-        Go to http://localhost:9191/app?service=page/AccountList 
-        Click on the Fiery.account link  
-        Click on the Job Log tab   
-"""
-#
-# TODO:
-#       Enable page level color detection for Fiery printers
-#       Mask passwords stored in PaperCut config editor
-#       On first ever query just record max id, to avoid logging pre-history
-
-from __future__ import division
-import csv
-import datetime
-import json
-import logging
-import optparse
-import os
-import pprint
-import re
-import requests
-import sys
-import time
-import xmlrpclib
-
-
-#
-# Exit codes
-#
-EXIT_SUCCESS = 0
-EXIT_BAD_ARG = 1
-EXIT_NO_FIERY_API_KEY = 2  
-EXIT_NO_FIERYS = 3
-EXIT_CANNOT_CONNECT_PAPERCUT = 4
-EXIT_MULTIPLE_INSTANCE = 5
-EXIT_INCONSISTENT = 6
-EXIT_INVALID_JOB_LIST = 7
-EXIT_CANNOT_LOAD_CSV = 8
-EXIT_CANNOT_DUMP_CSV = 9
-
-#
-# Utility functions
-#
-PRETTY_PRINTER =  pprint.PrettyPrinter(indent=4)
-
-def pprint(obj):
-    """Pretty print object obj"""
-    if isinstance(obj, str):
-        print obj
-    else:
-        PRETTY_PRINTER.pprint(obj)
-
-
-def log_error(s):
-    logging.error(s)
-    print >> sys.stderr, s
-
-
-def log_info(s):
-    logging.info(s)
-    pprint(s)
-
-
-def log_debug(s):
-    logging.debug(s)
-
-
-def first_non_empty(iterable):
-    """Return first non-empty element in iterable"""
-    return next(s for s in iterable if s)   
-
-
-def get_uid():
-    """Return an OS generated 21 character ASCII unique string"""
-    return os.urandom(16).encode("base64")[:21]    
-    
-#
-# Fiery code
-# 
-class FieryState:
-    """Stores a Fiery's login info and the state of the number of jobs that have been read from it
-        and recorded on a PaperCut server.
-            ip: Fiery network name or ip address
-            username: Username for Fiery login
-            password: Password for Fiery login
-            max_id: Highest job id from this Fiery recorded on PaperCut
-            pending_max_id: Highest job id from this Fiery about to be recorded on PaperCut
-    """
-
-    def __init__(self, ip=None, username=None, password=None, max_id=None, pending_max_id=None):
-        """All key word args to simplify construction from a dict as in from_dict()"""
-        self.ip = ip
-        self.username = username
-        self.password = password
-        self.max_id = max_id 
-        self.pending_max_id = pending_max_id
-
-    def __repr__(self): 
-        """Show the non-None values"""
-        return repr({k:v for k,v in self.__dict__.items() if v is not None}) 
-
-    def repr_no_ip(self):
-        """Convenience function for when ip is stored separately as in PaperCut config editor
-            where the ip is stored in the key and repr_no_ip() is stored in the value
-        """
-        # TODO: Should we hide password?
-        return repr({k:v for k,v in self.__dict__.items() if v is not None and k != 'ip'})    
-
-    @classmethod 
-    def from_dict(cls, dct, ip=None):
-        fiery = cls(**dct)
-        if ip:
-            fiery.ip = ip
-        return fiery
-
-    def is_inconsistent(self):
-        """A FieryState is consistent if there are no pending jobs that have not been recorded.
-            A FieryState can be inconsistent if this script crashed while recording Fiery jobs on
-            a PaperCut server.
-            If this ever happens then 
-                - the PaperCut server should be checked to see which Fiery jobs with 
-                  id: max_id > id >= pending_max_id have been recorded. 
-                - the FieryState should be be updated to 
-                        max_id = highest id
-                        pending_max_id = None        
-            The FieryState will be saved in the PaperCut config key given by PaperCut.config_key()
-            which will be logged at ERROR level if this should ever happen. See log_inconsistent(). 
-        """
-        return self.pending_max_id is not None and (
-                self.max_id is None or self.pending_max_id > self.max_id)
-
-
-def fiery_load_api_key(key_file): 
-    """Load api key from key_file"""
-    try:   
-        return open(key_file, 'rb').read()
-    except Exception, e:
-        print('Could not load Fiery API key from %s: %s' % (key_file, e))
-        return None
-
-
-class FieryConnection:
-    """Connnection to a Fiery
-            fiery: FieryState of Fiery connected to
-            url: URL of Fiery
-            session_cookie: Session cookie for connection
-            connected: True if successfully connected
-            failure: String containing failure message if there was a failuree
-    """
-    # TODO: Add retry in case where connection are dropped?
-
-    batch_size = 100
-
-    @staticmethod
-    def set_api_key(api_key):
-        FieryConnection.api_key = api_key
-        
-    def __init__(self, fiery):
-        self.fiery = fiery
-        self.url = None
-        self.session_cookie = None
-        self.session_cookie = None
-        self.connected = False
-        self.failure = None
-        self.login()
-
-    def login(self): 
-        """Login to Fiery
-            Set connected = True on success
-        """
-
-        auth = {
-            'username': self.fiery.username, 
-            'password': self.fiery.password,
-            'accessrights': {'a1': FieryConnection.api_key}
-        }
-        log_debug('fiery_login: fiery=%s,auth=%s' % (self, json.dumps(auth)))
-
-        if not self.fiery.ip:
-            self.failure = 'no server specified'
-            return
-
-        self.url = 'https://%s/live' % self.fiery.ip
-        
-        r = requests.post('%s/login' % self.url, 
-                          data=json.dumps(auth), 
-                          headers={'content-type': 'application/json'}, 
-                          verify=False)
-        if r.status_code != 200:
-            self.failure = 'login: http code=%s' + str(r.status_code)
-            return
-
-        log_debug('Connected to Fiery "%s"' % self.url)
-
-        # Check for cookies
-        if 'set-cookie' not in r.headers:
-            self.failure = 'No cookies'
-            return
-
-        # Extract login coookie
-        cookies = r.headers['set-cookie']
-        m = re.search('_session_id=([^ ;]+)', cookies)
-        if not m:
-            self.failure = 'No session cookie'
-            return
-
-        self.session_cookie = m.group(1)
-        log_debug('session_cookie=%s' % self.session_cookie)
-
-        self.connected = True
-
-    def fetch_jobs(self): 
-    
-        start_id = self.fiery.max_id + 1 if self.fiery.max_id is not None else 0
-
-        # Request job log
-        headers = {'Cookie': '_session_id=%s;' % self.session_cookie}
-        full_url = '%s/api/v1/cost?start_id=%d&count=%d' % (self.url, start_id, 
-                    FieryConnection.batch_size)
-
-        log_debug('Retrieving Fiery jobs: url="%s"' % full_url)
-
-        r = requests.get(full_url, headers=headers, verify=False)
-        if r.status_code != 200:
-            self.failure = 'url=%s, http code=%d' % (full_url, r.status_code)
-            return None
-
-        # The list of printed jobs
-        # Fierys seem to return these lists sorted by id. We re-sort to be sure.
-        return sorted(json.loads(r.text), key = lambda x: x['id'])
-
-
-#
-# Job conversion/manipulation code
-#
-def convert_boolean(fy_bool):
-    """Convert a Fiery boolean string to a PaperCut boolean string
-        Fiery is Yes/No
-        PaperCut is TRUE/FALSE
-    """
-    return 'TRUE' if fy_bool and fy_bool[0].lower() == 'y' else 'FALSE'
-
-    
-def convert_time(fiery_time):
-    """Convert a Fiery date-time to a PaperCut date-time
-
-
-        fiery_time: Fiery date-time local time localized into Fiery's locale
-            We assume all the Fierys that PaperCut is connnected to have the 
-            same locale as the computer this script is running on
-        Returns: PaperCut date-time corresponding to fiery_time if fiery_time 
-            is parsed successfully or an obviously bogus date-time if
-            it is not.
-    """ 
-    try:
-        tm = time.strptime(fiery_time, '%H:%M %b %d, %Y')  
-        dt = datetime.datetime(*tm[:6])
-        return dt.isoformat().replace(':', '').replace('-', '')
-    except e:
-        print('convert_time: Invalid fiery_time="%s": e' % (fiery_time, e))
-        return '11111111T111111'
-
-
-# TODO: Replace job[key] with job.get(key,None) to make FIERY_PAPERCUT_MAP
-#      resilient against missing Fiery keys
-
-FIERY_PAPERCUT_MAP = {
-    'printer': lambda job: job['fiery'],
-    'user': lambda job: first_non_empty([job.get('username', None), 
-                            job.get('authuser', None), 'blank on Fiery']),
-    'comment': lambda job: 'Fiery id: %s' % job['id'],
-    'time': lambda job: convert_time(job['date']),
-    'document-name': lambda job: job['title'],
-    'document-size-kb': lambda job: int(job['size'])//1024,
-    'paper-size-name': lambda job: job['media size'],
-    'copies': lambda job: int(job['copies printed']),
-    'total-pages': lambda job: (int(job['total blank pages printed'])
-                              + int(job['total bw pages printed'])
-                              + int(job['total color pages printed'])),
-    'total-color-pages': lambda job: int(job['total color pages printed']),
-    'duplex': lambda job: convert_boolean(job['duplex printed']),
-}
-
-def convert_job(fiery_job):
-    """Convert a Fiery job to a PaperCut job
-        TODO: Check this conversion with Fiery team
-    """    
-    pc_job = {k:FIERY_PAPERCUT_MAP[k](fiery_job) for k in FIERY_PAPERCUT_MAP} 
-    pc_job['grayscale'] = 'TRUE' if pc_job['total-color-pages'] > 0 else 'FALSE'
-    return pc_job 
-
-
-class PaperCut:
-    """For connecting with PaperCut server
-            host_name: Network name/IP address of PaperCut server
-            port: PaperCut server port to use
-            auth_token: Authorization token or password
-            account_name: Name of PaperCut Shared Account to be used to store Fiery jobs
-            connected: True if connected to a PaperCut server
-            uid: UID that is used to claim control of recording Fiery jobs on host_name. 
-                 Ensures that only one instance of this script is recording Fiery jobs in the
-                 PaperCut Job Log at one time
-    """
-
-    def __init__(self, host_name='localhost', port=9191, auth_token=None, account_name=None):
-        self.host_name = host_name
-        self.port = port
-        self.auth_token = auth_token
-        self.account_name = account_name
-        self.connected = False
-        self.uid = get_uid()
-        self.connect()
-
-    def connect(self):
-        """Standard PaperCut XMLRPC initialization
-            - Instantiate a server and create the accout if it doesn't already exis.
-            - Claim the PaperCut server
-        """
-
-        log_info('Connecting to PaperCut "%s:%d"' % (self.host_name, self.port))
-
-        self.server = xmlrpclib.Server('http://%s:%d/rpc/api/xmlrpc' % (self.host_name, self.port))
-
-        self.claim()
-
-        if self.server.api.isSharedAccountExists(self.auth_token, self.account_name):
-            log_info('PaperCut Shared Account "%s" account already exists.' % self.account_name)
-        else:
-            # user does not exist so create
-            log_info('Creating PaperCut Shared Account "%s"' % self.account_name)
-            self.server.api.addNewSharedAccount(self.auth_token, self.account_name)
-
-        self.connected = True     
-
-    def convert_job(self, fiery_job):
-        """Convert a Fiery job to a PaperCut job and apply server and shared-account names."""    
-        pc_job = convert_job(fiery_job)
-        pc_job['server'] = self.host_name
-        pc_job['shared-account'] = self.account_name
-        return pc_job
-
-    @staticmethod
-    def check_jobs(fiery, fiery_job_list):
-        """Validate new job ids against those already stored on PaperCut"""
-        for job in fiery_job_list: 
-            if fiery.max_id is not None and job['id'] <= fiery.max_id:
-                log_error('\n\t'.join([
-                            'Fetched Fiery job id <= previous max id',
-                            'job[id]=%s,fiery.max_id=%s', 
-                            'job=%s',
-                            'previous state=%s']) % (
-                        job['id'], fiery.max_id, job, fiery))
-                exit(EXIT_INVALID_JOB_LIST)
-
-    def _record_jobs_int(self, fiery_job_list):
-        """Record Fiery jobs in PaperCut Job Log
-            fiery_job_list: List of Fiery jobs
-            Should not be called directly. Use record_jobs()
-        """
-        for fiery_job in fiery_job_list:
-            job = self.convert_job(fiery_job)
-            # PaperCut doesn't log non-printing print jobs
-            if job['total-pages'] <= 0:
-                continue
-            # See http://www.papercut.com/products/ng/manual/ "Importing Print Job Details"    
-            job_details = ','.join('%s=%s' % (k,v) for k,v in job.items())
-            print('Recording job="%s"' % job_details)
-            self.server.api.processJob(self.auth_token, job_details)    
-
-    def record_jobs(self, fiery, fiery_job_list):
-        """Record Fiery jobs in PaperCut Job Log
-            fiery_job_list: List of Fiery jobs
-
-            Ensures that jobs are recorded in PaperCut Job Log reliably and that jobs are not
-            recorded twice.
-
-            If the PaperCut Config Editor values show that recording is in an inconsistent state
-            then this function will exit() with recording any Fiery jobs in the PaperCut Job Log.
-        """
-
-        # Check that Fiery state is consistent
-        check_consistency(fiery)
-
-        # Check that new jobs are consistent with those already recorded
-        PaperCut.check_jobs(fiery, fiery_job_list)
-
-        # Check that no other instance of this script is recording jobs on the PaperCut server
-        self.check_claim()
-
-        # Note in PaperCut Config Editor that we are in the process of recording Fiery jobs in the
-        # PaperCut Job Log
-        max_id = max(job['id'] for job in fiery_job_list)
-        fiery.pending_max_id = max_id  
-        self.save_fiery(fiery)
-
-        # Record the jobs in the PaperCut Job Log
-        self._record_jobs_int(fiery_job_list)
-
-        # Note in PaperCut Config Editor that we are done recording Fiery jobs in the PaperCut Job 
-        # Log
-        fiery.max_id = max_id
-        fiery.pending_max_id = None
-        self.save_fiery(fiery)
- 
-    FIERY = 'Fiery'
-    FIERY_LIST = '%s.list' % FIERY 
-    FIERY_ACCOUNT = '%s.account' % FIERY 
-    FIERY_CLAIM = '%s.claim' % FIERY    
-
-    @staticmethod
-    def config_key(fiery_ip):
-        """PaperCut config key format used for storing Fiery state"""
-        return '%s:%s' % (PaperCut.FIERY, fiery_ip)
-
-    def claim(self):
-        """Assert the claim current instance of this script to update PaperCut with Fiery jobs."""
-        self.server.api.setConfigValue(self.auth_token, PaperCut.FIERY_CLAIM, self.uid) 
-
-    def check_claim(self):
-        """Check if another instance of this program is updating PaperCut.
-            Exit if it is, after telling it to exit as well
-        """
-        uid = self.server.api.getConfigValue(self.auth_token, PaperCut.FIERY_CLAIM)
-        if uid != self.uid:
-            log_error('''
-    Another instance of this script is updating PaperCut server "%s"
-    Only one instance of this script can be run at one time.
-    Quitting.'''
-                % self.host_name)
-            # Tell the other instance to shutdown
-            self.claim()                
-            exit(EXIT_MULTIPLE_INSTANCE)
-
-    def save_fiery(self, fiery):  
-        """Save Fiery state in PaperCut config."""
-        assert fiery.__class__.__name__ == 'FieryState', fiery.__class__.__name__
-        fiery_ip = fiery.ip
-        fiery_str = fiery.repr_no_ip()
-        self.server.api.setConfigValue(self.auth_token, PaperCut.config_key(fiery_ip), fiery_str)  
-
-    def load_fiery(self, fiery_ip):  
-        """Load Fiery state from PaperCut config
-            fiery_ip: IP address/network name of Fiery for which start id is being saved
-            Returns: Fiery state
-            Always returns a dict with as much info as it can get from the PaperCut config.
-        """
-        fiery_str = self.server.api.getConfigValue(self.auth_token, PaperCut.config_key(fiery_ip))
-        fiery_dct = eval(fiery_str) if fiery_str else {}
-        return FieryState.from_dict(fiery_dct, ip=fiery_ip)
-
-    def save_fiery_ip_list(self, fiery_ip_list):
-        fiery_str = repr(fiery_ip_list)
-        self.server.api.setConfigValue(self.auth_token, PaperCut.FIERY_LIST, fiery_str) 
-
-    def load_fiery_ip_list(self):
-        fiery_str = self.server.api.getConfigValue(self.auth_token, PaperCut.FIERY_LIST)
-        if not fiery_str:
-            return []
-        return eval(fiery_str)
-
-    def load_fiery_list(self):
-        self.check_claim()
-        fiery_ip_list = self.load_fiery_ip_list()
-        return [self.load_fiery(fiery_ip) for fiery_ip in fiery_ip_list]
-
-    def save_fiery_list(self, fiery_list):
-        self.check_claim()
-        fiery_ip_list = [fiery.ip for fiery in fiery_list]
-        self.save_fiery_ip_list(fiery_ip_list)
-        for fiery in fiery_list:
-            self.save_fiery(fiery)
-
-    def describe_state(this):
-        msg = \
-'''
-    The Fiery jobs tracked so far can be seen in the PaperCut web admin interface.
-    - Jobs are logged as print jobs in the Shared Account "%s"
-       Each job is stored with a comment that contains the Fiery id.
-    - The Fierys currently being tracked are in the PaperCut Config Editor
-        - Search for "%s" (without the quotes)
-        - Name "%s" has a list of IP addresses of Fierys being tracked.
-        - Each Fiery being tracked has an entry "%s" with a value that looks like
-          {'username': 'admin', 'password': 'secret', 'max_id': 4}
-            The username and password values (admin and secret in this example) are 
-            used to log in to the Fiery. max_id is the maximum Fiery job id for this 
-            Fiery recorded in the PaperCut Job Log.
-            NOTE: Sometimes you will see a value like  
-                {'username': 'admin', 'password': 'secret', 'max_id': 4, pending_max_id: 7}
-            This means that this script stopped while it was recording Fiery jobs 
-            with ids in the range 5-7 on PaperCut.
-            If you ever see this then you will need to 
-            - check which of the jobs in the range 5-7 have been recorded in the 
-              PaperCut Job Log. You can find this by sorting PaperCut Shared Account 
-              "%s" Job Log by  date and checking the comment of the latest job.              
-            - set max_id to the highest Fiery id
-            - delete the pending_max_id 
-            - e.g. if the highest Fiery id logged is 6 then you would set the above 
-                  value to {'username': 'admin', 'password': 'secret', 'max_id': 6}
-''' % ( this.account_name,
-        PaperCut.FIERY,
-        PaperCut.FIERY_LIST,
-        PaperCut.config_key('<IP>'),
-        this.account_name)    
-
-        fiery_ip_list = this.load_fiery_ip_list()
-        fiery_list = this.load_fiery_list()
-
-        print
-        print 'Overview'
-        print msg
-        
-        if not fiery_ip_list and not fiery_list:
-            print 'There are no Fierys tracked in the PaperCut Config Editor'
-            return
-
-        print 'PaperCut Config Editor values'
-        print
-        print '    %s = %s' % (PaperCut.FIERY_LIST, fiery_ip_list)
-        for fiery in fiery_list:
-            print '    %s = %s' % (PaperCut.config_key(fiery.ip), fiery)        
-  
-
-def log_inconsistent(fiery):
-    log_error('Inconsistent Fiery state=%s in PaperCut config key=%s' 
-                % (fiery, PaperCut.config_key(fiery.ip)))
-
-
-def check_consistency_list(fiery_list):   
-    """Check that all Fiery states are consistent and exit if they are not"""   
-    num_inconsistent = 0   
-    for fiery in fiery_list:
-        if fiery.is_inconsistent():
-            log_inconsistent(fiery)
-            num_inconsistent += 1
-    if num_inconsistent > 0:
-        log_error('''
-    Please fix inconsistent Fiery recording state in PaperCut and restart this script.
-    Run this script with -v option to see how to fix the inconsistent state.
-    
-Quitting ...
-''')
-        exit(EXIT_INCONSISTENT)
-
-
-def check_consistency(fiery):   
-    """Check that Fiery states os consistent and exit if is are not"""   
-    check_consistency_list([fiery])   
-
- 
-def load_fierys_csv(csv_path):
-    """Load a list of Fiery ip, username, passwords from a CSV file"""
-    fiery_list = []
-    try: 
-        with open(csv_path, 'rb') as csv_file:
-            reader = csv.reader(csv_file)
-            for i,row in enumerate(reader):
-                if len(row) != 3:
-                    log_error('load_fierys_csv: row %d is formatted incorrectly row=%s' % (i, row))
-                    fiery_list = None
-                    break
-                ip,username,password = row    
-                fiery_list.append(FieryState(ip=ip, username=username, password=password))
-
-    except IOError, e:
-        log_error('dump_fierys_csv: csv_path="%s" failed with %s' % (csv_path, e)) 
-        return None
-    return fiery_list  
-
-
-def dump_fierys_csv(csv_path, fiery_list):
-    """Save a list of Fiery ip, username, passwords to a CSV file"""
-    try: 
-        with open(csv_path, 'wb') as csv_file:
-            writer = csv.writer(csv_file)
-            for fiery in fiery_list:
-                writer.writerow([fiery.ip, fiery.username, fiery.password])
-    except IOError, e:
-        log_error('dump_fierys_csv: csv_path="%s" failed with %s' % (csv_path, e)) 
-        return False
-    return True 
-
-
-def process_command_line():    
-    """Process the command line.
-        This script can only reasonably be run on the PaperCut server it is communicating with
-        so it does not make sense to change
-            - papercut_ip
-    """   
-    DEFAULT_FIERY_API_KEY_FILE = 'fiery.api.key'   
-    DEFAULT_FIERY_IP = None   # '192.68.228.104'   
-    DEFAULT_FIERY_USER = None # 'admin' 
-    DEFAULT_FIERY_PWD = None  # 'Fiery.color' 
-    DEFAULT_FIERY_BATCH_SIZE = 100 
-
-    DEFAULT_PAPERCUT_IP = 'localhost'
-    DEFAULT_PAPERCUT_PORT = 9191
-    DEFAULT_PAPERCUT_PWD = 'password'
-    DEFAULT_PAPERCUT_ACCOUNT = PaperCut.FIERY_ACCOUNT
-
-    DEFAULT_SLEEP_SECS = 60
-
-    parser = optparse.OptionParser('python %s [options]' % sys.argv[0])
-    parser.add_option('-L', '--csv-load', dest='csv_load',  
-            default=None, 
-            help='Load Fiery ip, username, pwd from csv file')
-    parser.add_option('-D', '--csv-dump', dest='csv_dump',  
-            default=None, 
-            help='Dump Fiery ip, username, pwd to csv file')            
-    parser.add_option('-B', '--fiery-batch-size', dest='fiery_batch_size', 
-            default=DEFAULT_FIERY_BATCH_SIZE, 
-            help='Number of jobs to request in each call to Fiery')
-    parser.add_option('-K', '--fiery-api-key', dest='fiery_api_key_file', 
-            default=DEFAULT_FIERY_API_KEY_FILE, 
-            help='Path of Fiery API key file')        
-    parser.add_option('-S', '--fiery-ip', dest='fiery_ip', 
-            default=DEFAULT_FIERY_IP, 
-            help='Network name or IP address of Fiery to monitor')
-    parser.add_option('-U', '--fiery-user', dest='fiery_user', 
-            default=DEFAULT_FIERY_USER, 
-            help='Fiery username')
-    parser.add_option('-P', '--fiery-pwd', dest='fiery_pwd', 
-            default=DEFAULT_FIERY_PWD, 
-            help='Fiery password')
-    parser.add_option('-s', '--papercut-ip', dest='papercut_ip', 
-            default=DEFAULT_PAPERCUT_IP,
-            help='Network name or IP address of PaperCut server') 
-    parser.add_option('-o', '--papercut-port', dest='papercut_port', type='int', 
-            default=DEFAULT_PAPERCUT_PORT, 
-            help='PaperCut port')
-    parser.add_option('-p', '--papercut-pwd', dest='papercut_pwd', 
-            default=DEFAULT_PAPERCUT_PWD, 
-            help='PaperCut admin password')
-    parser.add_option('-a', '--papercut-account', dest='papercut_account', 
-            default=DEFAULT_PAPERCUT_ACCOUNT, 
-            help='Name of PaperCut shared account to log Fiery prints in')
-    parser.add_option('-t', '--sleep-secs', dest='sleep_secs', type='int', 
-            default=DEFAULT_SLEEP_SECS, 
-            help='Sleep time between successive Fiery polls')    
-    parser.add_option('-d', '--debug', action='store_true', dest='debug', 
-            default=False, 
-            help='Enable debug logging')     
-    parser.add_option('-v', '--view', action='store_true', dest='view', 
-            default=False, 
-            help='View Fiery tracking on PaperCut server')                 
-
-    options,args = parser.parse_args()
-
-    # 
-    # We can't check command line params as they are optional (i.e. args is empty) 
-    # so we just print them to stdout.
-    #  
-    print('-' * 80)
-    print(__doc__)
-    print('     --help for more information')
-    print('-' * 80)
-    log_info('Options')    
-    log_info(options.__dict__)
-    log_info('-' * 80)
-
-    return options,args
-
-
-def main():
-    """Top level processing
-    """
-    
-    logging.basicConfig(
-        filename='papercut.fiery.log',
-        format='%(asctime)s %(levelname)s: %(message)s',
-        level=logging.INFO)
-        
-    logging.info(' Starting '.join(['=' * 30] * 2))
-
-    options,args = process_command_line()
-
-    if options.debug:
-        logging.basicConfig(level=logging.DEBUG)
-
-    # Initialize PaperCut        
-    papercut = PaperCut(options.papercut_ip, options.papercut_port, options.papercut_pwd, 
-                        options.papercut_account)  
-    if not papercut.connected:
-        log_error('Could not connect to PaperCut: papercut=%s' % papercut) 
-        exit(EXIT_CANNOT_CONNECT_PAPERCUT)
-
-    if options.view:
-        papercut.describe_state()
-        exit(EXIT_SUCCESS)
-
-    # Fetch the list of Fiery states stored on PaperCut  
-    fiery_list = papercut.load_fiery_list()  
-
-    # We will check consistency throughout this script
-    check_consistency_list(fiery_list)  
-
-    if options.csv_load:
-        # Load Fiery IPs, usernames and passwords from csv file
-        fiery_list = load_fierys_csv(options.csv_load)
-        if not fiery_list:
-            log_error('Could not load Fierys from csv file="%s"' % options.csv_load)
-            exit(EXIT_CANNOT_LOAD_CSV)    
-
-        # Update with fiery_list any state stored for these Fierys on PaperCut
-        for fiery in fiery_list:
-            pc_fiery = papercut.load_fiery(fiery.ip)
-            check_consistency(pc_fiery)
-            fiery.max_id = pc_fiery.max_id
-
-        # Save Fierys to PaperCut config       
-        papercut.save_fiery_list(fiery_list)
-
-    if options.fiery_ip or options.fiery_user or options.fiery_pwd:
-        if not (options.fiery_ip and options.fiery_user and options.fiery_pwd):
-            log_error('If any of fiery_ip, fiery_user or fiery_pwd is specified then all must be')
-            exit(EXIT_BAD_ARG)
-        if options.csv_load:
-            log_error('If any of fiery_ip, fiery_user or fiery_pwd is specified then csv_load may not be')
-            exit(EXIT_BAD_ARG)   
-
-        fiery = FieryState(options.fiery_ip, options.fiery_user, options.fiery_pwd)
-        pc_fiery = papercut.load_fiery(fiery.ip)
-        check_consistency(pc_fiery)
-        fiery.max_id = pc_fiery.max_id
-
-        fiery_list = [fiery]    
-        
-    # We will check consistency throughout this script
-    check_consistency_list(fiery_list)    
-
-    # Clean up the Fierys   
-    for fiery in fiery_list:
-        fiery.pending_max_id = None
-        assert fiery.ip, 'Invalid fiery=%s' % fiery     
-
-    if options.csv_dump:
-        if not dump_fierys_csv(options.csv_dump, fiery_list):
-            exit(EXIT_CANNOT_DUMP_CSV)
-
-    # Check that we have at least one Fiery
-
-    log_info('fiery_list=%s' % fiery_list)  
-    if not fiery_list:
-       log_error('No Fierys specified. Nothing to do.')
-       exit(EXIT_NO_FIERYS)        
-
-    # We now have a valid Fiery list
-    # So we save it to the PaperCut config
-    papercut.save_fiery_list(fiery_list) 
-
-    #
-    # Initialize connections to all Fierys in  fiery_list
-    # 
-    api_key = fiery_load_api_key(options.fiery_api_key_file)
-    if not api_key:
-        exit(EXIT_NO_FIERY_API_KEY)
-
-    FieryConnection.set_api_key(api_key)    
-    FieryConnection.batch_size = options.fiery_batch_size
-
-    log_debug('Fiery API Key file="%s"' % options.fiery_api_key_file)   
-    log_debug('Fiery API Key="%s"' % api_key) 
-
-    attempted_connection_list = [FieryConnection(f) for f in fiery_list]
-    fiery_connection_list = [f for f in attempted_connection_list if f.connected]
-    failed_connection_list = [f for f in attempted_connection_list if not f.connected]
-
-    log_info('Attempted to login to %d Fierys. %d succeeded, %d failed' % (
-        len(attempted_connection_list), 
-        len(fiery_connection_list),
-        len(failed_connection_list)
-    )) 
-    if failed_connection_list:
-        log_info('Failures=%s' % failed_connection_list)   
-    log_debug('=' * 80)  
-
-    #
-    # We now have connections and valid Fiery states in PaperCut so we are ready to go
-    #
-
-    #
-    # Main loop
-    #   Poll all Fierys for lists of jobs printed since the last time we polled.
-    #   If there are any new jobs   
-    #       record new job in PaperCut
-    #
-    while True:  
-
-        for fiery_connection in fiery_connection_list:
-
-            fiery_jobs = fiery_connection.fetch_jobs()
-
-            if fiery_jobs:
-                log_info('Fetched %d jobs from %s' % (len(fiery_jobs), fiery_connection.fiery.ip))
-                log_debug(fiery_jobs) 
-
-                papercut.record_jobs(fiery_connection.fiery, fiery_jobs)
-
-        log_debug('Sleeping %d sec' % options.sleep_secs)
-        log_debug('-' * 80)  
-        time.sleep(options.sleep_secs)
-        papercut.check_claim()
-
-
-#
-# Execution starts here
-#    
-main()
-
+# -*- coding: utf-8 -*-
+"""
+    Script to track Fiery jobs on a PaperCut server.
+
+    This script should be run on the PaperCut server.
+    
+    Uses Fiery cost accounting API
+
+    Viewing Fiery jobs in PaperCut
+    -------------------------------
+    The easiest way to view the Fiery jobs on PaperCut is with a web browser.
+
+        Go to http://localhost:9191/app?service=page/AccountList 
+        Click on the Fiery.account link  
+        Click on the Job Log tab   
+
+    Backfilling saved Fiery cost API responses
+    ------------------------------------------
+        python fiery_papercut.py [options] backfill FIERY_IP=DUMP_FILE [FIERY_IP=DUMP_FILE ...]
+    records the jobs in each DUMP_FILE as jobs from Fiery FIERY_IP then exits.
+    Only the job history that this script never polled is backfilled: all of it for Fierys that
+    have not been polled, and the jobs from before it was added for Fierys added with 
+    --bootstrap. Use --backfill-polled to backfill jobs that were polled, which records them 
+    twice on the same PaperCut server.
+
+    Resolving jobs that may have been recorded
+    ------------------------------------------
+    If PaperCut stops responding while this script is sending it jobs, or the script is killed
+    while sending them, then it can't tell whether they were recorded. It logs their ids and 
+    stops rather than risk recording them twice. Check the PaperCut Job Log for these jobs then run
+        python fiery_papercut.py [options] resolve FIERY_IP=MAX_ID [FIERY_IP=MAX_ID ...]
+    where MAX_ID is the highest Fiery id of the jobs from FIERY_IP in the Job Log. Use 
+    resolve-backfill instead of resolve for jobs that were being backfilled.
+
+    The backfill and resolve commands claim the PaperCut server, so stop the polling script 
+    before running them. They exit straight away if it is running.
+
+    Profiling a running script
+    --------------------------
+    Touch papercut.fiery.profile in the script's directory, or send it SIGUSR1, to profile it
+    for --profile-secs seconds. The profile is written to papercut.fiery.profile.<time>.<pid>.txt
+    and the stage times of each page of jobs are logged while it is taken.
+"""
+#
+# TODO:
+#       Enable page level color detection for Fiery printers
+#       Mask passwords stored in PaperCut config editor
+
+from __future__ import division
+import ast
+import atexit
+import BaseHTTPServer
+import bisect
+import collections
+import contextlib
+import csv
+import datetime
+import glob
+import heapq
+import httplib
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import pprint
+import Queue
+import random
+import re
+import requests
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import xmlrpclib
+import zlib
+
+
+#
+# Exit codes
+#
+EXIT_SUCCESS = 0
+EXIT_BAD_ARG = 1
+EXIT_NO_FIERY_API_KEY = 2  
+EXIT_NO_FIERYS = 3
+EXIT_CANNOT_CONNECT_PAPERCUT = 4
+EXIT_MULTIPLE_INSTANCE = 5
+EXIT_INCONSISTENT = 6
+EXIT_INVALID_JOB_LIST = 7
+EXIT_CANNOT_LOAD_CSV = 8
+EXIT_CANNOT_DUMP_CSV = 9
+
+#
+# Utility functions
+#
+PRETTY_PRINTER =  pprint.PrettyPrinter(indent=4)
+
+def pprint(obj):
+    """Pretty print object obj"""
+    if isinstance(obj, str):
+        print obj
+    else:
+        PRETTY_PRINTER.pprint(obj)
+
+
+def first_non_empty(iterable):
+    """Return first non-empty element in iterable"""
+    return next(s for s in iterable if s)   
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# The characters that iter_json_list() scans for to find where an element ends
+JSON_ELEMENT_TOKEN = re.compile(r'["\[\]{},]')
+# The rest of a JSON string after its opening quote. Group 1 is None if it is not terminated
+JSON_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*(")?')
+
+def iter_json_list(chunks):
+    """Decode a JSON list incrementally
+        chunks: Iterable of strings that make up the JSON text of a list
+        Yields: Elements of the list, one at a time as soon as each has been read
+        Only one element and one chunk are held in memory at a time.
+        An element that is split across chunks is decoded once the delimiter after it has been 
+        read, so it is scanned once, and a malformed element is reported straight away.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    expect = '['
+    # Position up to which the current element has been scanned, its bracket depth there and 
+    # whether that is inside a string
+    scan = None
+    depth = 0
+    in_string = False
+    while True:
+        pos = JSON_WHITESPACE.match(buf, pos).end()
+        if pos == len(buf):
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('Truncated JSON list')
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        c = buf[pos]
+        if expect == '[':
+            if c != '[':
+                raise ValueError('Expected JSON list, got %r' % buf[pos:pos + 20])
+            pos += 1
+            expect = 'first'
+        elif expect == ',':
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError('Expected , or ] in JSON list, got %r' % buf[pos:pos + 20])
+            pos += 1
+            expect = 'element'
+        elif expect == 'first' and c == ']':
+            return
+        else:
+            if scan is None:
+                # Most elements are all in buf so they are decoded without scanning them first
+                try:
+                    element, end = decoder.raw_decode(buf, pos)
+                    # A number or literal is only complete when it is followed by a delimiter
+                    complete = isinstance(element, (dict, list, basestring)) or (
+                               end < len(buf) and buf[end] in ' \t\n\r,]')
+                except ValueError:
+                    complete = False
+                if not complete:
+                    scan, depth, in_string = pos, 0, False
+            if scan is not None:
+                # The element is malformed or it doesn't end in buf. Scan for the delimiter after 
+                # it to tell which, scanning each chunk once
+                delim = None
+                while scan < len(buf):
+                    if in_string:
+                        m = JSON_STRING_REST.match(buf, scan)
+                        scan = m.end()
+                        if m.group(1) is None:
+                            break
+                        in_string = False
+                        continue
+                    m = JSON_ELEMENT_TOKEN.search(buf, scan)
+                    if not m:
+                        scan = len(buf)
+                        break
+                    c = m.group()
+                    scan = m.end()
+                    if c == '"':
+                        in_string = True
+                    elif c in '[{':
+                        depth += 1
+                    elif not depth:
+                        # The delimiter after the element
+                        delim = m.start()
+                        break
+                    elif c != ',':
+                        depth -= 1
+                if delim is None:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        raise ValueError('Truncated JSON list')
+                    buf, pos, scan = buf[pos:] + chunk, 0, scan - pos
+                    continue
+                try:
+                    element, end = decoder.raw_decode(buf, pos)
+                except ValueError, e:
+                    raise ValueError('Malformed JSON list element %r: %s' % (buf[pos:pos + 20], 
+                                     e))
+                scan = None
+            yield element
+            pos = end
+            expect = ','
+
+
+def shard_path(path, shard):
+    """Returns: Path of the file or directory for worker process shard of the one at path"""
+    return '%s.%s.shard' % (path, shard)
+
+
+def get_uid():
+    """Return an OS generated 21 character ASCII unique string"""
+    return os.urandom(16).encode("base64")[:21]
+
+
+#
+# Logging
+#
+# Records are handed to a background thread that formats and writes them so that log I/O and
+# formatting don't hold up fetching and recording. Pass arguments for the message separately,
+# as with logging.info(), so that messages that aren't logged are never formatted.
+#
+LOG_FILE = 'papercut.fiery.log'
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+
+
+def log_error(s, *args):
+    logging.error(s, *args, extra={'echo': True})
+
+
+def log_info(s, *args):
+    logging.info(s, *args, extra={'echo': True})
+
+
+def log_debug(s, *args):
+    logging.debug(s, *args)
+
+
+def log_job(s, *args):
+    """log_info() for per-job messages, limited to JOB_LOG_LIMITER.lines_per_sec"""
+    if JOB_LOG_LIMITER.take():
+        log_info(s, *args)
+
+
+class LogLimiter:
+    """Limits a kind of log message to a number of lines per second
+            name: Name of the kind of message
+            lines_per_sec: Lines allowed per second. 0 for no limit
+        The number of lines that were not logged in a second is logged with the next line.
+    """
+
+    def __init__(self, name, lines_per_sec):
+        self.name = name
+        self.lines_per_sec = lines_per_sec
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.num_lines = 0
+        self.num_suppressed = 0
+
+    def take(self):
+        """Returns: True if another line may be logged now"""
+        if self.lines_per_sec <= 0:
+            return True
+        suppressed = 0
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= 1.0:
+                suppressed = self.num_suppressed
+                self.window_start, self.num_lines, self.num_suppressed = now, 0, 0
+            allowed = self.num_lines < self.lines_per_sec
+            if allowed:
+                self.num_lines += 1
+            else:
+                self.num_suppressed += 1
+        if suppressed:
+            log_info('%d "%s" lines were not logged (limit %s/sec)', suppressed, self.name,
+                     self.lines_per_sec)
+        return allowed
+
+
+JOB_LOG_LIMITER = LogLimiter('Recording job', 0)
+
+
+class ConsoleHandler(logging.Handler):
+    """Echoes records logged by log_info() and log_error() to stdout and stderr as the 
+        print statements they replace did
+    """
+
+    def emit(self, record):
+        if not getattr(record, 'echo', False):
+            return
+        try:
+            if record.args or isinstance(record.msg, basestring):
+                msg = record.getMessage()
+            else:
+                msg = PRETTY_PRINTER.pformat(record.msg)
+            stream = sys.stderr if record.levelno >= logging.ERROR else sys.stdout
+            stream.write(msg + '\n')
+            stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record as a JSON object on one line"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        return json.dumps(entry)
+
+
+class BackgroundLogHandler(logging.Handler):
+    """Queues records for handlers that are run on a background thread
+            handlers: The handlers that write the records
+            max_queued: Most records to queue. Further records are dropped and counted
+    """
+
+    max_queued = 100000
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(BackgroundLogHandler.max_queued)
+        self.num_dropped = 0
+        self.thread = threading.Thread(target=self._run, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, record):
+        # The queue does the locking that logging.Handler.handle() would do
+        if self.filter(record):
+            self.emit(record)
+
+    def emit(self, record):
+        # Messages are formatted on the background thread so the caller must not change the 
+        # message arguments after logging them
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.num_dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.num_dropped:
+                num_dropped, self.num_dropped = self.num_dropped, 0
+                self._handle(logging.makeLogRecord({'levelno': logging.ERROR, 
+                    'levelname': 'ERROR', 'echo': True,
+                    'msg': '%d log messages were dropped' % num_dropped}))
+            self._handle(record)
+
+    def _handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        """Write the queued records and close the handlers"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(10.0)
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(debug=False, json_lines=False, job_lines_per_sec=0):
+    """Send log messages through a BackgroundLogHandler. Replaces any earlier setup
+            debug: Log debug messages
+            json_lines: Write the log file as one JSON object per line
+            job_lines_per_sec: Limit for log_job() messages. 0 for no limit
+        Called again in each worker process as forking doesn't copy the logging thread.
+    """
+    # Skip the per-record stack walk that finds the caller's file and line. They aren't logged
+    logging._srcfile = None
+    logging.logProcesses = False
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        if isinstance(handler, BackgroundLogHandler) and not handler.thread.is_alive():
+            # Inherited from the parent process. Its records are the parent's to write
+            continue
+        handler.close()
+
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(JsonLinesFormatter() if json_lines 
+                              else logging.Formatter(LOG_FORMAT))
+    root.addHandler(BackgroundLogHandler([file_handler, ConsoleHandler()]))
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+    JOB_LOG_LIMITER.lines_per_sec = job_lines_per_sec
+
+
+def stop_logging():
+    """Write all queued log messages and stop the logging thread"""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, BackgroundLogHandler):
+            root.removeHandler(handler)
+            handler.close()
+
+
+atexit.register(stop_logging)
+
+
+#
+# Concurrency code
+#
+class PendingResult:
+    """Result of a call submitted to a WorkerPool
+            value: Return value of the call
+            error: Exception raised by the call, if any
+    """
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def get(self):
+        """Wait for the call to complete and return its value
+            Re-raises any exception raised by the call.
+        """
+        # Wait in short steps so that KeyboardInterrupt is still delivered in Python 2
+        while not self.done.wait(1.0):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class WorkerPool:
+    """A bounded pool of daemon threads for running blocking calls such as Fiery HTTP requests
+            num_threads: Maximum number of calls that run at the same time
+    """
+
+    def __init__(self, num_threads):
+        self.num_threads = max(1, num_threads)
+        self.task_queue = Queue.Queue()
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name='worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            func, args, result = self.task_queue.get()
+            try:
+                result.value = func(*args)
+            except Exception, e:
+                result.error = e
+            result.done.set()
+
+    def submit(self, func, *args):
+        """Queue func(*args) to run on a worker thread
+            Returns: PendingResult for the call
+        """
+        result = PendingResult()
+        self.task_queue.put((func, args, result))
+        return result
+
+
+class PipelineStage:
+    """One stage of a pipeline: worker threads that call func on items taken from bounded queues
+            name: Name of the stage for thread names
+            func: Called as func(item) for each item
+            num_workers: Number of worker threads
+            queue_size: Maximum number of items waiting for each worker
+
+        Each worker has its own queue and all items with the same key go to the same worker so 
+        they are processed in the order they were put. put() blocks while that queue is full which 
+        holds back the stage feeding this one.
+        Exceptions raised by func are passed to on_error(sys.exc_info()) and the worker carries on.
+    """
+
+    def __init__(self, name, func, num_workers, queue_size, on_error):
+        self.func = func
+        self.on_error = on_error
+        self.stopping = False
+        self.queues = [Queue.Queue(max(1, queue_size)) for _ in range(max(1, num_workers))]
+        self.threads = []
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(queue,), name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if self.stopping:
+                # Items that are dropped here are fetched again the next time we run
+                continue
+            try:
+                self.func(item)
+            except BaseException:
+                # Includes the SystemExits from exit()
+                self.on_error(sys.exc_info())
+
+    def put(self, key, item):
+        """Queue item for the worker that handles key. Blocks while its queue is full"""
+        self.queues[hash(key) % len(self.queues)].put(item)
+
+    def close(self, finish=False):
+        """Stop the workers once they have finished the items they are working on
+            finish: Finish the items still waiting in the queues too. Otherwise they are dropped.
+        """
+        if not finish:
+            self.stopping = True
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1.0)
+
+
+#
+# Metrics
+#
+# Metrics served in the Prometheus text format by --metrics-port. {name: help}
+METRICS_HELP = {
+    'fiery_login_seconds': 'Time to log in to a Fiery',
+    'fiery_login_failures_total': 'Fiery logins that failed',
+    'fiery_fetch_seconds': 'Time to fetch a page of jobs from a Fiery',
+    'fiery_fetch_failures_total': 'Fetches of jobs from Fierys that failed',
+    'fiery_jobs_fetched_total': 'Jobs fetched from Fierys',
+    'convert_seconds': 'Time to convert a page of Fiery jobs to PaperCut jobs',
+    'jobs_converted_total': 'Fiery jobs converted to PaperCut jobs',
+    'papercut_process_job_seconds': 'Time of each processJob request or system.multicall batch '
+                                    'of them',
+    'papercut_jobs_recorded_total': 'Jobs recorded in the PaperCut Job Log',
+    'papercut_job_failures_total': 'Jobs that PaperCut rejected',
+    'papercut_jobs_skipped_total': 'Jobs that were skipped after PaperCut rejected them too often',
+    'papercut_unavailable_total': 'Requests to record jobs that failed as PaperCut could not be '
+                                  'reached',
+    'papercut_set_config_seconds': 'Time of each setConfigValue request for Fiery states',
+    'papercut_check_claim_seconds': 'Time to renew the claim on the PaperCut server',
+    'jobs_recorded_per_second': 'Jobs recorded per second over the last report period',
+    'fierys_connected': 'Fierys being polled',
+    'fierys_reconnecting': 'Fierys waiting to be logged in to again',
+    'spool_pages': 'Pages of jobs in the spool',
+    'fiery_pages_in_pipeline': 'Pages of jobs fetched from a Fiery and not yet recorded',
+    'fiery_backlogged': '1 if the last fetch from a Fiery returned a full page',
+    'fiery_max_id': 'Highest job id from a Fiery recorded on PaperCut',
+    'freshness_lag_seconds': 'Time from jobs finishing printing to them being recorded on '
+                             'PaperCut, over all Fierys',
+    'fiery_freshness_lag_seconds': 'Time from jobs finishing printing on a Fiery to them being '
+                                   'recorded on PaperCut',
+    'batch_fetch_seconds': 'Time from requesting a page of jobs from a Fiery to the response',
+    'batch_parse_seconds': 'Time to read and decode a page of jobs from a Fiery',
+    'batch_sort_seconds': 'Time to sort a page of jobs that a Fiery returned out of id order',
+    'batch_convert_seconds': 'Time to convert a page of jobs in the pipeline',
+    'batch_record_seconds': 'Time to record a page of jobs on PaperCut, not counting the saves '
+                            'of the Fiery state',
+    'batch_save_fiery_seconds': 'Time to save the Fiery state while recording a page of jobs',
+}
+
+
+def metric_key(name, labels):
+    """Returns: name{label="value",...} of a metric series"""
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, 
+                       str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                       for k, v in sorted(labels.items())))
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms of the daemon's work
+        Updating a metric takes a lock and a dict lookup so that metrics can be left on in 
+        production. Labels are for per-Fiery gauges. Counters and histograms are fleet-wide to
+        keep the number of series down.
+        Collectors added with add_collector() are called when the metrics are rendered and return
+        gauges that are read from the state of the daemon.
+    """
+
+    # Upper bounds of histogram buckets in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {name: {series key: value}}
+        self.counters = collections.defaultdict(dict)
+        self.gauges = collections.defaultdict(dict)
+        # {name: [count in each bucket, sum, count]}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, n=1, **labels):
+        """Add n to counter name"""
+        key = metric_key(name, labels)
+        with self.lock:
+            series = self.counters[name]
+            series[key] = series.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        """Set gauge name to value"""
+        key = metric_key(name, labels)
+        with self.lock:
+            self.gauges[name][key] = value
+
+    def observe(self, name, value):
+        """Add value to histogram name"""
+        i = bisect.bisect_left(MetricsRegistry.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(MetricsRegistry.buckets), 0.0, 0]
+            if i < len(MetricsRegistry.buckets):
+                histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Add the time taken by the body of a with statement to histogram name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def add_collector(self, collector):
+        """collector() returns a list of (name, labels, value) gauges"""
+        self.collectors.append(collector)
+
+    def render(self):
+        """Returns: All the metrics in the Prometheus text exposition format"""
+        gauges = collections.defaultdict(dict)
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges[name][metric_key(name, labels)] = value
+
+        lines = []
+        def header(name, kind):
+            if name in METRICS_HELP:
+                lines.append('# HELP %s %s' % (name, METRICS_HELP[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            for name, series in self.gauges.items():
+                gauges[name].update(series)
+            for name, series in sorted(self.counters.items()):
+                header(name, 'counter')
+                lines.extend('%s %r' % (key, float(value)) for key, value in sorted(series.items()))
+            for name, (counts, total, count) in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                cumulative = 0
+                for bound, n in zip(MetricsRegistry.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket{le="%r"} %d' % (name, bound, cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, count))
+                lines.append('%s_sum %r' % (name, total))
+                lines.append('%s_count %d' % (name, count))
+        for name, series in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.extend('%s %r' % (key, float(value)) for key, value in sorted(series.items()))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves METRICS at /metrics"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port):
+    """Serve METRICS on localhost:port on a background thread"""
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    log_info('Serving metrics on http://127.0.0.1:%d/metrics' % port)
+    return httpd
+
+
+def percentiles(values, pcts=(50, 90, 99)):
+    """Returns: {pct: value} of values or None if there are none"""
+    values = sorted(values)
+    if not values:
+        return None
+    return {pct: values[min(len(values) - 1, int(len(values) * pct / 100))] for pct in pcts}
+
+
+class FreshnessTracker:
+    """Tracks how stale the PaperCut Job Log is: the lag from each job finishing printing on its 
+        Fiery to it being recorded on PaperCut
+            alert_secs: Lag at which a Fiery is reported in the log. 0 to disable alerts
+
+        Lags are kept for the last window_size jobs from each Fiery and the last fleet_window_size
+        jobs from all Fierys, dropping those recorded more than window_secs ago, so percentiles 
+        follow the current lag. Print times come from the Fierys' clocks so lags include any 
+        clock skew between the Fierys and this computer.
+        A Fiery whose lag goes over alert_secs is logged as an error once, and again when its lag
+        drops back below alert_secs.
+    """
+
+    window_size = 200
+    fleet_window_size = 10000
+    window_secs = 900
+
+    def __init__(self, alert_secs):
+        self.alert_secs = alert_secs
+        self.lock = threading.Lock()
+        # {ip: deque of (time recorded, lag)}
+        self.lags = {}
+        self.fleet_lags = collections.deque(maxlen=FreshnessTracker.fleet_window_size)
+        # Fierys whose lag is over alert_secs
+        self.alerting = set()
+
+    def observe(self, fiery_ip, print_times, now=None):
+        """Note that jobs from Fiery fiery_ip that finished printing at print_times were 
+            recorded at now
+        """
+        if not print_times:
+            return
+        now = now if now is not None else time.time()
+        lags = [(now, max(0.0, now - t)) for t in print_times]
+        max_lag = max(lag for _, lag in lags)
+        with self.lock:
+            if fiery_ip not in self.lags:
+                self.lags[fiery_ip] = collections.deque(maxlen=FreshnessTracker.window_size)
+            self.lags[fiery_ip].extend(lags)
+            self.fleet_lags.extend(lags)
+            if not self.alert_secs:
+                return
+            if max_lag >= self.alert_secs and fiery_ip not in self.alerting:
+                self.alerting.add(fiery_ip)
+                log_error('Jobs from Fiery %s are being recorded %.0f sec after they printed. '
+                          'The alert threshold is %d sec' % (fiery_ip, max_lag, self.alert_secs))
+            elif max_lag < self.alert_secs and fiery_ip in self.alerting:
+                self.alerting.discard(fiery_ip)
+                log_info('Jobs from Fiery %s are being recorded within %d sec of printing again' 
+                         % (fiery_ip, self.alert_secs))
+
+    @staticmethod
+    def percentiles(lags, now, pcts=(50, 90, 99)):
+        """Returns: {pct: lag} of the lags recorded in the last window_secs or None if there are
+            none
+        """
+        return percentiles([lag for t, lag in lags if t >= now - FreshnessTracker.window_secs],
+                           pcts)
+
+    def fleet(self, now=None):
+        """Returns: {50: p50, 90: p90, 99: p99} lag over all Fierys or None"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            lags = list(self.fleet_lags)
+        return FreshnessTracker.percentiles(lags, now)
+
+    def by_fiery(self, now=None):
+        """Returns: {ip: {50: p50, 90: p90, 99: p99}} lag of each Fiery with recent jobs"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            items = [(ip, list(lags)) for ip, lags in self.lags.items()]
+        result = {}
+        for ip, lags in items:
+            pcts = FreshnessTracker.percentiles(lags, now)
+            if pcts:
+                result[ip] = pcts
+        return result
+
+    def slowest(self, n, now=None):
+        """Returns: list of (ip, {50: p50, 90: p90, 99: p99}) of the n Fierys with the highest p99 
+            lag
+        """
+        return heapq.nlargest(n, self.by_fiery(now).items(), key=lambda item: item[1][99])
+
+    def collect_metrics(self):
+        """Returns: Gauges of the lags for METRICS"""
+        now = time.time()
+        gauges = []
+        fleet = self.fleet(now)
+        if fleet:
+            gauges.extend(('freshness_lag_seconds', {'quantile': '%g' % (pct / 100)}, lag)
+                          for pct, lag in sorted(fleet.items()))
+        for ip, pcts in self.by_fiery(now).items():
+            gauges.append(('fiery_freshness_lag_seconds', {'fiery': ip, 'quantile': '0.99'}, 
+                           pcts[99]))
+        return gauges
+
+
+#
+# Profiling
+#
+BATCH_SPANS = ('fetch', 'parse', 'sort', 'convert', 'record', 'save_fiery')
+
+
+class BatchTrace:
+    """Times of the stages that one page of jobs from a Fiery goes through
+            fiery_ip: Fiery the jobs came from
+        Stages are in BATCH_SPANS
+            fetch: Request for the page up to the response headers
+            parse: Reading and decoding the response body
+            sort: Sorting jobs that the Fiery returned out of id order
+            convert: Conversion to PaperCut job details
+            record: Recording on PaperCut, less save_fiery
+            save_fiery: Saving the Fiery state before and after recording
+    """
+
+    def __init__(self, fiery_ip):
+        self.fiery_ip = fiery_ip
+        self.start_time = time.time()
+        self.num_jobs = 0
+        # {stage: seconds}
+        self.spans = {}
+
+    def add(self, name, secs):
+        self.spans[name] = self.spans.get(name, 0.0) + secs
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Add the time taken by the body of a with statement to stage name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def finish(self):
+        """Report the stage times once the page has been recorded"""
+        for name, secs in self.spans.items():
+            METRICS.observe('batch_%s_seconds' % name, secs)
+        PROFILER.note_trace(self)
+        # The stage times are logged at info level while a profile is being taken
+        if PROFILER.running:
+            log = log_info
+        elif logging.getLogger().isEnabledFor(logging.DEBUG):
+            log = log_debug
+        else:
+            return
+        log('Page of %d jobs from Fiery %s took %.3f sec: %s', self.num_jobs, self.fiery_ip, 
+            time.time() - self.start_time, 
+            ', '.join('%s=%.3f' % (name, self.spans[name]) for name in BATCH_SPANS 
+                      if name in self.spans))
+
+
+def span(trace, name):
+    """trace.span(name), or a no-op context if trace is None"""
+    return trace.span(name) if trace is not None else NO_SPAN
+
+
+class _NoSpan:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class StackProfiler:
+    """Takes profiles of the running process on demand
+        start() samples the stacks of all threads every interval seconds for secs seconds then 
+        writes a profile file that lists
+            the stage times of the pages recorded while profiling 
+            the functions the threads were in most often
+            the sampled stacks in the collapsed format of flamegraph.pl
+        Stacks are sampled rather than traced with cProfile as cProfile only sees the thread 
+        it is started on, and the work is done on the pool and pipeline threads.
+    """
+
+    # Time between stack samples
+    interval = 0.01
+    # Default length of a profile. Set from the command line
+    secs = 30
+    # Profile files are prefix.<time>.<pid>.txt
+    prefix = 'papercut.fiery.profile'
+    # Number of functions listed in the summary
+    num_top = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+        # Set by request() and cleared by start_requested()
+        self.requested = False
+        # {stage: [seconds]} of the pages recorded while profiling
+        self.spans = collections.defaultdict(list)
+
+    def request(self):
+        """Ask for a profile to be taken by the next start_requested()
+            This only sets a flag so that it can be called from a signal handler. start() takes
+            locks, which deadlocks if the handler interrupts code that holds them.
+        """
+        self.requested = True
+
+    def start_requested(self):
+        """start() a profile if one has been request()ed"""
+        if self.requested:
+            self.requested = False
+            self.start()
+
+    def start(self, secs=None):
+        """Take a profile for secs seconds on a background thread
+            Returns: True if profiling was started, False if a profile is already being taken
+        """
+        secs = secs if secs is not None else StackProfiler.secs
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.spans = collections.defaultdict(list)
+        thread = threading.Thread(target=self._run, args=(secs,), name='profiler')
+        thread.daemon = True
+        thread.start()
+        log_info('Profiling for %d sec', secs)
+        return True
+
+    def note_trace(self, trace):
+        """Keep the stage times of trace if profiling"""
+        if not self.running:
+            return
+        with self.lock:
+            for name, secs in trace.spans.items():
+                self.spans[name].append(secs)
+
+    def _run(self, secs):
+        try:
+            start = time.time()
+            stacks = collections.Counter()
+            num_samples = 0
+            me = threading.current_thread().ident
+            while time.time() < start + secs:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('%s (%s:%d)' % (code.co_name, 
+                                     os.path.basename(code.co_filename), code.co_firstlineno))
+                        frame = frame.f_back
+                    stack.append(re.sub(r'-\d+$', '', names.get(ident, 'thread')))
+                    stacks[tuple(reversed(stack))] += 1
+                num_samples += 1
+                time.sleep(StackProfiler.interval)
+            with self.lock:
+                spans = self.spans
+            path = '%s.%s.%d.txt' % (StackProfiler.prefix, 
+                                     datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), 
+                                     os.getpid())
+            self.write(path, time.time() - start, num_samples, stacks, spans)
+            log_info('Wrote profile to "%s"', path)
+        except Exception, e:
+            log_error('Could not write profile: %s' % e)
+        finally:
+            self.running = False
+
+    @staticmethod
+    def write(path, secs, num_samples, stacks, spans):
+        """Write a profile to path
+            stacks: {(thread name, outermost function, ..., innermost function): samples}
+            spans: {stage: [seconds]}
+        """
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+        for stack, n in stacks.items():
+            self_samples[stack[-1]] += n
+            for function in set(stack[1:]):
+                total_samples[function] += n
+        num_stacks = max(1, sum(stacks.values()))
+
+        with open(path, 'wb') as f:
+            f.write('Profile of pid %d for %.1f sec. %d samples of %d thread stacks\n\n' % (
+                    os.getpid(), secs, num_samples, num_stacks))
+            f.write('Stage times of %d pages\n' % len(spans.get('record', [])))
+            f.write('    %-12s %8s %10s %10s %10s\n' % ('stage', 'pages', 'total sec', 
+                    'mean sec', 'max sec'))
+            for name in BATCH_SPANS:
+                values = spans.get(name)
+                if values:
+                    f.write('    %-12s %8d %10.3f %10.4f %10.4f\n' % (name, len(values), 
+                            sum(values), sum(values) / len(values), max(values)))
+            for title, samples in [('self', self_samples), ('total', total_samples)]:
+                f.write('\nFunctions by %s samples. Threads waiting on queues, locks and sockets '
+                        'are included\n' % title)
+                for function, n in samples.most_common(StackProfiler.num_top):
+                    f.write('    %6d %5.1f%%  %s\n' % (n, 100 * n / num_stacks, function))
+            f.write('\nStacks\n')
+            for stack, n in sorted(stacks.items(), key=lambda item: -item[1]):
+                f.write('%s %d\n' % (';'.join(stack), n))
+
+    def watch(self, trigger_path, check_secs=1.0):
+        """Start a profile whenever the file trigger_path is created or touched"""
+        def mtime():
+            try:
+                return os.path.getmtime(trigger_path)
+            except OSError:
+                return None
+
+        def run():
+            last_mtime = mtime()
+            while True:
+                time.sleep(check_secs)
+                current = mtime()
+                if current != last_mtime and current is not None:
+                    self.start()
+                last_mtime = current
+
+        thread = threading.Thread(target=run, name='profile-trigger')
+        thread.daemon = True
+        thread.start()
+
+
+PROFILER = StackProfiler()
+
+
+#
+# Fiery code
+# 
+class FieryState:
+    """Stores a Fiery's login info and the state of the number of jobs that have been read from it
+        and recorded on a PaperCut server.
+            ip: Fiery network name or ip address
+            username: Username for Fiery login
+            password: Password for Fiery login
+            max_id: Highest job id from this Fiery recorded on PaperCut
+            pending_max_id: Highest job id from this Fiery about to be recorded on PaperCut
+            bootstrap_id: Highest job id from this Fiery when its job history was skipped with
+                --bootstrap. Jobs with ids <= bootstrap_id were never polled
+    """
+
+    def __init__(self, ip=None, username=None, password=None, max_id=None, pending_max_id=None,
+                 bootstrap_id=None):
+        """All key word args to simplify construction from a dict as in from_dict()"""
+        self.ip = ip
+        self.username = username
+        self.password = password
+        self.max_id = max_id 
+        self.pending_max_id = pending_max_id
+        self.bootstrap_id = bootstrap_id
+
+    def __repr__(self): 
+        """Show the non-None values"""
+        return repr({k:v for k,v in self.__dict__.items() if v is not None}) 
+
+    def dict_no_ip(self):
+        """Convenience function for when ip is stored separately as in PaperCut config editor
+            where the ip is stored in the key and dict_no_ip() is stored in the value
+        """
+        # TODO: Should we hide password?
+        return {k:v for k,v in self.__dict__.items() if v is not None and k != 'ip'}
+
+    def repr_no_ip(self):
+        return repr(self.dict_no_ip())    
+
+    @classmethod 
+    def from_dict(cls, dct, ip=None):
+        fiery = cls(**dct)
+        if ip:
+            fiery.ip = ip
+        return fiery
+
+    def is_inconsistent(self):
+        """A FieryState is consistent if there are no pending jobs that have not been recorded.
+            A FieryState can be inconsistent if this script crashed while recording Fiery jobs on
+            a PaperCut server.
+            If this ever happens then 
+                - the PaperCut server should be checked to see which Fiery jobs with 
+                  id: max_id > id >= pending_max_id have been recorded. 
+                - the FieryState should be be updated to 
+                        max_id = highest id
+                        pending_max_id = None        
+            The FieryState will be saved in the PaperCut config as described in FieryStateStore
+            and logged at ERROR level if this should ever happen. See log_inconsistent(). 
+        """
+        return self.pending_max_id is not None and (
+                self.max_id is None or self.pending_max_id > self.max_id)
+
+
+def fiery_load_api_key(key_file): 
+    """Load api key from key_file"""
+    try:   
+        return open(key_file, 'rb').read()
+    except Exception, e:
+        print('Could not load Fiery API key from %s: %s' % (key_file, e))
+        return None
+
+
+class FieryConnection:
+    """Connnection to a Fiery
+            fiery: FieryState of Fiery connected to
+            url: URL of Fiery
+            session_cookie: Session cookie for connection
+            session: Keep-alive HTTP session that sends session_cookie with each request
+            connected: True if successfully connected
+            failure: String containing failure message if there was a failuree
+            fetch_secs: Duration of the last call to fetch_jobs()
+            page_size: Number of jobs to request in the next call to fetch_jobs()
+            backlogged: True if the last call to fetch_jobs() returned a full page, so the Fiery
+                probably has more jobs waiting to be fetched
+    """
+    # TODO: Add retry in case where connection are dropped?
+
+    # Initial number of jobs requested in each call to fetch_jobs()
+    batch_size = 100
+    # In drain mode the page size is adapted between these bounds so that each fetch takes 
+    # about target_fetch_secs and returns no more than max_fetch_bytes
+    drain = True
+    min_batch_size = 10
+    max_batch_size = 1000
+    target_fetch_secs = 5.0
+    max_fetch_bytes = 8 * 1024 * 1024
+    # Timeouts in seconds for connecting to and reading from a Fiery
+    connect_timeout = 10.0
+    read_timeout = 60.0
+    # Fiery responses are decoded as they are read in chunks of this many bytes
+    chunk_size = 64 * 1024
+
+    @staticmethod
+    def set_api_key(api_key):
+        FieryConnection.api_key = api_key
+        
+    def __init__(self, fiery):
+        self.fiery = fiery
+        self.url = None
+        self.session_cookie = None
+        self.session = FieryConnection.make_session()
+        self.connected = False
+        self.failure = None
+        self.fetch_secs = 0.0
+        self.page_size = FieryConnection.batch_size
+        self.backlogged = False
+        # Id to fetch from when fetching ahead of the jobs recorded on PaperCut. None to fetch
+        # from fiery.max_id
+        self.next_id = None
+        self.login()
+
+    @staticmethod
+    def make_session():
+        """Return a requests session that keeps its connection to a Fiery open between polls"""
+        session = requests.Session()
+        # Each FieryConnection talks to one host so one pooled connection is enough
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('https://', adapter)
+        return session
+
+    @staticmethod
+    def timeout():
+        return (FieryConnection.connect_timeout, FieryConnection.read_timeout)
+
+    def login(self): 
+        """Login to Fiery
+            Set connected = True on success
+        """
+        with METRICS.timer('fiery_login_seconds'):
+            self._login()
+        if not self.connected:
+            METRICS.inc('fiery_login_failures_total')
+
+    def _login(self):
+        self.connected = False
+        self.session_cookie = None
+
+        auth = {
+            'username': self.fiery.username, 
+            'password': self.fiery.password,
+            'accessrights': {'a1': FieryConnection.api_key}
+        }
+        log_debug('fiery_login: fiery=%s,auth=%s', self, json.dumps(auth))
+
+        if not self.fiery.ip:
+            self.failure = 'no server specified'
+            return
+
+        self.url = 'https://%s/live' % self.fiery.ip
+
+        # Don't send a stale session cookie with the login request
+        self.session.headers.pop('Cookie', None)
+        
+        try:
+            r = self.session.post('%s/login' % self.url, 
+                                  data=json.dumps(auth), 
+                                  headers={'content-type': 'application/json'}, 
+                                  verify=False,
+                                  timeout=FieryConnection.timeout())
+        except requests.RequestException, e:
+            self.failure = 'login: %s' % e
+            return
+        if r.status_code != 200:
+            self.failure = 'login: http code=%d' % r.status_code
+            return
+
+        log_debug('Connected to Fiery "%s"', self.url)
+
+        # Check for cookies
+        if 'set-cookie' not in r.headers:
+            self.failure = 'No cookies'
+            return
+
+        # Extract login coookie
+        cookies = r.headers['set-cookie']
+        m = re.search('_session_id=([^ ;]+)', cookies)
+        if not m:
+            self.failure = 'No session cookie'
+            return
+
+        self.session_cookie = m.group(1)
+        log_debug('session_cookie=%s', self.session_cookie)
+
+        # The session sends the cookie with every subsequent request
+        self.session.cookies.clear()
+        self.session.headers['Cookie'] = '_session_id=%s;' % self.session_cookie
+
+        self.failure = None
+        self.connected = True
+
+    def relogin(self, reason):
+        """Login to Fiery again after its session has been lost
+            Returns: True if the login succeeded
+        """
+        log_info('Logging in to Fiery %s again: %s' % (self.fiery.ip, reason))
+        self.login()
+        if not self.connected:
+            log_error('Could not log in to Fiery %s: %s' % (self.fiery.ip, self.failure))
+        return self.connected
+
+    def fetch_jobs(self, trace=None): 
+        """Fetch the next page of jobs after max_id, or from next_id if it is set, from the Fiery
+            trace: BatchTrace to add the fetch, parse and sort times to or None
+            Returns: list of jobs sorted by id or None on failure
+        """
+    
+        if self.next_id is not None:
+            start_id = self.next_id
+        else:
+            start_id = self.fiery.max_id + 1 if self.fiery.max_id is not None else 0
+        count = self.page_size
+
+        self.backlogged = False
+        start = time.time()
+        with span(trace, 'fetch'):
+            r = self._get_jobs(start_id, count)
+        if r is None:
+            self.fetch_secs = time.time() - start
+            return None
+
+        # The list of printed jobs
+        # Jobs are decoded as they arrive and only the fields needed for recording are kept so 
+        # that memory use does not grow with the size of each job's media counters
+        num_bytes = [0]
+        def chunks():
+            for chunk in r.iter_content(FieryConnection.chunk_size):
+                num_bytes[0] += len(chunk)
+                yield chunk
+
+        fiery_jobs = []
+        in_order = True
+        with span(trace, 'parse'):
+            for job in iter_json_list(chunks()):
+                if fiery_jobs and job['id'] <= fiery_jobs[-1]['id']:
+                    in_order = False
+                fiery_jobs.append({k: job[k] for k in FIERY_JOB_KEYS if k in job})
+        self.fetch_secs = time.time() - start
+
+        # Fierys seem to return these lists sorted by id. We only sort if they don't
+        if not in_order:
+            log_info('Fiery %s returned jobs out of id order. Sorting' % self.fiery.ip)
+            with span(trace, 'sort'):
+                fiery_jobs.sort(key=lambda x: x['id'])
+
+        if fiery_jobs:
+            self.next_id = fiery_jobs[-1]['id'] + 1
+
+        # A full page means there are probably more jobs waiting on the Fiery
+        self.backlogged = FieryConnection.drain and len(fiery_jobs) >= count
+        if FieryConnection.drain:
+            self.adapt_page_size(count, len(fiery_jobs), num_bytes[0])
+
+        return fiery_jobs
+
+    def _get_jobs(self, start_id, count):
+        """Start a request for up to count jobs with ids >= start_id
+            Returns: requests.Response whose body is to be streamed or None on failure
+        """
+        if not self.session_cookie and not self.relogin('no session cookie'):
+            return None
+
+        # Request job log
+        full_url = '%s/api/v1/cost?start_id=%d&count=%d' % (self.url, start_id, count)
+
+        log_debug('Retrieving Fiery jobs: url="%s"', full_url)
+
+        r = self._get(full_url)
+        if r.status_code in (401, 403):
+            # The session has expired. Log in again and retry once
+            r.close()
+            if not self.relogin('http code=%d' % r.status_code):
+                return None
+            r = self._get(full_url)
+        if r.status_code != 200:
+            r.close()
+            self.failure = 'url=%s, http code=%d' % (full_url, r.status_code)
+            return None
+        return r
+
+    def first_job_id(self, start_id):
+        """Returns: (True, id of the first job with id >= start_id or None if there is none) or
+            (False, None) on failure
+        """
+        r = self._get_jobs(start_id, 1)
+        if r is None:
+            return False, None
+        # Read the whole response so that the connection can be reused
+        job_ids = [job['id'] for job in iter_json_list(r.iter_content(FieryConnection.chunk_size))]
+        return True, min(job_ids) if job_ids else None
+
+    def find_max_id(self):
+        """Find the highest job id on the Fiery without fetching its job history
+            Returns: highest job id, -1 if the Fiery has no jobs or None on failure
+            Uses an exponential search for an id above all the jobs followed by a binary search 
+            between that and the highest job id seen, one job per request.
+        """
+        ok, lo = self.first_job_id(0)
+        if not ok:
+            return None
+        if lo is None:
+            return -1
+        # Invariants: lo is a job id and there are no jobs with ids >= hi
+        hi = max(1, lo * 2)
+        while True:
+            ok, job_id = self.first_job_id(hi)
+            if not ok:
+                return None
+            if job_id is None:
+                break
+            lo, hi = job_id, job_id * 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            ok, job_id = self.first_job_id(mid)
+            if not ok:
+                return None
+            if job_id is None:
+                hi = mid
+            else:
+                lo = job_id
+        return lo
+
+    def _get(self, url):
+        """Start a GET request on url whose body will be streamed"""
+        return self.session.get(url, verify=False, timeout=FieryConnection.timeout(), stream=True)
+
+    def adapt_page_size(self, count, num_jobs, num_bytes):
+        """Grow or shrink page_size based on the last fetch
+            count: Number of jobs requested
+            num_jobs: Number of jobs returned
+            num_bytes: Size of the response body
+            Pages are halved when a fetch is slow or large and doubled when a full page was
+            fetched quickly.
+        """
+        if (self.fetch_secs > FieryConnection.target_fetch_secs 
+            or num_bytes > FieryConnection.max_fetch_bytes):
+            page_size = max(FieryConnection.min_batch_size, count // 2)
+        elif (num_jobs >= count 
+              and self.fetch_secs < FieryConnection.target_fetch_secs / 2 
+              and num_bytes < FieryConnection.max_fetch_bytes / 2):
+            page_size = min(FieryConnection.max_batch_size, count * 2)
+        else:
+            page_size = count
+
+        if page_size != self.page_size:
+            log_debug('Fiery %s page size %d => %d (%d jobs, %d bytes, %.3f sec)', 
+                      self.fiery.ip, self.page_size, page_size, num_jobs, num_bytes, 
+                      self.fetch_secs)
+            self.page_size = page_size
+
+
+class FieryReconnector:
+    """Retries logins to Fierys that are not connected, backing off exponentially with jitter
+            min_backoff_secs: Delay before the first retry
+            max_backoff_secs: Longest delay between retries
+    """
+
+    def __init__(self, min_backoff_secs=30, max_backoff_secs=3600):
+        self.min_backoff_secs = min_backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        # {fiery_connection: (number of failed attempts, time of next attempt)}
+        self.waiting = {}
+        # {fiery_connection: number of failed attempts} for logins in progress
+        self.attempting = {}
+
+    def __len__(self):
+        return len(self.waiting) + len(self.attempting)
+
+    def backoff_secs(self, attempts):
+        """Delay before retrying a Fiery that has failed attempts times"""
+        delay = min(self.max_backoff_secs, self.min_backoff_secs * 2 ** min(attempts, 30))
+        # Equal jitter so that Fierys that failed together don't retry together
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def add(self, fiery_connection, attempts=0):
+        """Schedule a login retry for fiery_connection"""
+        delay = self.backoff_secs(attempts)
+        log_info('Will retry Fiery %s in %.0f sec: %s' % (fiery_connection.fiery.ip, delay,
+                 fiery_connection.failure))
+        self.waiting[fiery_connection] = (attempts, time.time() + delay)
+
+    def take_due(self, now=None):
+        """Returns: list of Fiery connections whose next login attempt is due
+            The caller should call login() on each of them and then finish()
+        """
+        now = now if now is not None else time.time()
+        due_list = [fc for fc, (_, next_time) in self.waiting.items() if next_time <= now]
+        for fiery_connection in due_list:
+            attempts, _ = self.waiting.pop(fiery_connection)
+            self.attempting[fiery_connection] = attempts
+        return due_list
+
+    def finish(self, fiery_connection):
+        """Handle the result of a login attempt on a Fiery connection returned by take_due()
+            Returns: True if the Fiery is now connected. If not, another attempt is scheduled
+        """
+        attempts = self.attempting.pop(fiery_connection, 0)
+        if fiery_connection.connected:
+            log_info('Reconnected to Fiery %s' % fiery_connection.fiery.ip)
+            return True
+        self.add(fiery_connection, attempts + 1)
+        return False
+
+
+class FieryScheduler:
+    """Decides when each Fiery is next polled from its recent job arrival rate
+            initial_secs: Time between polls of a Fiery before its arrival rate is known
+            min_secs: Shortest time between polls of a Fiery
+            max_secs: Longest time between polls of a Fiery
+
+        Each Fiery is polled about once per job it prints, within [min_secs, max_secs], so busy 
+        Fierys are recorded with low lag and idle Fierys are polled rarely.
+    """
+
+    # Weight of the latest poll in each Fiery's smoothed arrival rate
+    smoothing = 0.3
+
+    def __init__(self, initial_secs, min_secs, max_secs):
+        self.initial_secs = initial_secs
+        self.min_secs = min_secs
+        self.max_secs = max_secs
+        # {fiery_connection: [time of next poll, time of last poll, jobs per second]}
+        self.schedule = {}
+
+    def add(self, fiery_connection, now=None):
+        """Start scheduling fiery_connection. It is due straight away"""
+        now = now if now is not None else time.time()
+        self.schedule[fiery_connection] = [now, None, None]
+
+    def remove(self, fiery_connection):
+        self.schedule.pop(fiery_connection, None)
+
+    def due(self, now=None):
+        """Returns: list of Fiery connections whose next poll is due"""
+        now = now if now is not None else time.time()
+        return [fc for fc, (next_time, _, _) in self.schedule.items() if next_time <= now]
+
+    def next_time(self):
+        """Returns: time of the next due poll or None if nothing is scheduled"""
+        return min(next_time for next_time, _, _ in self.schedule.values()) if self.schedule else None
+
+    def start_poll(self, fiery_connection):
+        """Note that fiery_connection is being polled. It is not due again until update()"""
+        self.schedule[fiery_connection][0] = float('inf')
+
+    def poll_now(self, fiery_connection):
+        """Make fiery_connection due straight away, e.g. to drain its backlog"""
+        self.schedule[fiery_connection][0] = time.time()
+
+    def poll_in(self, fiery_connection, secs):
+        """Make fiery_connection due in secs seconds"""
+        self.schedule[fiery_connection][0] = time.time() + secs
+
+    def update(self, fiery_connection, num_jobs, now=None):
+        """Schedule the next poll of fiery_connection after a poll that fetched num_jobs jobs
+            num_jobs: None if the poll failed
+        """
+        now = now if now is not None else time.time()
+        entry = self.schedule.get(fiery_connection)
+        if entry is None:
+            return
+        _, last_time, rate = entry
+        if num_jobs is None:
+            # A failed poll says nothing about the arrival rate so it is retried at the current 
+            # interval. The jobs printed meanwhile are counted against the time since the last 
+            # poll that succeeded
+            if rate is None:
+                interval = self.initial_secs
+            else:
+                interval = 1 / rate if rate > 0 else self.max_secs
+            interval = min(self.max_secs, max(self.min_secs, interval))
+            entry[0] = now + interval
+            return
+        if last_time is None:
+            # First poll: the jobs may have been printed at any time in the past
+            interval = self.initial_secs
+        else:
+            # Rates above one job per min_secs can't shorten the interval any further. Capping 
+            # them stops a backlog being drained from keeping a Fiery at min_secs afterwards
+            latest_rate = min(num_jobs / max(now - last_time, 1e-3), 1 / max(self.min_secs, 1e-3))
+            if rate is None:
+                rate = latest_rate
+            else:
+                rate = FieryScheduler.smoothing * latest_rate + (1 - FieryScheduler.smoothing) * rate
+            interval = 1 / rate if rate > 0 else self.max_secs
+        interval = min(self.max_secs, max(self.min_secs, interval))
+        self.schedule[fiery_connection] = [now + interval, now, rate]
+        log_debug('Fiery %s: %d jobs, rate=%s jobs/sec, next poll in %.1f sec', 
+                  fiery_connection.fiery.ip, num_jobs, rate, interval)
+
+
+class IngestionEngine:
+    """Polls Fierys and records their jobs on PaperCut without letting any one Fiery hold up 
+        the others.
+            papercut: PaperCut to record jobs on
+            pool: WorkerPool that runs Fiery fetches and logins. It bounds the number of Fierys 
+                being talked to at one time
+            scheduler: FieryScheduler that decides when each Fiery is polled
+            reconnector: FieryReconnector that decides when Fierys that are not connected are
+                retried
+            claim_secs: Time between checks that no other instance of this script has claimed
+                the PaperCut server
+            spool: JobSpool for jobs that can't be recorded while PaperCut is offline or None to 
+                stop when PaperCut can't be reached
+
+        The main thread runs run(), which dispatches work and waits on a queue of completed work.
+        Jobs flow through a pipeline of stages joined by bounded queues
+            fetch:   pages of jobs are fetched from Fierys on pool
+            convert: pages are converted to PaperCut job details on the converter threads
+            record:  pages are recorded on PaperCut on the recorder threads
+        A full queue holds back the stage that feeds it.
+        A Fiery with a backlog has its next page fetched while the pages before it are being 
+        converted and recorded, up to read_ahead pages. All pages from a Fiery go through the
+        same converter and recorder threads so its jobs are recorded in id order, one page at a 
+        time, and check_jobs() and the pending_max_id protocol hold. If PaperCut rejects any of
+        a Fiery's jobs then its pages after them are dropped and it is fetched again from its
+        max_id once its pipeline is empty.
+        With a spool, pages that can't be recorded because PaperCut can't be reached are spooled
+        and fetching carries on. While PaperCut is offline, and while a Fiery has pages in the 
+        spool, its new pages are spooled too. A drainer thread records the spooled pages in 
+        order once PaperCut is back.
+        stop() or an exception on any thread ends run() after the recorders have finished the 
+        pages they are recording.
+    """
+
+    # Time between log reports of throughput
+    report_secs = 60
+    # Longest time run() waits on completed work before acting on stop() and on profile requests
+    # from signal handlers
+    signal_check_secs = 1.0
+    # Pipeline sizes. Set from the command line
+    num_converters = 1
+    num_recorders = 2
+    queue_size = 4
+    # Maximum number of pages from one Fiery that are fetched but not yet recorded
+    read_ahead = 2
+    # Start recording Fierys that have never been recorded from their current job
+    bootstrap = False
+    # Number of Fierys with the highest lag or poll time listed in each report
+    num_slowest = 5
+
+    # Time between attempts to record spooled jobs while PaperCut is offline
+    spool_retry_secs = 10
+    # Number of times a job that PaperCut rejects is fetched again before it is skipped
+    reject_retries = 3
+
+    def __init__(self, papercut, pool, scheduler, reconnector, claim_secs, spool=None):
+        self.papercut = papercut
+        self.pool = pool
+        self.scheduler = scheduler
+        self.reconnector = reconnector
+        self.claim_secs = claim_secs
+        self.spool = spool
+        # Completed work: (kind, fiery_connection, value) posted by the other threads
+        self.completed = Queue.Queue()
+        self.stop_event = threading.Event()
+        # Set by stop(). run() sets stop_event when it sees it
+        self.stop_requested = False
+        self.exc_info = None
+        self.converters = self.recorders = None
+        self.fiery_connection_list = []
+        # Fierys being fetched from
+        self.fetching = set()
+        # {fiery_connection: number of pages fetched and not yet recorded}
+        self.pages = {}
+        # {ip: FieryState} of all Fierys, connected or not, for recording spooled jobs
+        self.fiery_of = {}
+        # Fierys with jobs that PaperCut rejected. Their pages in the pipeline are dropped and 
+        # they are fetched again from their max_id
+        self.refetch = set()
+        # Held while a Fiery is added to refetch and its spooled pages are discarded, and while 
+        # a recorder checks refetch and spools a page, so no page after rejected jobs is spooled
+        self.reject_lock = threading.Lock()
+        # {ip: (id of the job PaperCut rejected, number of times in a row it was rejected)}
+        self.rejections = {}
+        self.stats = {'polls': 0, 'fetched': 0, 'recorded': 0, 'spooled': 0}
+        # {ip: [round trip time of each poll of the Fiery since the last report]}
+        self.poll_secs = {}
+
+    def stop(self):
+        """Ask run() to return within signal_check_secs
+            This only sets a flag so that it can be called from a signal handler. A handler that
+            takes a lock deadlocks if it interrupts code that holds the lock.
+        """
+        self.stop_requested = True
+
+    def run(self, fiery_connection_list, failed_connection_list=()):
+        """Poll the Fierys and record their jobs until stop() is called
+            fiery_connection_list: Connected Fierys
+            failed_connection_list: Fierys that could not be logged in to
+            Re-raises any exception raised on the fetching or recording threads, including the
+            SystemExits raised by the consistency and claim checks.
+        """
+        for fiery_connection in fiery_connection_list:
+            self.add(fiery_connection)
+        for fiery_connection in failed_connection_list:
+            self.fiery_of[fiery_connection.fiery.ip] = fiery_connection.fiery
+            self.reconnector.add(fiery_connection)
+
+        METRICS.add_collector(self.collect_metrics)
+        if self.papercut.freshness:
+            METRICS.add_collector(self.papercut.freshness.collect_metrics)
+        if self.spool is not None:
+            drainer = threading.Thread(target=self._drain_loop, name='spool-drainer')
+            drainer.daemon = True
+            drainer.start()
+
+        self.recorders = PipelineStage('recorder', self._record, IngestionEngine.num_recorders,
+                                       IngestionEngine.queue_size, self._error)
+        self.converters = PipelineStage('converter', self._convert, 
+                                        IngestionEngine.num_converters, 
+                                        IngestionEngine.queue_size, self._error)
+
+        last_claim_time = last_report_time = time.time()
+        try:
+            while not self.stop_event.is_set():
+                self._dispatch()
+
+                now = time.time()
+                next_time = min(self.scheduler.next_time() or float('inf'),
+                                last_claim_time + self.claim_secs,
+                                last_report_time + IngestionEngine.report_secs)
+                if self.reconnector:
+                    next_time = min(next_time, now + self.scheduler.min_secs)
+                next_time = min(next_time, now + IngestionEngine.signal_check_secs)
+                try:
+                    item = self.completed.get(timeout=max(0.0, next_time - now))
+                    while True:
+                        self._handle(*item)
+                        item = self.completed.get_nowait()
+                except Queue.Empty:
+                    pass
+                if self.stop_requested:
+                    # Stops the spool drainer too
+                    self.stop_event.set()
+                    break
+                PROFILER.start_requested()
+
+                now = time.time()
+                if now >= last_claim_time + self.claim_secs:
+                    try:
+                        self.papercut.check_claim()
+                    except PAPERCUT_ERRORS, e:
+                        if self.spool is None:
+                            raise
+                        log_error('Could not check claim on PaperCut server: %s' % e)
+                    last_claim_time = now
+                if now >= last_report_time + IngestionEngine.report_secs:
+                    self.report(now - last_report_time)
+                    last_report_time = now
+        finally:
+            # Let the recorders finish the pages they are recording so the Fiery states stay 
+            # consistent. The converters go first as they may be waiting on the recorders
+            self.converters.stopping = self.recorders.stopping = True
+            self.converters.close()
+            self.recorders.close()
+
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def add(self, fiery_connection):
+        """Start polling fiery_connection"""
+        self.fiery_connection_list.append(fiery_connection)
+        self.pages[fiery_connection] = 0
+        self.fiery_of[fiery_connection.fiery.ip] = fiery_connection.fiery
+        if self.spool is not None:
+            # Carry on from the last spooled jobs
+            fiery_connection.next_id = self.spool.next_id(fiery_connection.fiery.ip)
+        self.scheduler.add(fiery_connection)
+
+    def _dispatch(self):
+        """Start fetches from all Fierys that are due and logins to all Fierys being retried"""
+        for fiery_connection in self.reconnector.take_due():
+            self.pool.submit(self._login, fiery_connection)
+        for fiery_connection in self.scheduler.due():
+            self.scheduler.start_poll(fiery_connection)
+            self.fetching.add(fiery_connection)
+            self.pool.submit(self._fetch, fiery_connection)
+
+    def _handle(self, kind, fiery_connection, value):
+        """Handle an item of completed work posted by another thread"""
+        if kind == 'error':
+            if not self.exc_info:
+                self.exc_info = value
+            self.stop_event.set()
+        elif kind == 'login':
+            if self.reconnector.finish(fiery_connection):
+                self.add(fiery_connection)
+        elif kind == 'polled':
+            self.poll_secs.setdefault(fiery_connection.fiery.ip, []).append(value)
+        elif kind == 'fetched':
+            self.stats['polls'] += 1
+            self.stats['fetched'] += value or 0
+            self.fetching.discard(fiery_connection)
+            if value:
+                self.pages[fiery_connection] += 1
+            self.scheduler.update(fiery_connection, value)
+            self._reschedule(fiery_connection)
+        elif kind in ('recorded', 'spooled'):
+            self.stats[kind] += value
+            self.pages[fiery_connection] -= 1
+            self._reschedule(fiery_connection)
+
+    def _reschedule(self, fiery_connection):
+        """Decide what to do next with a Fiery after a fetch from it or a recording of its jobs
+            Fierys with a backlog are fetched from again straight away unless read_ahead pages 
+            are already in the pipeline. 
+            Fierys that have lost their connection are handed to the reconnector once their 
+            pages have been recorded.
+        """
+        if fiery_connection in self.fetching:
+            return
+        pages = self.pages[fiery_connection]
+        if pages == 0:
+            # Nothing in the pipeline so fetch from the recorded or spooled state
+            fiery_connection.next_id = (self.spool.next_id(fiery_connection.fiery.ip) 
+                                        if self.spool is not None else None)
+            if fiery_connection in self.refetch and fiery_connection.connected:
+                # Retry the rejected jobs after a normal poll interval rather than straight away
+                self.refetch.discard(fiery_connection)
+                self.scheduler.poll_in(fiery_connection, self.scheduler.initial_secs)
+                return
+            self.refetch.discard(fiery_connection)
+
+        if not fiery_connection.connected:
+            if pages == 0:
+                self.fiery_connection_list.remove(fiery_connection)
+                del self.pages[fiery_connection]
+                self.scheduler.remove(fiery_connection)
+                self.reconnector.add(fiery_connection)
+            else:
+                self.scheduler.start_poll(fiery_connection)
+        elif fiery_connection.backlogged:
+            if pages < IngestionEngine.read_ahead:
+                log_info('Draining backlog on Fiery %s', fiery_connection.fiery.ip)
+                self.scheduler.poll_now(fiery_connection)
+            else:
+                self.scheduler.start_poll(fiery_connection)
+
+    def _error(self, exc_info):
+        """Stop recording and have run() re-raise exc_info"""
+        self.converters.stopping = self.recorders.stopping = True
+        self.completed.put(('error', None, exc_info))
+
+    def _login(self, fiery_connection):
+        """Runs on pool"""
+        try:
+            fiery_connection.login()
+            self.completed.put(('login', fiery_connection, None))
+        except Exception:
+            self._error(sys.exc_info())
+
+    def _bootstrap(self, fiery_connection):
+        """Skip the job history of a Fiery that has never been recorded by setting its max_id to 
+            its current highest job id
+            Returns: True on success
+        """
+        fiery = fiery_connection.fiery
+        start = time.time()
+        max_id = fiery_connection.find_max_id()
+        if max_id is None:
+            return False
+        fiery.max_id = fiery.bootstrap_id = max_id
+        self.papercut.note_fiery(fiery)
+        log_info('Bootstrapped Fiery %s in %.1f sec. Recording jobs with ids > %d' % (fiery.ip,
+                 time.time() - start, max_id))
+        return True
+
+    def _fetch(self, fiery_connection):
+        """Runs on pool. Passes the fetched jobs on to the converters"""
+        try:
+            try:
+                if (IngestionEngine.bootstrap and fiery_connection.fiery.max_id is None 
+                    and not self._bootstrap(fiery_connection)):
+                    fiery_jobs = None
+                else:
+                    trace = BatchTrace(fiery_connection.fiery.ip)
+                    try:
+                        with METRICS.timer('fiery_fetch_seconds'):
+                            fiery_jobs = fiery_connection.fetch_jobs(trace)
+                    finally:
+                        self.completed.put(('polled', fiery_connection, 
+                                            time.time() - trace.start_time))
+            except (requests.RequestException, ValueError), e:
+                fiery_connection.failure = 'fetch_jobs: %s' % e
+                fiery_connection.backlogged = False
+                fiery_jobs = None
+            if fiery_jobs is None:
+                METRICS.inc('fiery_fetch_failures_total')
+            if fiery_jobs is None and fiery_connection.failure:
+                log_error('Could not fetch jobs from Fiery %s: %s' % (fiery_connection.fiery.ip,
+                          fiery_connection.failure))
+            if fiery_jobs:
+                METRICS.inc('fiery_jobs_fetched_total', len(fiery_jobs))
+                log_info('Fetched %d jobs from %s', len(fiery_jobs), fiery_connection.fiery.ip)
+                log_debug('%s', fiery_jobs)
+                # Hand the page on before reporting the fetch so that the next page from this 
+                # Fiery can't be queued ahead of it
+                trace.num_jobs = len(fiery_jobs)
+                self.converters.put(fiery_connection.fiery.ip, 
+                                    (fiery_connection, fiery_jobs, trace))
+                self.completed.put(('fetched', fiery_connection, len(fiery_jobs)))
+            else:
+                self.completed.put(('fetched', fiery_connection, 0 if fiery_jobs is not None 
+                                                                else None))
+        except Exception:
+            self._error(sys.exc_info())
+
+    def _convert(self, item):
+        """Runs on the converter threads"""
+        fiery_connection, fiery_jobs, trace = item
+        with trace.span('convert'):
+            id_details_list = self.papercut.converter.convert_batch(fiery_jobs)
+        self.recorders.put(fiery_connection.fiery.ip, 
+                           (fiery_connection, fiery_jobs, id_details_list, trace))
+
+    def _record(self, item):
+        """Runs on the recorder threads"""
+        fiery_connection, fiery_jobs, id_details_list, trace = item
+        fiery = fiery_connection.fiery
+        with self.reject_lock:
+            if fiery_connection in self.refetch:
+                # These jobs come after jobs that PaperCut rejected
+                self.completed.put(('recorded', fiery_connection, 0))
+                return
+            if self.spool is not None and self.spool.append_if_spooling(fiery.ip, fiery_jobs, 
+                                                                        id_details_list):
+                self.completed.put(('spooled', fiery_connection, len(fiery_jobs)))
+                return
+        try:
+            if self.papercut.record_jobs(fiery, fiery_jobs, id_details_list, trace):
+                trace.finish()
+            else:
+                self._rejected(fiery, fiery_jobs)
+                self.refetch.add(fiery_connection)
+        except PaperCutUnavailable, e:
+            if self.spool is None:
+                raise
+            self.spool.offline = True
+            self.spool.append(fiery.ip, e.fiery_job_list, e.id_details_list)
+            log_info('Spooling jobs until PaperCut can be reached')
+        self.completed.put(('recorded', fiery_connection, len(fiery_jobs)))
+
+    def _drain_loop(self):
+        """Runs on the spool drainer thread. Records the spooled jobs when PaperCut can be 
+            reached
+        """
+        try:
+            while not self.stop_event.is_set():
+                page = self.spool.peek()
+                if page is None:
+                    self.stop_event.wait(1.0)
+                    continue
+                ip, fiery_job_list, id_details_list = page
+                fiery = self.fiery_of.get(ip)
+                if fiery is None:
+                    log_error('Dropping spooled jobs from Fiery %s, which is no longer tracked' % 
+                              ip)
+                    self.spool.pop()
+                    continue
+                fiery_job_list, id_details_list = trim_jobs(fiery.max_id, fiery_job_list, 
+                                                            id_details_list)
+                recorded = True
+                if fiery_job_list:
+                    try:
+                        recorded = self.papercut.record_jobs(fiery, fiery_job_list, 
+                                                             id_details_list)
+                    except PaperCutUnavailable:
+                        # The jobs that were recorded are trimmed or skipped next time
+                        self.stop_event.wait(IngestionEngine.spool_retry_secs)
+                        continue
+                if self.spool.offline:
+                    log_info('PaperCut can be reached. Recording %d pages of spooled jobs' % 
+                             len(self.spool))
+                    self.spool.offline = False
+                if recorded:
+                    self.spool.pop()
+                else:
+                    self._rejected(fiery, fiery_job_list)
+                    self._drop_spooled(ip)
+        except BaseException:
+            self._error(sys.exc_info())
+
+    def _rejected(self, fiery, fiery_jobs):
+        """Runs on the recorder and spool drainer threads after PaperCut rejected a job in 
+            fiery_jobs. fiery.max_id has been left before the rejected job so it is fetched again.
+            After reject_retries retries it is skipped instead, as Backfill does, so that it 
+            doesn't hold up the Fiery's later jobs for good.
+        """
+        remaining, _ = trim_jobs(fiery.max_id, fiery_jobs, [])
+        if not remaining:
+            return
+        job_id = remaining[0]['id']
+        with self.reject_lock:
+            last_id, count = self.rejections.get(fiery.ip, (None, 0))
+            count = count + 1 if job_id == last_id else 1
+            if count <= IngestionEngine.reject_retries:
+                self.rejections[fiery.ip] = (job_id, count)
+                return
+            del self.rejections[fiery.ip]
+        log_error('PaperCut rejected Fiery %s job id=%d %d times. Skipping it. Record it in '
+                  'PaperCut by hand if it should be billed', fiery.ip, job_id, count)
+        METRICS.inc('papercut_jobs_skipped_total')
+        fiery.max_id = job_id
+        self.papercut.note_fiery(fiery)
+
+    def _drop_spooled(self, ip):
+        """Runs on the spool drainer thread after PaperCut rejected jobs in the oldest spooled 
+            page, which is from Fiery ip. As in drain_spool(), the Fiery's spooled pages are 
+            dropped and it is fetched again from its max_id so that the pages from the other 
+            Fierys are not held up
+        """
+        log_error('Dropping spooled jobs from Fiery %s after the rejected jobs. They will be '
+                  'fetched again', ip)
+        with self.reject_lock:
+            for fiery_connection in list(self.fiery_connection_list):
+                if fiery_connection.fiery.ip == ip:
+                    self.refetch.add(fiery_connection)
+            self.spool.discard(ip)
+
+    def collect_metrics(self):
+        """Returns: Gauges of the Fierys' state for METRICS. Runs on the metrics server thread"""
+        gauges = [('fierys_connected', {}, len(self.fiery_connection_list)),
+                  ('fierys_reconnecting', {}, len(self.reconnector))]
+        if self.spool is not None:
+            gauges.append(('spool_pages', {}, len(self.spool)))
+        for fiery_connection, pages in self.pages.items():
+            fiery = fiery_connection.fiery
+            gauges.append(('fiery_pages_in_pipeline', {'fiery': fiery.ip}, pages))
+            gauges.append(('fiery_backlogged', {'fiery': fiery.ip}, 
+                           int(bool(fiery_connection.backlogged))))
+            if fiery.max_id is not None:
+                gauges.append(('fiery_max_id', {'fiery': fiery.ip}, fiery.max_id))
+        return gauges
+
+    def report(self, period_secs):
+        """Log throughput over the last period_secs and reset the counts"""
+        METRICS.set('jobs_recorded_per_second', self.stats['recorded'] / period_secs)
+        log_info('Last %.0f sec: %d polls, %d jobs fetched, %d jobs recorded (%.1f jobs/sec), '
+                 '%d jobs spooled. %d Fierys connected, %d reconnecting. %d pages in spool' % (
+                 period_secs, self.stats['polls'], self.stats['fetched'], self.stats['recorded'],
+                 self.stats['recorded'] / period_secs, self.stats['spooled'], 
+                 len(self.fiery_connection_list), len(self.reconnector), 
+                 len(self.spool) if self.spool is not None else 0))
+        self.stats = dict.fromkeys(self.stats, 0)
+
+        # Poll round trip times show how long each Fiery takes to answer, and the cycle time
+        # of the polling loop when Fierys are polled continuously
+        poll_secs, self.poll_secs = self.poll_secs, {}
+        if poll_secs:
+            fleet = percentiles([secs for ip_secs in poll_secs.values() for secs in ip_secs])
+            by_fiery = {ip: percentiles(ip_secs) for ip, ip_secs in poll_secs.items()}
+            slowest = heapq.nlargest(IngestionEngine.num_slowest, by_fiery.items(), 
+                                     key=lambda item: item[1][99])
+            log_info('Poll round trip: p50=%.3f sec, p99=%.3f sec. Slowest Fierys by p99: %s' % (
+                     fleet[50], fleet[99], 
+                     ', '.join('%s=%.3f sec' % (ip, pcts[99]) for ip, pcts in slowest)))
+            log_debug('Poll round trip by Fiery: %s', ', '.join(
+                      '%s: %d polls, p50=%.3f sec, p99=%.3f sec' % (ip, len(poll_secs[ip]), 
+                      by_fiery[ip][50], by_fiery[ip][99]) for ip in sorted(by_fiery)))
+
+        freshness = self.papercut.freshness
+        fleet = freshness.fleet() if freshness else None
+        if fleet:
+            log_info('Lag from printing to recording: p50=%.1f sec, p90=%.1f sec, p99=%.1f sec. '
+                     'Slowest Fierys by p99: %s' % (fleet[50], fleet[90], fleet[99], 
+                     ', '.join('%s=%.1f sec' % (ip, pcts[99]) 
+                               for ip, pcts in freshness.slowest(IngestionEngine.num_slowest))))
+
+
+#
+# Job conversion/manipulation code
+#
+def convert_boolean(fy_bool):
+    """Convert a Fiery boolean string to a PaperCut boolean string
+        Fiery is Yes/No
+        PaperCut is TRUE/FALSE
+    """
+    return 'TRUE' if fy_bool and fy_bool[0].lower() == 'y' else 'FALSE'
+
+    
+# Fiery date-times have minute resolution so a batch of jobs repeats a handful of values. 
+# Converted values are cached. The cache is emptied when it reaches TIME_CACHE_SIZE entries
+TIME_CACHE_SIZE = 10000
+_time_cache = {}
+
+# Fast path for Fiery date-times like "14:38 Oct 02, 2012"
+FIERY_TIME_RE = re.compile(r'(\d\d?):(\d\d) (\w+) (\d\d?), (\d{4})$')
+# Month abbreviations in the locale of the computer this script is running on, as used by %b
+MONTH_NUMBERS = {time.strftime('%b', (2000, m, 1, 0, 0, 0, 0, 1, 0)).lower(): m 
+                 for m in range(1, 13)}
+    
+def convert_time(fiery_time):
+    """Convert a Fiery date-time to a PaperCut date-time
+
+
+        fiery_time: Fiery date-time local time localized into Fiery's locale
+            We assume all the Fierys that PaperCut is connnected to have the 
+            same locale as the computer this script is running on
+        Returns: PaperCut date-time corresponding to fiery_time if fiery_time 
+            is parsed successfully or an obviously bogus date-time if
+            it is not.
+    """ 
+    try:
+        return _time_cache[fiery_time]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable fiery_time
+        return _convert_time(fiery_time)
+
+    pc_time = _convert_time(fiery_time)
+    if len(_time_cache) >= TIME_CACHE_SIZE:
+        _time_cache.clear()
+    _time_cache[fiery_time] = pc_time
+    return pc_time
+
+
+def _convert_time(fiery_time):
+    """Uncached convert_time()"""
+    try:
+        m = FIERY_TIME_RE.match(fiery_time)
+        month = MONTH_NUMBERS.get(m.group(3).lower()) if m else None
+        if month:
+            hour, minute, day, year = [int(m.group(i)) for i in (1, 2, 4, 5)]
+            dt = datetime.datetime(year, month, day, hour, minute)
+        else:
+            tm = time.strptime(fiery_time, '%H:%M %b %d, %Y')  
+            dt = datetime.datetime(*tm[:6])
+        return dt.isoformat().replace(':', '').replace('-', '')
+    except (ValueError, TypeError), e:
+        log_error('convert_time: Invalid fiery_time="%s": %s' % (fiery_time, e))
+        return '11111111T111111'
+
+
+def parse_fiery_timestamp(fiery_timestamp):
+    """Convert a Fiery "timestamp done printing" like "1349214299:308968" (seconds:microseconds
+        since the epoch) to a time.time() value
+        Returns: The time or None if fiery_timestamp is missing or invalid
+    """
+    try:
+        secs, _, usecs = fiery_timestamp.partition(':')
+        return int(secs) + int(usecs or 0) / 1e6
+    except (ValueError, AttributeError):
+        return None
+
+
+# TODO: Replace job[key] with job.get(key,None) to make FIERY_PAPERCUT_MAP
+#      resilient against missing Fiery keys
+
+FIERY_PAPERCUT_MAP = {
+    'printer': lambda job: job['fiery'],
+    'user': lambda job: first_non_empty([job.get('username', None), 
+                            job.get('authuser', None), 'blank on Fiery']),
+    'comment': lambda job: 'Fiery id: %s' % job['id'],
+    'time': lambda job: convert_time(job['date']),
+    'document-name': lambda job: job['title'],
+    'document-size-kb': lambda job: int(job['size'])//1024,
+    'paper-size-name': lambda job: job['media size'],
+    'copies': lambda job: int(job['copies printed']),
+    'total-pages': lambda job: (int(job['total blank pages printed'])
+                              + int(job['total bw pages printed'])
+                              + int(job['total color pages printed'])),
+    'total-color-pages': lambda job: int(job['total color pages printed']),
+    'duplex': lambda job: convert_boolean(job['duplex printed']),
+}
+
+# The Fiery job fields used by FIERY_PAPERCUT_MAP and for tracking recorded jobs. 
+# Other fields are dropped when jobs are fetched.
+FIERY_JOB_KEYS = [
+    'id',
+    'fiery',
+    'username',
+    'authuser',
+    'date',
+    'title',
+    'size',
+    'media size',
+    'copies printed',
+    'total blank pages printed',
+    'total bw pages printed',
+    'total color pages printed',
+    'duplex printed',
+    'timestamp done printing',
+]
+
+def convert_job(fiery_job):
+    """Convert a Fiery job to a PaperCut job
+        TODO: Check this conversion with Fiery team
+    """    
+    pc_job = {k:FIERY_PAPERCUT_MAP[k](fiery_job) for k in FIERY_PAPERCUT_MAP} 
+    pc_job['grayscale'] = 'TRUE' if pc_job['total-color-pages'] > 0 else 'FALSE'
+    return pc_job 
+
+
+class JobConverter:
+    """Converts batches of Fiery jobs to the job details strings passed to PaperCut processJob
+            server: PaperCut server name recorded with each job
+            account_name: PaperCut shared account recorded with each job
+
+        Gives the same jobs as convert_job() followed by formatting each job as key=value pairs,
+        but the format string is built once and each field is converted column by column over 
+        the whole batch.
+    """
+
+    # PaperCut fields in the order they are written to the job details string
+    FIELDS = [
+        'printer',
+        'user',
+        'comment',
+        'time',
+        'document-name',
+        'document-size-kb',
+        'paper-size-name',
+        'copies',
+        'total-pages',
+        'total-color-pages',
+        'duplex',
+        'grayscale',
+    ]
+
+    def __init__(self, server, account_name):
+        # The server and shared account are the same for every job so they are formatted once
+        # See http://www.papercut.com/products/ng/manual/ "Importing Print Job Details"    
+        constants = 'server=%s,shared-account=%s' % (server, account_name)
+        self.template = ','.join(['%s=%%s' % k for k in JobConverter.FIELDS] + [
+                                  constants.replace('%', '%%')])
+
+    def convert_batch(self, fiery_jobs):
+        """Convert a batch of Fiery jobs
+            fiery_jobs: List of Fiery jobs
+            Returns: list of (id, job details) in the order of fiery_jobs for the jobs that
+                printed pages. PaperCut doesn't log non-printing print jobs
+        """
+        with METRICS.timer('convert_seconds'):
+            id_details_list = self._convert_batch(fiery_jobs)
+        METRICS.inc('jobs_converted_total', len(fiery_jobs))
+        return id_details_list
+
+    def _convert_batch(self, fiery_jobs):
+        color = [int(job['total color pages printed']) for job in fiery_jobs]
+        total = [int(job['total blank pages printed']) + int(job['total bw pages printed']) + c
+                 for job, c in zip(fiery_jobs, color)]
+        keep = [i for i, t in enumerate(total) if t > 0]
+        if len(keep) < len(fiery_jobs):
+            fiery_jobs = [fiery_jobs[i] for i in keep]
+            color = [color[i] for i in keep]
+            total = [total[i] for i in keep]
+
+        ids = [job['id'] for job in fiery_jobs]
+        columns = [
+            [job['fiery'] for job in fiery_jobs],
+            [job.get('username') or job.get('authuser') or 'blank on Fiery' for job in fiery_jobs],
+            ['Fiery id: %s' % i for i in ids],
+            [convert_time(job['date']) for job in fiery_jobs],
+            [job['title'] for job in fiery_jobs],
+            [int(job['size']) // 1024 for job in fiery_jobs],
+            [job['media size'] for job in fiery_jobs],
+            [int(job['copies printed']) for job in fiery_jobs],
+            total,
+            color,
+            [convert_boolean(job['duplex printed']) for job in fiery_jobs],
+            ['TRUE' if c > 0 else 'FALSE' for c in color],
+        ]
+        template = self.template
+        return zip(ids, [template % row for row in zip(*columns)])
+
+
+#
+# Local recording state
+#
+def id_ranges(job_ids):
+    """Returns: Sorted job_ids as a list of [first id, last id] ranges of consecutive ids"""
+    ranges = []
+    for job_id in sorted(job_ids):
+        if ranges and job_id <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], job_id)
+        else:
+            ranges.append([job_id, job_id])
+    return ranges
+
+
+class IdRanges:
+    """Set of job ids stored as sorted, disjoint [first id, last id] ranges
+        Fiery job ids are recorded in order so the ids recorded from a Fiery take a few ranges
+        however many of them there are.
+    """
+
+    def __init__(self, ranges=()):
+        self.firsts = []
+        self.lasts = []
+        for first, last in ranges:
+            self.add_range(first, last)
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def __contains__(self, job_id):
+        i = bisect.bisect_right(self.firsts, job_id) - 1
+        return i >= 0 and job_id <= self.lasts[i]
+
+    def add_range(self, first, last):
+        """Add the ids first <= id <= last"""
+        # Ranges i:j overlap or touch [first, last] and are merged with it
+        i = bisect.bisect_left(self.lasts, first - 1)
+        j = bisect.bisect_right(self.firsts, last + 1)
+        if i < j:
+            first = min(first, self.firsts[i])
+            last = max(last, self.lasts[j - 1])
+        self.firsts[i:j] = [first]
+        self.lasts[i:j] = [last]
+
+    def discard_to(self, max_id):
+        """Remove the ids <= max_id"""
+        i = bisect.bisect_right(self.lasts, max_id)
+        del self.firsts[:i]
+        del self.lasts[:i]
+        if self.firsts and self.firsts[0] <= max_id:
+            self.firsts[0] = max_id + 1
+
+    def ranges(self):
+        return [[first, last] for first, last in zip(self.firsts, self.lasts)]
+
+
+class FieryJournal:
+    """Local append-only journal of Fiery recording state
+            path: Path of journal file
+            max_lines: The journal is compacted when it grows past this many lines
+
+        Each line is a JSON list, one of
+            ["state", ip, max_id, pending_max_id]: Fiery state as saved by PaperCut.note_fiery()
+            ["commit", ip, id]: Pending jobs from Fiery ip with ids <= id have been recorded
+            ["recorded", ip, [[first id, last id], ...]]: Jobs from Fiery ip with these ids have
+                been recorded
+            ["sending", ip, first id, last id]: A batch of jobs from Fiery ip with ids in this 
+                range is being sent to PaperCut. The next line for ip ends it
+            ["uncertain", ip, first id, last id]: Jobs from Fiery ip with ids in this range may 
+                or may not have been recorded. The Fiery is held, inconsistent, until its state 
+                is fixed with the resolve command
+        The "recorded" lines are an index of the jobs that PaperCut has acknowledged above each
+        Fiery's max_id. Jobs in it are skipped when a page is recorded again, so pages can be
+        retried after a crash or a failure without recording any of their jobs twice. A batch 
+        that was still being sent when this script stopped may or may not have been recorded so
+        it is replayed as uncertain.
+        Every line is flushed and fsynced before recording continues so the journal survives a 
+        crash. The journal is replayed when it is opened.
+    """
+
+    def __init__(self, path, max_lines=100000):
+        self.path = path
+        self.max_lines = max_lines
+        self.lock = threading.Lock()
+        # {ip: [max_id, pending_max_id, highest committed id, [first, last] uncertain ids]}
+        self.states = {}
+        # {ip: IdRanges of ids > max_id that have been recorded}
+        self.recorded = {}
+        # {ip: [first, last] ids of the batch being sent to PaperCut}
+        self.in_flight = {}
+        self.num_lines = 0
+        self.replay()
+        self.compact()
+
+    def replay(self):
+        """Read the journal into self.states"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Only the last line can be torn by a crash
+                    log_error('FieryJournal: Ignoring invalid line %d of "%s"' % (i + 1, self.path))
+                    continue
+                if entry[0] != 'sending':
+                    self.in_flight.pop(entry[1], None)
+                if entry[0] == 'state':
+                    _, ip, max_id, pending_max_id = entry
+                    self._set_state(ip, max_id, pending_max_id)
+                    self._discard_recorded(ip, max_id)
+                elif entry[0] == 'commit' and entry[1] in self.states:
+                    self.states[entry[1]][2] = entry[2]
+                elif entry[0] == 'uncertain' and entry[1] in self.states:
+                    self.states[entry[1]][3] = entry[2:]
+                elif entry[0] == 'recorded':
+                    self._add_recorded(entry[1], entry[2])
+                elif entry[0] == 'sending':
+                    self.in_flight[entry[1]] = entry[2:]
+        # The batches that were being sent when this script stopped may have been recorded
+        for ip, (first_id, last_id) in sorted(self.in_flight.items()):
+            if ip in self.states and self.states[ip][1] is not None:
+                log_error('FieryJournal: Jobs from Fiery %s with ids %d to %d were being sent to '
+                          'PaperCut when this script stopped', ip, first_id, last_id)
+                self.states[ip][3] = [first_id, last_id]
+        self.in_flight = {}
+
+    def restore(self, fiery, log=True):
+        """Update fiery with the state recorded in the journal
+            If this script stopped while recording jobs then max_id is set to the last committed
+            job id so that the rest of the pending jobs are recorded again. If some of the jobs
+            may or may not have been recorded then fiery is left inconsistent with these jobs 
+            pending.
+            log: Log the recovery of an interrupted recording
+            Returns: [first id, last id] of the jobs that may or may not have been recorded or 
+                None
+        """
+        with self.lock:
+            if fiery.ip not in self.states:
+                return None
+            max_id, pending_max_id, committed_id, uncertain = self.states[fiery.ip]
+        if pending_max_id is not None and (max_id is None or pending_max_id > max_id):
+            if committed_id is not None and (max_id is None or committed_id > max_id):
+                max_id = committed_id
+            if uncertain:
+                fiery.max_id, fiery.pending_max_id = max_id, uncertain[1]
+                if log:
+                    log_error('FieryJournal: Jobs from Fiery %s with ids %d to %d may have been '
+                              'recorded on PaperCut. Check the PaperCut Job Log for them and '
+                              'run this script with "resolve %s=<highest id recorded>", or %s '
+                              'if none were' % (fiery.ip, uncertain[0], uncertain[1], fiery.ip,
+                              max_id))
+                return uncertain
+            if log:
+                log_info('FieryJournal: Recovered Fiery %s recording. Jobs %s < id <= %s will be '
+                         'recorded again, skipping the ones that were recorded.' % (fiery.ip, 
+                         max_id, pending_max_id))
+        fiery.max_id = max_id
+        fiery.pending_max_id = None
+        return None
+
+    def _set_state(self, ip, max_id, pending_max_id):
+        # Uncertain jobs stay uncertain until the Fiery has no pending jobs
+        uncertain = self.states[ip][3] if ip in self.states and pending_max_id is not None else None
+        self.states[ip] = [max_id, pending_max_id, None, uncertain]
+
+    def _append(self, *entries):
+        with open(self.path, 'ab') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_lines += len(entries)
+        if self.num_lines > self.max_lines:
+            self._compact()
+
+    def save(self, fiery):
+        """Record fiery's state"""
+        with self.lock:
+            self.in_flight.pop(fiery.ip, None)
+            self._set_state(fiery.ip, fiery.max_id, fiery.pending_max_id)
+            self._discard_recorded(fiery.ip, fiery.max_id)
+            self._append(['state', fiery.ip, fiery.max_id, fiery.pending_max_id])
+
+    def hold(self, fiery, first_id, last_id):
+        """Record fiery's state and that its jobs with ids first_id to last_id may or may not have
+            been recorded
+        """
+        with self.lock:
+            self.in_flight.pop(fiery.ip, None)
+            self.states[fiery.ip] = [fiery.max_id, fiery.pending_max_id, None, [first_id, last_id]]
+            self._discard_recorded(fiery.ip, fiery.max_id)
+            self._append(['state', fiery.ip, fiery.max_id, fiery.pending_max_id],
+                         ['uncertain', fiery.ip, first_id, last_id])
+
+    def commit(self, ip, job_id):
+        """Record that pending jobs from Fiery ip with ids <= job_id have been recorded"""
+        with self.lock:
+            self.in_flight.pop(ip, None)
+            if ip in self.states:
+                self.states[ip][2] = job_id
+            self._append(['commit', ip, job_id])
+
+    def sending(self, ip, first_id, last_id):
+        """Record that a batch of jobs from Fiery ip with ids first_id to last_id is being sent 
+            to PaperCut. The batch ends with the next record() or state saved for ip
+        """
+        with self.lock:
+            self.in_flight[ip] = [first_id, last_id]
+            self._append(['sending', ip, first_id, last_id])
+
+    def record(self, ip, job_ids, commit_id=None, sending=None):
+        """Add job_ids from Fiery ip, the jobs PaperCut recorded from the batch being sent, to 
+            the index of recorded jobs
+            commit_id: If not None, also commit() the pending jobs with ids <= commit_id
+            sending: (first id, last id) of the next batch to be sent or None. Recording it with 
+                the previous batch's jobs saves a journal write per batch. See sending()
+        """
+        ranges = id_ranges(job_ids)
+        # This line is written even if there are no ranges as it ends the batch being sent
+        entries = [['recorded', ip, ranges]]
+        if commit_id is not None:
+            entries.append(['commit', ip, commit_id])
+        if sending:
+            entries.append(['sending', ip] + list(sending))
+        with self.lock:
+            self._add_recorded(ip, ranges)
+            if commit_id is not None and ip in self.states:
+                self.states[ip][2] = commit_id
+            if sending:
+                self.in_flight[ip] = list(sending)
+            else:
+                self.in_flight.pop(ip, None)
+            self._append(*entries)
+
+    def is_recorded(self, ip, job_id):
+        """Returns: True if job job_id from Fiery ip is in the index of recorded jobs"""
+        with self.lock:
+            return ip in self.recorded and job_id in self.recorded[ip]
+
+    def _add_recorded(self, ip, ranges):
+        if not ranges:
+            return
+        if ip not in self.recorded:
+            self.recorded[ip] = IdRanges()
+        for first, last in ranges:
+            self.recorded[ip].add_range(first, last)
+
+    def _discard_recorded(self, ip, max_id):
+        """Jobs with ids <= max_id are never recorded again so they are dropped from the index"""
+        if ip not in self.recorded or max_id is None:
+            return
+        self.recorded[ip].discard_to(max_id)
+        if not self.recorded[ip]:
+            del self.recorded[ip]
+
+    def absorb(self, path):
+        """Take over the Fiery states in the journal at path then delete it
+            The journal at path must be more recent than this one, as the journals of worker 
+            processes are for the Fierys they record.
+        """
+        other = FieryJournal(path)
+        for ip in sorted(other.states):
+            fiery = FieryState(ip=ip)
+            uncertain = other.restore(fiery, log=False)
+            if uncertain:
+                self.hold(fiery, *uncertain)
+            else:
+                self.save(fiery)
+        for ip in sorted(other.recorded):
+            ranges = other.recorded[ip].ranges()
+            with self.lock:
+                self._add_recorded(ip, ranges)
+                self._append(['recorded', ip, ranges])
+        os.remove(path)
+        log_info('FieryJournal: Merged %d Fiery states from "%s"' % (len(other.states), path))
+
+    def compact(self):
+        """Rewrite the journal with one line per Fiery"""
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = '%s.tmp' % self.path
+        num_lines = 0
+        with open(tmp_path, 'wb') as f:
+            for ip, (max_id, pending_max_id, committed_id, uncertain) in sorted(
+                    self.states.items()):
+                f.write(json.dumps(['state', ip, max_id, pending_max_id]) + '\n')
+                num_lines += 1
+                if committed_id is not None:
+                    f.write(json.dumps(['commit', ip, committed_id]) + '\n')
+                    num_lines += 1
+                if uncertain:
+                    f.write(json.dumps(['uncertain', ip] + uncertain) + '\n')
+                    num_lines += 1
+            for ip, recorded in sorted(self.recorded.items()):
+                f.write(json.dumps(['recorded', ip, recorded.ranges()]) + '\n')
+            for ip, in_flight in sorted(self.in_flight.items()):
+                f.write(json.dumps(['sending', ip] + in_flight) + '\n')
+            num_lines += len(self.recorded) + len(self.in_flight)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path) and os.name == 'nt':
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+        self.num_lines = num_lines
+
+
+class FieryConfigSyncer:
+    """Saves Fiery states to the PaperCut config on a background thread
+            papercut: PaperCut to save to
+            sync_secs: Time between syncs
+    """
+
+    def __init__(self, papercut, sync_secs):
+        self.papercut = papercut
+        self.sync_secs = sync_secs
+        self.lock = threading.Lock()
+        # {ip: FieryState} of Fierys whose state has changed since the last sync
+        self.changed = {}
+        thread = threading.Thread(target=self._run, name='config-syncer')
+        thread.daemon = True
+        thread.start()
+
+    def mark(self, fiery):
+        """Note that fiery's state needs to be saved in the PaperCut config"""
+        with self.lock:
+            self.changed[fiery.ip] = fiery
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_secs)
+            self.sync()
+
+    def sync(self):
+        """Save all changed Fiery states in the PaperCut config"""
+        with self.lock:
+            changed, self.changed = self.changed, {}
+        if not changed:
+            return
+        try:
+            self.papercut.save_fierys(changed.values())
+        except (socket.error, xmlrpclib.Error), e:
+            log_error('Could not save %d Fiery states in PaperCut config: %s' % (len(changed), e))
+            for fiery in changed.values():
+                self.mark(fiery)
+
+
+class JobSpool:
+    """Local append-only spool of pages of converted jobs that could not be recorded on PaperCut
+            path: Directory of the spool's segment files
+            segment_bytes: A new segment file is started when the current one grows past this
+
+        Each page is a line 
+        "<crc32 of JSON in hex> <JSON [ip, job ids, id_details_list, print times]>" in a segment
+        file. job ids are the ids of all the Fiery jobs in the page, including the non-printing
+        jobs that aren't in id_details_list. print times are the jobs' "timestamp done printing"
+        so that the freshness of jobs recorded from the spool is tracked. Pages spooled by 
+        earlier versions have no print times. Each line is flushed and fsynced 
+        before the page counts as spooled. Lines with bad checksums, such as a line torn by a 
+        crash, are logged and skipped.
+        A line with JSON [ip, null, null] is a discard marker. It removes the pages from ip 
+        before it. See discard(). The marker stays in the spool until the pages before it have
+        been taken, so that the removed pages are not replayed.
+        Pages are taken from the spool in the order they were added. Only the position of each 
+        page is kept in memory. A segment file is deleted once all its pages have been taken.
+        Pages may contain jobs that were recorded after they were spooled. Use trim_jobs() to 
+        remove them.
+    """
+
+    def __init__(self, path, segment_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        # (segment, offset, ip) of each page in the order they were added. ip is None for discard
+        # markers
+        self.pages = collections.deque()
+        # Number of discard markers in pages
+        self.num_markers = 0
+        # {ip: number of pages in the spool}
+        self.counts = {}
+        # {ip: highest job id spooled}
+        self.max_ids = {}
+        # {segment: number of pages in it that are still in the spool}
+        self.segment_pages = {}
+        # True while PaperCut can't be reached. All pages are spooled until it can
+        self.offline = False
+        self.segment = None
+        self.file = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+        segments = sorted(int(name[:-4]) for name in os.listdir(path) 
+                          if re.match(r'^\d+\.seg$', name))
+        for segment in segments:
+            self._replay(segment)
+        self.segment = segments[-1] + 1 if segments else 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%08d.seg' % segment)
+
+    @staticmethod
+    def _decode(line):
+        """Returns: [ip, job ids, id_details_list, ...] in spool line or None if it is invalid"""
+        if not line.endswith('\n'):
+            return None
+        crc, _, payload = line[:-1].partition(' ')
+        if crc != '%08x' % (zlib.crc32(payload) & 0xffffffff):
+            return None
+        return json.loads(payload)
+
+    def _replay(self, segment):
+        """Add the pages in segment to the spool"""
+        num_pages = 0
+        with open(self._segment_path(segment), 'rb') as f:
+            offset = 0
+            for line in f:
+                page = JobSpool._decode(line)
+                if page is None:
+                    log_error('JobSpool: Skipping invalid page at offset %d of "%s"' % (offset,
+                              self._segment_path(segment)))
+                elif page[1] is None:
+                    self._add_marker(segment, offset, page[0])
+                    num_pages += 1
+                else:
+                    ip, job_ids = page[:2]
+                    self._add(segment, offset, ip, job_ids)
+                    num_pages += 1
+                offset += len(line)
+        if num_pages:
+            log_info('JobSpool: %d pages in "%s"' % (num_pages, self._segment_path(segment)))
+        else:
+            os.remove(self._segment_path(segment))
+
+    def _add(self, segment, offset, ip, job_ids):
+        self.pages.append((segment, offset, ip))
+        self.counts[ip] = self.counts.get(ip, 0) + 1
+        self.max_ids[ip] = max(self.max_ids.get(ip), max(job_ids))
+        self.segment_pages[segment] = self.segment_pages.get(segment, 0) + 1
+
+    def _add_marker(self, segment, offset, ip):
+        """Add a discard marker for ip and remove the pages from ip before it"""
+        self.pages.append((segment, offset, None))
+        self.num_markers += 1
+        self.segment_pages[segment] = self.segment_pages.get(segment, 0) + 1
+        if not self.counts.get(ip):
+            return
+        pages = collections.deque()
+        for page in self.pages:
+            if page[2] == ip:
+                self._release(page[0])
+            else:
+                pages.append(page)
+        self.pages = pages
+        self.counts[ip] = 0
+        del self.max_ids[ip]
+
+    def __len__(self):
+        """Returns: Number of pages in the spool"""
+        return len(self.pages) - self.num_markers
+
+    def append(self, ip, fiery_job_list, id_details_list):
+        """Add a page of jobs from Fiery ip to the spool"""
+        with self.lock:
+            self._append(ip, fiery_job_list, id_details_list)
+
+    def _append(self, ip, fiery_job_list, id_details_list):
+        job_ids = [job['id'] for job in fiery_job_list]
+        print_times = [job.get('timestamp done printing') for job in fiery_job_list]
+        segment, offset = self._write([ip, job_ids, id_details_list, print_times])
+        self._add(segment, offset, ip, job_ids)
+
+    def _write(self, entry):
+        """Write entry as a line in the current segment
+            Returns: (segment, offset) of the line
+        """
+        payload = json.dumps(entry, separators=(',', ':'))
+        line = '%08x %s\n' % (zlib.crc32(payload) & 0xffffffff, payload)
+        if self.file and self.file.tell() > self.segment_bytes:
+            self.file.close()
+            self.file = None
+            self.segment += 1
+        if not self.file:
+            self.file = open(self._segment_path(self.segment), 'ab')
+        offset = self.file.tell()
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.segment, offset
+
+    def discard(self, ip):
+        """Remove all the pages from Fiery ip from the spool"""
+        with self.lock:
+            if not self.counts.get(ip):
+                return
+            segment, offset = self._write([ip, None, None])
+            self._add_marker(segment, offset, ip)
+
+    def append_if_spooling(self, ip, fiery_job_list, id_details_list):
+        """Add a page of jobs from Fiery ip to the spool if PaperCut is offline or the spool 
+            has earlier pages from ip. Jobs from a Fiery must be recorded in order
+            Returns: True if the page was spooled
+        """
+        with self.lock:
+            if not self.offline and not self.counts.get(ip):
+                return False
+            self._append(ip, fiery_job_list, id_details_list)
+            return True
+
+    def next_id(self, ip):
+        """Returns: id to fetch the next jobs from Fiery ip from or None if the spool has no 
+            pages from it
+        """
+        with self.lock:
+            return self.max_ids[ip] + 1 if self.counts.get(ip) else None
+
+    def peek(self):
+        """Returns: (ip, Fiery job list, id_details_list) of the oldest page or None if the 
+            spool is empty. The Fiery jobs have only ids and print times.
+        """
+        with self.lock:
+            while self.pages:
+                segment, offset, ip = self.pages[0]
+                if ip is None:
+                    # A discard marker. The pages it removed have been taken
+                    self._pop()
+                    continue
+                if self.file and segment == self.segment:
+                    self.file.flush()
+                with open(self._segment_path(segment), 'rb') as f:
+                    f.seek(offset)
+                    page = JobSpool._decode(f.readline())
+                if page is not None:
+                    job_ids, id_details_list = page[1:3]
+                    print_times = page[3] if len(page) > 3 else [None] * len(job_ids)
+                    fiery_job_list = [{'id': job_id, 'timestamp done printing': print_time}
+                                      for job_id, print_time in zip(job_ids, print_times)]
+                    return ip, fiery_job_list, id_details_list
+                log_error('JobSpool: Page at offset %d of "%s" from Fiery %s has been corrupted. '
+                          'Its jobs will not be recorded' % (offset, self._segment_path(segment),
+                          ip))
+                self._pop()
+            return None
+
+    def pop(self):
+        """Remove the oldest page from the spool"""
+        with self.lock:
+            self._pop()
+
+    def _pop(self):
+        segment, _, ip = self.pages.popleft()
+        if ip is None:
+            self.num_markers -= 1
+        else:
+            self.counts[ip] -= 1
+        self._release(segment)
+
+    def _release(self, segment):
+        """Delete segment once none of its pages are in the spool"""
+        self.segment_pages[segment] -= 1
+        if self.segment_pages[segment] == 0:
+            del self.segment_pages[segment]
+            if segment == self.segment and self.file:
+                self.file.close()
+                self.file = None
+                self.segment += 1
+            os.remove(self._segment_path(segment))
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+def trim_jobs(max_id, fiery_job_list, id_details_list):
+    """Returns: (fiery_job_list, id_details_list) without the jobs with ids <= max_id"""
+    if max_id is None:
+        return fiery_job_list, id_details_list
+    return ([job for job in fiery_job_list if job['id'] > max_id],
+            [(job_id, details) for job_id, details in id_details_list if job_id > max_id])
+
+
+def drain_spool(papercut, spool, fiery_list):
+    """Record all the pages in spool on papercut
+            fiery_list: States of the Fierys whose jobs may be in spool
+        Pages from Fierys that aren't in fiery_list are dropped. So are the pages after any jobs
+        that PaperCut rejects, as those Fierys are fetched again from their max_id.
+    """
+    fiery_of = {fiery.ip: fiery for fiery in fiery_list}
+    rejected_ips = set()
+    if spool:
+        log_info('Recording %d pages of jobs from spool "%s"' % (len(spool), spool.path))
+    while True:
+        page = spool.peek()
+        if page is None:
+            break
+        ip, fiery_job_list, id_details_list = page
+        fiery = fiery_of.get(ip)
+        if fiery is None:
+            log_error('Dropping spooled jobs from Fiery %s, which is no longer tracked' % ip)
+        elif ip not in rejected_ips:
+            fiery_job_list, id_details_list = trim_jobs(fiery.max_id, fiery_job_list, 
+                                                        id_details_list)
+            if fiery_job_list and not papercut.record_jobs(fiery, fiery_job_list, 
+                                                           id_details_list):
+                log_error('Dropping spooled jobs from Fiery %s after the rejected jobs. They will '
+                          'be fetched again' % ip)
+                rejected_ips.add(ip)
+        spool.pop()
+
+
+class ClaimRenewer:
+    """Renews a PaperCut's claim on the PaperCut server on a background thread
+            papercut: PaperCut whose claim is renewed
+            renew_secs: Time between renewals
+    """
+
+    def __init__(self, papercut, renew_secs):
+        self.papercut = papercut
+        self.renew_secs = renew_secs
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='claim-renewer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop renewing the claim, waiting for any renewal in progress to finish"""
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.renew_secs):
+            try:
+                if not self.papercut.renew_claim():
+                    log_error('Lost claim on PaperCut server "%s"' % self.papercut.host_name)
+                    return
+            except (socket.error, xmlrpclib.Error), e:
+                log_error('Could not renew claim on PaperCut server: %s' % e)
+
+
+# Errors from PaperCut requests that mean PaperCut can't be reached, as opposed to the 
+# xmlrpclib.Faults that PaperCut returns for requests it rejects
+PAPERCUT_ERRORS = (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError)
+
+
+class PaperCutUnavailable(Exception):
+    """PaperCut could not be reached while recording jobs
+            error: The PAPERCUT_ERRORS error
+            first_id: id of the first job that may not have been recorded
+            fiery_job_list, id_details_list: The jobs with ids >= first_id
+    """
+
+    def __init__(self, error, first_id, fiery_job_list=None, id_details_list=None):
+        Exception.__init__(self, 'PaperCut could not be reached: %s' % error)
+        self.error = error
+        self.first_id = first_id
+        self.fiery_job_list = fiery_job_list
+        self.id_details_list = id_details_list
+
+
+class PaperCutUncertain(Exception):
+    """PaperCut could not be reached after a request to record jobs was sent, so the jobs in 
+        the request may or may not have been recorded
+            error: The PAPERCUT_ERRORS error
+            first_id, last_id: ids of the first and last jobs in the request
+    """
+
+    def __init__(self, error, first_id, last_id):
+        Exception.__init__(self, 'PaperCut could not be reached: %s' % error)
+        self.error = error
+        self.first_id = first_id
+        self.last_id = last_id
+
+
+class PaperCutTransport(xmlrpclib.Transport):
+    """xmlrpclib.Transport with a socket timeout that never sends a request twice
+            timeout: Socket timeout in seconds for PaperCut requests
+            request_sent: True once any of the last request has been sent
+
+        As in the Python 2.7 xmlrpclib.Transport that it inherits from, one HTTP/1.1 connection 
+        is kept open between calls, closed after any error and re-opened on the next call. 
+        Unlike xmlrpclib.Transport, a request that fails is not sent again as processJob is not 
+        idempotent. Instead connections that have been idle for max_idle_secs, which PaperCut 
+        may have closed, are re-opened before use. Connections are opened before anything is 
+        sent so that request_sent tells a request that never reached PaperCut from one that 
+        PaperCut may have carried out.
+    """
+
+    max_idle_secs = 10.0
+
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+        self.request_sent = False
+        self.last_used = 0.0
+
+    def request(self, host, handler, request_body, verbose=0):
+        self.request_sent = False
+        try:
+            return self.single_request(host, handler, request_body, verbose)
+        finally:
+            self.last_used = time.time()
+
+    def make_connection(self, host):
+        if self._connection[1] and (host != self._connection[0] or 
+                                    time.time() - self.last_used > PaperCutTransport.max_idle_secs
+                                    or self._dropped()):
+            self.close()
+        if not self._connection[1]:
+            chost, self._extra_headers, x509 = self.get_host_info(host)
+            self._connection = host, httplib.HTTPConnection(chost, timeout=self.timeout)
+        connection = self._connection[1]
+        if connection.sock is None:
+            connection.connect()
+        return connection
+
+    def _dropped(self):
+        """Returns: True if PaperCut has closed the open connection
+            An idle connection only becomes readable when PaperCut closes it
+        """
+        sock = self._connection[1].sock
+        if sock is None:
+            return False
+        try:
+            return bool(select.select([sock], [], [], 0.0)[0])
+        except (select.error, socket.error):
+            return True
+
+    def send_content(self, connection, request_body):
+        self.request_sent = True
+        xmlrpclib.Transport.send_content(self, connection, request_body)
+
+
+class PooledMethod:
+    """An XML-RPC method called on a connection checked out from a PaperCutServerPool"""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return PooledMethod(self.pool, '%s.%s' % (self.name, name))
+
+    def __call__(self, *args):
+        return self.pool.call(self.name, *args)
+
+
+class PaperCutServerPool:
+    """Thread-safe replacement for xmlrpclib.ServerProxy that shares a small pool of keep-alive
+        PaperCut connections between threads.
+            url: PaperCut XML-RPC URL
+            size: Maximum number of connections. Callers wait when all connections are in use
+            timeout: Socket timeout in seconds for PaperCut requests
+
+        Methods are called as on a ServerProxy, e.g. pool.api.getConfigValue(auth_token, key)
+    """
+
+    def __init__(self, url, size=4, timeout=60.0):
+        self.url = url
+        self.size = max(1, size)
+        # Most recently used connection first so that idle connections are the ones that expire
+        self.proxies = Queue.LifoQueue()
+        for _ in range(self.size):
+            transport = PaperCutTransport(timeout)
+            self.proxies.put((xmlrpclib.ServerProxy(url, transport=transport), transport))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return PooledMethod(self, name)
+
+    def __repr__(self):
+        return 'PaperCutServerPool(%s, size=%d)' % (self.url, self.size)
+
+    def call(self, name, *args):
+        """Call XML-RPC method name on a pooled connection
+            PAPERCUT_ERRORS raised by the call have request_sent set to False if the request 
+            never reached PaperCut
+        """
+        proxy, transport = self.proxies.get()
+        try:
+            return getattr(proxy, name)(*args)
+        except PAPERCUT_ERRORS, e:
+            e.request_sent = transport.request_sent
+            raise
+        finally:
+            self.proxies.put((proxy, transport))
+
+    def close(self):
+        """Close the pooled connections. They are re-opened by the next call"""
+        for _ in range(self.size):
+            proxy, transport = self.proxies.get()
+            transport.close()
+            self.proxies.put((proxy, transport))
+
+
+class FieryStateStore:
+    """Write-through cache of the Fiery states in a PaperCut server's config
+            papercut: PaperCut whose config holds the states
+
+        The states are stored as JSON in a few config values rather than one value per Fiery
+            Fiery.state = {"generation": <g>, "chunks": <n>}
+            Fiery.state.<g>.<i> = {"<ip>": {"username": ..., "password": ..., "max_id": ...}, ...}
+                for i = 0 ... n-1
+        They are read once and then served from memory. Saving Fiery states rewrites only the 
+        chunks whose JSON has changed.
+        Each Fiery keeps its chunk until the Fiery list is saved with save_list(). This writes a 
+        new generation of chunks and then switches to it with one write of Fiery.state so that
+        a crash can't leave a mix of old and new chunks.
+        States saved by older versions of this script, in Fiery.list and one Fiery:<ip> value per 
+        Fiery, are read when there is no Fiery.state and are moved to the new encoding by the 
+        next save.
+    """
+
+    # Maximum number of Fierys in each chunk
+    chunk_size = 50
+    # The number of chunks is a multiple of this so that the Fierys in chunk i are those in 
+    # shard i % num_groups of a ShardSupervisor with num_groups workers. Each worker then writes 
+    # only its own chunks
+    num_groups = 1
+
+    def __init__(self, papercut):
+        self.papercut = papercut
+        self.lock = threading.Lock()
+        self.loaded = False
+        # Generation of the chunks or None for states read from the old encoding
+        self.generation = None
+        # [{ip: state dict}] and the JSON last read from or written to each chunk
+        self.chunks = []
+        self.chunk_strs = []
+        # {ip: index of the chunk that holds its state}
+        self.chunk_of = {}
+
+    def _get(self, key):
+        return self.papercut.server.api.getConfigValue(self.papercut.auth_token, key)
+
+    def _set(self, key, value):
+        with METRICS.timer('papercut_set_config_seconds'):
+            self.papercut.server.api.setConfigValue(self.papercut.auth_token, key, value)
+
+    @staticmethod
+    def chunk_key(generation, i):
+        return '%s.%d.%d' % (PaperCut.FIERY_STATE, generation, i)
+
+    @staticmethod
+    def encode(chunk):
+        return json.dumps(chunk, sort_keys=True, separators=(',', ':'))
+
+    def _load(self):
+        if self.loaded:
+            return
+        header_str = self._get(PaperCut.FIERY_STATE)
+        if header_str:
+            header = json.loads(header_str)
+            self.generation = header['generation']
+            self.chunk_strs = [self._get(FieryStateStore.chunk_key(self.generation, i)) 
+                               for i in range(header['chunks'])]
+            self.chunks = [json.loads(s) if s else {} for s in self.chunk_strs]
+        else:
+            self.generation = None
+            self.chunk_strs = [None]
+            self.chunks = [self._load_legacy()]
+        self.chunk_of = {}
+        for i, chunk in enumerate(self.chunks):
+            for ip in chunk:
+                self.chunk_of.setdefault(ip, i)
+        self.loaded = True
+
+    def _load_legacy(self):
+        """Returns: {ip: state dict} of the states saved by older versions of this script"""
+        fiery_str = self._get(PaperCut.FIERY_LIST)
+        fiery_ip_list = ast.literal_eval(fiery_str) if fiery_str else []
+        chunk = {}
+        for fiery_ip in fiery_ip_list:
+            fiery_str = self._get(PaperCut.config_key(fiery_ip))
+            chunk[fiery_ip] = ast.literal_eval(fiery_str) if fiery_str else {}
+        if chunk:
+            log_info('Read %d Fiery states in the old PaperCut config format. They will be saved '
+                     'in "%s"' % (len(chunk), PaperCut.FIERY_STATE))
+        return chunk
+
+    def ips(self):
+        """Returns: sorted list of the ips of the Fierys whose states are stored"""
+        with self.lock:
+            self._load()
+            return sorted(self.chunk_of)
+
+    def get(self, fiery_ip):
+        """Returns: dict of the stored state of Fiery fiery_ip without the ip. {} if there is none"""
+        with self.lock:
+            self._load()
+            if fiery_ip not in self.chunk_of:
+                return {}
+            return dict(self.chunks[self.chunk_of[fiery_ip]][fiery_ip])
+
+    def save(self, fiery_list):
+        """Save the states of the Fierys in fiery_list, writing only the chunks that changed"""
+        with self.lock:
+            self._load()
+            if self.generation is None or any(f.ip not in self.chunk_of for f in fiery_list):
+                # Fierys that have no chunk yet need a new generation
+                states = {ip: self.chunks[i][ip] for ip, i in self.chunk_of.items()}
+                states.update((f.ip, f.dict_no_ip()) for f in fiery_list)
+                self._save_all(states)
+                return
+            changed = set()
+            for fiery in fiery_list:
+                i = self.chunk_of[fiery.ip]
+                self.chunks[i][fiery.ip] = fiery.dict_no_ip()
+                changed.add(i)
+            for i in sorted(changed):
+                chunk_str = FieryStateStore.encode(self.chunks[i])
+                if chunk_str != self.chunk_strs[i]:
+                    self._set(FieryStateStore.chunk_key(self.generation, i), chunk_str)
+                    self.chunk_strs[i] = chunk_str
+
+    def save_list(self, fiery_list):
+        """Replace all the stored states with those of the Fierys in fiery_list"""
+        with self.lock:
+            self._load()
+            self._save_all({fiery.ip: fiery.dict_no_ip() for fiery in fiery_list})
+
+    def _save_all(self, states):
+        fiery_ip_list = sorted(states)
+        num_groups = max(1, FieryStateStore.num_groups)
+        num_chunks = -(-len(fiery_ip_list) // FieryStateStore.chunk_size)
+        num_chunks = max(1, -(-num_chunks // num_groups)) * num_groups
+        chunk_of = {fiery_ip: j % num_chunks for j, fiery_ip in enumerate(fiery_ip_list)}
+        chunks = [{} for _ in range(num_chunks)]
+        for fiery_ip, i in chunk_of.items():
+            chunks[i][fiery_ip] = states[fiery_ip]
+        chunk_strs = [FieryStateStore.encode(chunk) for chunk in chunks]
+
+        if self.generation is not None and chunk_of == self.chunk_of:
+            # Same Fierys in the same chunks so the current generation can be updated in place
+            for i, chunk_str in enumerate(chunk_strs):
+                if chunk_str != self.chunk_strs[i]:
+                    self._set(FieryStateStore.chunk_key(self.generation, i), chunk_str)
+            self.chunks = chunks
+            self.chunk_strs = chunk_strs
+            return
+
+        old_generation, old_num_chunks = self.generation, len(self.chunks)
+        generation = 0 if old_generation is None else old_generation + 1
+        for i, chunk_str in enumerate(chunk_strs):
+            self._set(FieryStateStore.chunk_key(generation, i), chunk_str)
+        self._set(PaperCut.FIERY_STATE, json.dumps({'generation': generation, 
+                                                   'chunks': num_chunks}))
+        if old_generation is not None:
+            # PaperCut config values can't be deleted so we empty them
+            for i in range(old_num_chunks):
+                self._set(FieryStateStore.chunk_key(old_generation, i), '')
+
+        self.generation = generation
+        self.chunks = chunks
+        self.chunk_strs = chunk_strs
+        self.chunk_of = chunk_of
+
+
+class PaperCut:
+    """For connecting with PaperCut server
+            host_name: Network name/IP address of PaperCut server
+            port: PaperCut server port to use
+            auth_token: Authorization token or password
+            account_name: Name of PaperCut Shared Account to be used to store Fiery jobs
+            connected: True if connected to a PaperCut server
+            uid: UID that is used to claim control of recording Fiery jobs on host_name. 
+                 Ensures that only one instance of this script is recording Fiery jobs in the
+                 PaperCut Job Log at one time. The worker processes of a ShardSupervisor share
+                 its uid
+            claim: False to connect without claiming the PaperCut server, for commands that 
+                 only read from it
+            wait_for_claim: False to exit rather than wait if another instance of this script 
+                 holds the claim, for commands that run once
+    """
+
+    # Number of processJob calls sent in each system.multicall request. 
+    # 0 or 1 records jobs with one processJob request per job
+    multicall_size = 50
+    # Number of keep-alive connections to the PaperCut server shared by all threads
+    num_connections = 4
+    # Socket timeout in seconds for PaperCut requests
+    timeout = 60.0
+    # Seconds that a claim on the PaperCut server lasts without being renewed
+    claim_ttl = 60
+    # Seconds to wait after taking over a claim before checking that we hold it
+    claim_confirm_secs = 2.0
+
+    def __init__(self, host_name='localhost', port=9191, auth_token=None, account_name=None,
+                 uid=None, claim=True, wait_for_claim=True):
+        self.host_name = host_name
+        self.port = port
+        self.auth_token = auth_token
+        self.account_name = account_name
+        self.connected = False
+        self.uid = uid or get_uid()
+        self.claiming = claim
+        self.wait_for_claim = wait_for_claim
+        self.renewer = None
+        self.converter = JobConverter(host_name, account_name)
+        self.journal = None
+        self.syncer = None
+        # FreshnessTracker of the jobs recorded by the polling loop or None
+        self.freshness = None
+        self.lease_expiry = 0.0
+        self.multicall_lock = threading.Lock()
+        self.store = FieryStateStore(self)
+        self.connect()
+
+    def connect(self):
+        """Standard PaperCut XMLRPC initialization
+            - Instantiate a server and create the accout if it doesn't already exis.
+            - Claim the PaperCut server unless we only read from it
+        """
+
+        log_info('Connecting to PaperCut "%s:%d"' % (self.host_name, self.port))
+
+        self.server = PaperCutServerPool('http://%s:%d/rpc/api/xmlrpc' % (self.host_name, self.port),
+                                         PaperCut.num_connections, PaperCut.timeout)
+
+        if self.claiming:
+            self.acquire_claim()
+            self.renewer = ClaimRenewer(self, PaperCut.claim_ttl / 3)
+
+        if self.server.api.isSharedAccountExists(self.auth_token, self.account_name):
+            log_info('PaperCut Shared Account "%s" account already exists.' % self.account_name)
+        else:
+            # user does not exist so create
+            log_info('Creating PaperCut Shared Account "%s"' % self.account_name)
+            self.server.api.addNewSharedAccount(self.auth_token, self.account_name)
+
+        self.connected = True     
+
+    def convert_job(self, fiery_job):
+        """Convert a Fiery job to a PaperCut job and apply server and shared-account names."""    
+        pc_job = convert_job(fiery_job)
+        pc_job['server'] = self.host_name
+        pc_job['shared-account'] = self.account_name
+        return pc_job
+
+    @staticmethod
+    def check_jobs(fiery, fiery_job_list):
+        """Validate new job ids against those already stored on PaperCut"""
+        for job in fiery_job_list: 
+            if fiery.max_id is not None and job['id'] <= fiery.max_id:
+                log_error('\n\t'.join([
+                            'Fetched Fiery job id <= previous max id',
+                            'job[id]=%s,fiery.max_id=%s', 
+                            'job=%s',
+                            'previous state=%s']) % (
+                        job['id'], fiery.max_id, job, fiery))
+                exit(EXIT_INVALID_JOB_LIST)
+
+    def _record_jobs_int(self, fiery, fiery_job_list, id_details_list=None):
+        """Record Fiery jobs in PaperCut Job Log
+            fiery: FieryState of Fiery the jobs came from
+            fiery_job_list: List of Fiery jobs sorted by id
+            id_details_list: fiery_job_list converted by self.converter or None to convert here
+            Should not be called directly. Use record_jobs()
+            Returns: (done_ids, failures) where 
+                done_ids: ids of jobs that were recorded or did not need to be recorded
+                failures: list of (id, xmlrpclib.Fault) for jobs that PaperCut rejected
+            Recording stops after the first batch of jobs that has a failure.
+            Jobs in the journal's index of recorded jobs are not recorded again.
+        """
+        if id_details_list is None:
+            id_details_list = self.converter.convert_batch(fiery_job_list)
+
+        # PaperCut doesn't log non-printing print jobs so they are done already
+        recorded_ids = set(job_id for job_id, _ in id_details_list)
+        done_ids = [job['id'] for job in fiery_job_list if job['id'] not in recorded_ids]
+
+        if self.journal:
+            skipped_ids = [job_id for job_id, _ in id_details_list 
+                           if self.journal.is_recorded(fiery.ip, job_id)]
+            if skipped_ids:
+                log_info('Skipping %d jobs from Fiery %s that were already recorded: ids %s', 
+                         len(skipped_ids), fiery.ip, id_ranges(skipped_ids))
+                done_ids.extend(skipped_ids)
+                skipped_ids = set(skipped_ids)
+                id_details_list = [(job_id, job_details) for job_id, job_details 
+                                   in id_details_list if job_id not in skipped_ids]
+
+        for _, job_details in id_details_list:
+            log_job('Recording job="%s"', job_details)
+
+        if self.freshness:
+            print_times = {job['id']: parse_fiery_timestamp(job.get('timestamp done printing'))
+                           for job in fiery_job_list}
+
+        failures = []
+        i = 0
+        if self.journal and id_details_list:
+            batch = id_details_list[:max(1, self.multicall_size)]
+            self.journal.sending(fiery.ip, batch[0][0], batch[-1][0])
+        # Number of jobs to record one at a time after a system.multicall request failed
+        num_single = 0
+        while i < len(id_details_list) and not failures:
+            batch_size = 1 if num_single else max(1, self.multicall_size)
+            batch = id_details_list[i:i + batch_size]
+            try:
+                if batch_size > 1:
+                    with METRICS.timer('papercut_process_job_seconds'):
+                        results = self._process_jobs_multicall(batch)
+                else:
+                    results = []
+                    for _, job_details in batch:
+                        with METRICS.timer('papercut_process_job_seconds'):
+                            results.append(self._process_job(job_details))
+            except PAPERCUT_ERRORS, e:
+                METRICS.inc('papercut_unavailable_total')
+                if getattr(e, 'request_sent', True):
+                    # Some or all of batch may have been recorded but we can't tell which
+                    raise PaperCutUncertain(e, batch[0][0], batch[-1][0])
+                raise PaperCutUnavailable(e, batch[0][0])
+            if results is None:
+                # The system.multicall request failed. Nothing in batch was recorded
+                num_single = len(batch)
+                continue
+            batch_done_ids = []
+            for (job_id, _), error in zip(batch, results):
+                if error is None:
+                    batch_done_ids.append(job_id)
+                else:
+                    failures.append((job_id, error))
+            done_ids.extend(batch_done_ids)
+            METRICS.inc('papercut_jobs_recorded_total', len(batch_done_ids))
+            if self.freshness:
+                self.freshness.observe(fiery.ip, [print_times[job_id] for job_id in batch_done_ids
+                                                  if print_times[job_id] is not None])
+            if failures:
+                METRICS.inc('papercut_job_failures_total', len(failures))
+            i += len(batch)
+            num_single = max(0, num_single - len(batch))
+            if self.journal:
+                # If there were no failures then all jobs up to the end of batch have been recorded
+                next_size = 1 if num_single else max(1, self.multicall_size)
+                next_batch = id_details_list[i:i + next_size] if not failures else None
+                self.journal.record(fiery.ip, batch_done_ids, 
+                                    None if failures else batch[-1][0],
+                                    (next_batch[0][0], next_batch[-1][0]) if next_batch else None)
+
+        return sorted(done_ids), failures
+
+    def _process_job(self, job_details):
+        """Record one job in PaperCut Job Log with processJob
+            Returns: None on success or the xmlrpclib.Fault if PaperCut rejected the job
+        """
+        try:
+            self.server.api.processJob(self.auth_token, job_details)
+        except xmlrpclib.Fault, e:
+            return e
+        return None
+
+    def _process_jobs_multicall(self, id_details_list):
+        """Record jobs in PaperCut Job Log with one system.multicall request
+            id_details_list: list of (id, job details string)
+            Returns: list of None for each recorded job or the xmlrpclib.Fault for each rejected
+                job, in the order of id_details_list. 
+                None if the system.multicall request failed, so that the jobs are recorded one at
+                a time. If PaperCut does not support system.multicall then self.multicall_size 
+                is also set to 0 so that subsequent jobs are recorded one at a time.
+        """
+        multicall = xmlrpclib.MultiCall(self.server)
+        for _, job_details in id_details_list:
+            multicall.api.processJob(self.auth_token, job_details)
+        try:
+            multicall_results = multicall()
+        except xmlrpclib.Fault, e:
+            # PaperCut and Python XML-RPC servers name the method in the fault when it is missing
+            if 'system.multicall' not in e.faultString:
+                log_error('PaperCut system.multicall failed. Recording these jobs one at a time: '
+                          '%s', e)
+                return None
+            # Several recorder threads may get this fault
+            with self.multicall_lock:
+                if self.multicall_size:
+                    log_error('PaperCut does not support system.multicall. Recording jobs one at '
+                              'a time: %s', e)
+                    self.multicall_size = 0
+            return None
+
+        results = []
+        for i in range(len(id_details_list)):
+            try:
+                multicall_results[i]
+                results.append(None)
+            except xmlrpclib.Fault, e:
+                results.append(e)
+        return results
+
+    def record_jobs(self, fiery, fiery_job_list, id_details_list=None, trace=None):
+        """Record Fiery jobs in PaperCut Job Log
+            fiery_job_list: List of Fiery jobs
+            id_details_list: fiery_job_list converted by self.converter.convert_batch() or None
+            trace: BatchTrace to add the record and save_fiery times to or None
+
+            Ensures that jobs are recorded in PaperCut Job Log reliably and that jobs are not
+            recorded twice.
+            Returns: True if all the jobs were recorded. False if PaperCut rejected some of them,
+                in which case fiery.max_id is left below the first rejected job so that the jobs
+                from it on can be fetched and recorded again.
+
+            If the PaperCut Config Editor values show that recording is in an inconsistent state
+            then this function will exit() with recording any Fiery jobs in the PaperCut Job Log.
+        """
+
+        # Check that Fiery state is consistent
+        check_consistency(fiery)
+
+        # Check that new jobs are consistent with those already recorded
+        PaperCut.check_jobs(fiery, fiery_job_list)
+
+        if id_details_list is None:
+            id_details_list = self.converter.convert_batch(fiery_job_list)
+
+        try:
+            # Check that no other instance of this script is recording jobs on the PaperCut server
+            with span(trace, 'record'):
+                self.check_claim()
+
+            # Note in PaperCut Config Editor that we are in the process of recording Fiery jobs in
+            # the PaperCut Job Log
+            max_id = max(job['id'] for job in fiery_job_list)
+            fiery.pending_max_id = max_id  
+            with span(trace, 'save_fiery'):
+                self.note_fiery(fiery)
+
+            # Record the jobs in the PaperCut Job Log
+            with span(trace, 'record'):
+                done_ids, failures = self._record_jobs_int(fiery, fiery_job_list, 
+                                                           id_details_list)
+        except PAPERCUT_ERRORS, e:
+            self.handle_unavailable(fiery, fiery_job_list, id_details_list, e, 
+                                    fiery_job_list[0]['id'])
+        except PaperCutUnavailable, e:
+            self.handle_unavailable(fiery, fiery_job_list, id_details_list, e.error, e.first_id)
+        except PaperCutUncertain, e:
+            self.handle_uncertain(fiery, fiery_job_list, e)
+
+        if failures:
+            self.handle_failures(fiery, fiery_job_list, done_ids, failures)
+            return False
+
+        # Note in PaperCut Config Editor that we are done recording Fiery jobs in the PaperCut Job 
+        # Log
+        fiery.max_id = max_id
+        fiery.pending_max_id = None
+        try:
+            with span(trace, 'save_fiery'):
+                self.note_fiery(fiery)
+        except PAPERCUT_ERRORS, e:
+            # All the jobs were recorded. The state is saved with the next jobs from this Fiery
+            log_error('Could not save Fiery %s state in PaperCut config: %s' % (fiery.ip, e))
+        return True
+
+    def handle_unavailable(self, fiery, fiery_job_list, id_details_list, error, first_id):
+        """Update Fiery state after PaperCut could not be reached while recording fiery_job_list
+            first_id: id of the first job that may not have been recorded
+            max_id is advanced to the last job before first_id. 
+            Raises PaperCutUnavailable with the jobs from first_id on so that they can be 
+            recorded later.
+        """
+        recorded_ids = [job['id'] for job in fiery_job_list if job['id'] < first_id]
+        if recorded_ids:
+            fiery.max_id = max(recorded_ids)
+        fiery.pending_max_id = None
+        try:
+            self.note_fiery(fiery)
+        except PAPERCUT_ERRORS:
+            # The state is saved with the next jobs from this Fiery that are recorded
+            pass
+        log_error('PaperCut could not be reached while recording jobs from Fiery %s. Jobs with '
+                  'ids >= %d were not recorded: %s' % (fiery.ip, first_id, error))
+        raise PaperCutUnavailable(error, first_id,
+                                  [job for job in fiery_job_list if job['id'] >= first_id],
+                                  [(job_id, job_details) for job_id, job_details in id_details_list
+                                   if job_id >= first_id])
+
+    def handle_uncertain(self, fiery, fiery_job_list, e):
+        """Stop after PaperCut could not be reached while it may have been recording jobs
+            e: PaperCutUncertain. Jobs with ids < e.first_id were recorded. Those with ids from 
+                e.first_id to e.last_id may or may not have been recorded
+
+            The uncertain jobs are left pending in the Fiery state so that this script won't 
+            record them, or any later jobs, until the range has been checked in the PaperCut Job 
+            Log and the Fiery state has been fixed with the resolve command.
+        """
+        recorded_ids = [job['id'] for job in fiery_job_list if job['id'] < e.first_id]
+        if recorded_ids:
+            fiery.max_id = max(recorded_ids)
+        fiery.pending_max_id = e.last_id
+        if self.journal:
+            self.journal.hold(fiery, e.first_id, e.last_id)
+        try:
+            self.save_fiery(fiery)
+        except PAPERCUT_ERRORS:
+            # The PaperCut config keeps the pending_max_id noted before the jobs were recorded
+            pass
+        log_error('PaperCut could not be reached while recording jobs from Fiery %s: %s. Jobs '
+                  'with ids %d to %d may have been recorded. Check the PaperCut Job Log for '
+                  'them and run this script with "resolve %s=<highest id recorded>", or %s if '
+                  'none were. Quitting.' % (fiery.ip, e.error, e.first_id, e.last_id, fiery.ip,
+                  fiery.max_id))
+        exit(EXIT_INCONSISTENT)
+
+    def note_fiery(self, fiery):
+        """Save Fiery state while recording jobs
+            With a journal the state is saved locally and synced to the PaperCut config in the 
+            background. Without one it is saved in the PaperCut config straight away.
+        """
+        if self.journal:
+            self.journal.save(fiery)
+            if self.syncer:
+                self.syncer.mark(fiery)
+        else:
+            self.save_fiery(fiery)
+
+    def set_journal(self, journal, sync_secs):
+        """Record Fiery state in journal and sync it to the PaperCut config every sync_secs
+            sync_secs: None to keep the Fiery states out of the PaperCut config
+        """
+        self.journal = journal
+        self.syncer = FieryConfigSyncer(self, sync_secs) if sync_secs is not None else None
+
+    def handle_failures(self, fiery, fiery_job_list, done_ids, failures):
+        """Update Fiery state after some jobs in fiery_job_list could not be recorded
+            done_ids, failures: As returned by _record_jobs_int()
+
+            max_id is advanced to the last job before the first failure so that the failed jobs
+            are retried on the next poll. If any job after the first failure was recorded then 
+            it is skipped on the retry if there is a journal. Without one, the Fiery state is 
+            left inconsistent and this function exits.
+        """
+        for job_id, error in failures:
+            log_error('Could not record Fiery %s job id=%s in PaperCut: %s' % (fiery.ip, job_id, 
+                      error))
+
+        first_failed_id = min(job_id for job_id, _ in failures)
+        ok_ids = [job['id'] for job in fiery_job_list if job['id'] < first_failed_id]
+        if ok_ids:
+            fiery.max_id = max(ok_ids)
+
+        recorded_after = [job_id for job_id in done_ids if job_id > first_failed_id]
+        if recorded_after and not self.journal:
+            fiery.pending_max_id = max(recorded_after)
+            self.note_fiery(fiery)
+            log_inconsistent(fiery)
+            exit(EXIT_INCONSISTENT)
+
+        fiery.pending_max_id = None
+        self.note_fiery(fiery)
+ 
+    FIERY = 'Fiery'
+    FIERY_LIST = '%s.list' % FIERY 
+    FIERY_STATE = '%s.state' % FIERY
+    FIERY_ACCOUNT = '%s.account' % FIERY 
+    FIERY_CLAIM = '%s.claim' % FIERY    
+
+    @staticmethod
+    def config_key(fiery_ip):
+        """PaperCut config key format used for storing Fiery state by older versions of this 
+            script. See FieryStateStore
+        """
+        return '%s:%s' % (PaperCut.FIERY, fiery_ip)
+
+    @staticmethod
+    def parse_claim(claim_str):
+        """Returns: (uid, expiry time) of the instance of this script that claimed PaperCut in
+            PaperCut config value claim_str. 
+            uid is None if PaperCut has not been claimed. expiry time is None for claims made by 
+            older versions of this script, which don't expire.
+        """
+        if not claim_str:
+            return None, None
+        uid, _, expiry = claim_str.rpartition(':')
+        try:
+            return uid, float(expiry)
+        except ValueError:
+            return claim_str, None
+
+    def read_claim(self):
+        """Returns: (uid, expiry time) of the current claim on PaperCut. See parse_claim()"""
+        return PaperCut.parse_claim(self.server.api.getConfigValue(self.auth_token, 
+                                                                   PaperCut.FIERY_CLAIM))
+
+    def claim(self):
+        """Assert the claim current instance of this script to update PaperCut with Fiery jobs.
+            The claim is a lease that expires claim_ttl seconds from now unless it is renewed.
+        """
+        expiry = time.time() + PaperCut.claim_ttl
+        self.server.api.setConfigValue(self.auth_token, PaperCut.FIERY_CLAIM, 
+                                       '%s:%.3f' % (self.uid, expiry)) 
+        self.lease_expiry = expiry
+
+    def acquire_claim(self):
+        """Claim PaperCut, waiting for any other instance of this script's claim to expire first
+            This lets a standby instance take over within claim_ttl of the active instance 
+            crashing, and sooner when it stops cleanly and releases its claim. Claims from older
+            versions of this script are taken over straight away.
+            Exits without waiting if wait_for_claim is False.
+        """
+        waiting = False
+        while True:
+            uid, expiry = self.read_claim()
+            now = time.time()
+            if uid not in (None, self.uid) and expiry is not None and expiry > now:
+                if not self.wait_for_claim:
+                    log_error('PaperCut server "%s" is claimed by another instance of this script. '
+                              'Stop it before running this command.' % self.host_name)
+                    exit(EXIT_MULTIPLE_INSTANCE)
+                if not waiting:
+                    log_info('PaperCut server "%s" is claimed by another instance of this script. '
+                             'Waiting to take over.' % self.host_name)
+                    waiting = True
+                time.sleep(min(expiry - now, PaperCut.claim_ttl / 3) + random.uniform(0, 1))
+                continue
+
+            self.claim()
+            if uid in (None, self.uid):
+                break
+            # Another standby may have taken over at the same time. The last claim wins
+            time.sleep(PaperCut.claim_confirm_secs)
+            if self.read_claim()[0] == self.uid:
+                log_info('Took over claim on PaperCut server "%s"' % self.host_name)
+                break
+            self.lease_expiry = 0.0
+
+    def renew_claim(self):
+        """Extend our claim on PaperCut if we still hold it
+            Returns: True if we still hold it
+        """
+        uid, _ = self.read_claim()
+        if uid != self.uid:
+            # check_claim() will see this
+            self.lease_expiry = 0.0
+            return False
+        self.claim()
+        return True
+
+    def release_claim(self):
+        """Give up our claim on PaperCut when we stop so that a standby instance can take over
+            straight away rather than after the claim expires
+        """
+        if not self.claiming:
+            return
+        self.claiming = False
+        self.renewer.stop()
+        try:
+            if self.read_claim()[0] == self.uid:
+                self.server.api.setConfigValue(self.auth_token, PaperCut.FIERY_CLAIM, '')
+                log_info('Released claim on PaperCut server "%s"', self.host_name)
+        except PAPERCUT_ERRORS, e:
+            log_error('Could not release claim on PaperCut server: %s', e)
+        self.lease_expiry = 0.0
+
+    def check_claim(self):
+        """Check if another instance of this program is updating PaperCut.
+            Exit if it is.
+            No PaperCut request is made while our claim has plenty of time left as no other 
+            instance will claim PaperCut until it expires, or if we are not claiming PaperCut.
+        """
+        if not self.claiming or time.time() < self.lease_expiry - PaperCut.claim_ttl / 3:
+            return
+        with METRICS.timer('papercut_check_claim_seconds'):
+            renewed = self.renew_claim()
+        if not renewed:
+            log_error('''
+    Another instance of this script is updating PaperCut server "%s"
+    Only one instance of this script can be run at one time.
+    Quitting.'''
+                % self.host_name)
+            exit(EXIT_MULTIPLE_INSTANCE)
+
+    def save_fiery(self, fiery):  
+        """Save Fiery state in PaperCut config."""
+        assert fiery.__class__.__name__ == 'FieryState', fiery.__class__.__name__
+        self.store.save([fiery])
+
+    def save_fierys(self, fiery_list):  
+        """Save the states of the Fierys in fiery_list in PaperCut config."""
+        self.store.save(fiery_list)
+
+    def load_fiery(self, fiery_ip):  
+        """Load Fiery state from PaperCut config
+            fiery_ip: IP address/network name of Fiery for which start id is being saved
+            Returns: Fiery state
+            Always returns a dict with as much info as it can get from the PaperCut config.
+        """
+        fiery = FieryState.from_dict(self.store.get(fiery_ip), ip=fiery_ip)
+        if self.journal:
+            # The journal is more recent than the PaperCut config
+            self.journal.restore(fiery)
+        return fiery
+
+    def load_fiery_ip_list(self):
+        return self.store.ips()
+
+    def load_fiery_list(self):
+        self.check_claim()
+        fiery_ip_list = self.load_fiery_ip_list()
+        return [self.load_fiery(fiery_ip) for fiery_ip in fiery_ip_list]
+
+    def save_fiery_list(self, fiery_list):
+        self.check_claim()
+        self.store.save_list(fiery_list)
+        if self.journal:
+            for fiery in fiery_list:
+                self.journal.save(fiery)
+
+    def describe_state(this):
+        msg = \
+'''
+    The Fiery jobs tracked so far can be seen in the PaperCut web admin interface.
+    - Jobs are logged as print jobs in the Shared Account "%s"
+       Each job is stored with a comment that contains the Fiery id.
+    - The Fierys currently being tracked are in the PaperCut Config Editor
+        - Search for "%s" (without the quotes)
+        - Name "%s" has a value like {"chunks": 2, "generation": 3}. 
+          The Fiery states are in the values named "%s" to "%s" in this example.
+        - Each of these has an entry for each of its Fierys that looks like
+          "192.168.1.10": {"max_id": 4, "password": "secret", "username": "admin"}
+            The username and password values (admin and secret in this example) are 
+            used to log in to the Fiery. max_id is the maximum Fiery job id for this 
+            Fiery recorded in the PaperCut Job Log.
+            NOTE: Sometimes you will see an entry like  
+                "192.168.1.10": {"max_id": 4, "password": "secret", "pending_max_id": 7, 
+                                 "username": "admin"}
+            This means that this script stopped while it was recording Fiery jobs 
+            with ids in the range 5-7 on PaperCut.
+            If you ever see this then you will need to 
+            - check which of the jobs in the range 5-7 have been recorded in the 
+              PaperCut Job Log. You can find this by sorting PaperCut Shared Account 
+              "%s" Job Log by  date and checking the comment of the latest job.              
+            - set max_id to the highest Fiery id
+            - delete the pending_max_id 
+            - e.g. if the highest Fiery id logged is 6 then you would set the above 
+                  entry to 
+                  "192.168.1.10": {"max_id": 6, "password": "secret", "username": "admin"}
+            When this script is run with a journal (the default) it fixes this itself
+            on startup from the last recorded id in the journal, unless this script 
+            stopped or PaperCut stopped responding while jobs were being sent to it. Then 
+            it can't tell which of the jobs were recorded and stops. Fix the state with 
+                python fiery_papercut.py resolve 192.168.1.10=6
+            which updates both the journal and these values.
+''' % ( this.account_name,
+        PaperCut.FIERY,
+        PaperCut.FIERY_STATE,
+        FieryStateStore.chunk_key(3, 0),
+        FieryStateStore.chunk_key(3, 1),
+        this.account_name)    
+
+        fiery_list = this.load_fiery_list()
+
+        print
+        print 'Overview'
+        print msg
+        
+        if not fiery_list:
+            print 'There are no Fierys tracked in the PaperCut Config Editor'
+            return
+
+        print 'PaperCut Config Editor values'
+        print
+        store = this.store
+        if store.generation is None:
+            print '    (Old format, one value per Fiery. It will be converted when this script runs)'
+        else:
+            print '    %s = %s' % (PaperCut.FIERY_STATE, json.dumps({'generation': store.generation,
+                                                                    'chunks': len(store.chunks)}))
+        for fiery in fiery_list:
+            print '    "%s": %s' % (fiery.ip, json.dumps(fiery.dict_no_ip(), sort_keys=True))
+  
+
+def log_inconsistent(fiery):
+    log_error('Inconsistent Fiery state=%s in PaperCut config "%s" values' 
+                % (fiery, PaperCut.FIERY_STATE))
+
+
+def check_consistency_list(fiery_list):   
+    """Check that all Fiery states are consistent and exit if they are not"""   
+    num_inconsistent = 0   
+    for fiery in fiery_list:
+        if fiery.is_inconsistent():
+            log_inconsistent(fiery)
+            num_inconsistent += 1
+    if num_inconsistent > 0:
+        log_error('''
+    Please fix inconsistent Fiery recording state and restart this script.
+    Check the PaperCut Job Log for the pending jobs then run this script with
+        resolve FIERY_IP=<highest id recorded>
+    or resolve-backfill for jobs that were being backfilled.
+    Run this script with -v option to see how to fix the inconsistent state.
+    
+Quitting ...
+''')
+        exit(EXIT_INCONSISTENT)
+
+
+def check_consistency(fiery):   
+    """Check that Fiery states os consistent and exit if is are not"""   
+    check_consistency_list([fiery])   
+
+ 
+def load_fierys_csv(csv_path):
+    """Load a list of Fiery ip, username, passwords from a CSV file"""
+    fiery_list = []
+    try: 
+        with open(csv_path, 'rb') as csv_file:
+            reader = csv.reader(csv_file)
+            for i,row in enumerate(reader):
+                if len(row) != 3:
+                    log_error('load_fierys_csv: row %d is formatted incorrectly row=%s' % (i, row))
+                    fiery_list = None
+                    break
+                ip,username,password = row    
+                fiery_list.append(FieryState(ip=ip, username=username, password=password))
+
+    except IOError, e:
+        log_error('dump_fierys_csv: csv_path="%s" failed with %s' % (csv_path, e)) 
+        return None
+    return fiery_list  
+
+
+def dump_fierys_csv(csv_path, fiery_list):
+    """Save a list of Fiery ip, username, passwords to a CSV file"""
+    try: 
+        with open(csv_path, 'wb') as csv_file:
+            writer = csv.writer(csv_file)
+            for fiery in fiery_list:
+                writer.writerow([fiery.ip, fiery.username, fiery.password])
+    except IOError, e:
+        log_error('dump_fierys_csv: csv_path="%s" failed with %s' % (csv_path, e)) 
+        return False
+    return True 
+
+
+def process_command_line():    
+    """Process the command line.
+        This script can only reasonably be run on the PaperCut server it is communicating with
+        so it does not make sense to change
+            - papercut_ip
+    """   
+    DEFAULT_FIERY_API_KEY_FILE = 'fiery.api.key'   
+    DEFAULT_FIERY_IP = None   # '192.68.228.104'   
+    DEFAULT_FIERY_USER = None # 'admin' 
+    DEFAULT_FIERY_PWD = None  # 'Fiery.color' 
+    DEFAULT_FIERY_BATCH_SIZE = 100 
+    DEFAULT_FIERY_MAX_BATCH_SIZE = 1000
+    DEFAULT_FIERY_CONNECT_TIMEOUT = 10.0
+    DEFAULT_FIERY_READ_TIMEOUT = 60.0
+    DEFAULT_FIERY_THREADS = 10
+    DEFAULT_WORKERS = 0
+
+    DEFAULT_PAPERCUT_IP = 'localhost'
+    DEFAULT_PAPERCUT_PORT = 9191
+    DEFAULT_PAPERCUT_PWD = 'password'
+    DEFAULT_PAPERCUT_ACCOUNT = PaperCut.FIERY_ACCOUNT
+    DEFAULT_PAPERCUT_MULTICALL_SIZE = 50
+    DEFAULT_PAPERCUT_CONNECTIONS = 4
+    DEFAULT_PAPERCUT_TIMEOUT = 60.0
+    DEFAULT_CLAIM_TTL_SECS = 60
+
+    DEFAULT_SLEEP_SECS = 60
+    DEFAULT_MIN_SLEEP_SECS = 10
+    DEFAULT_MAX_SLEEP_SECS = 600
+    DEFAULT_JOURNAL = 'papercut.fiery.journal'
+    DEFAULT_SPOOL = 'papercut.fiery.spool'
+    DEFAULT_CONFIG_SYNC_SECS = 60
+    DEFAULT_RECONNECT_MIN_SECS = 30
+    DEFAULT_RECONNECT_MAX_SECS = 3600
+    DEFAULT_CONVERTERS = 1
+    DEFAULT_RECORDERS = 2
+    DEFAULT_PIPELINE_QUEUE_SIZE = 4
+    DEFAULT_READ_AHEAD = 2
+    DEFAULT_REJECT_RETRIES = 3
+    DEFAULT_BACKFILL_CHECKPOINT = 'papercut.fiery.backfill'
+    DEFAULT_BACKFILL_RATE = 0.0
+    DEFAULT_METRICS_PORT = 0
+    DEFAULT_LAG_ALERT_SECS = 900
+    DEFAULT_JOB_LOG_RATE = 10
+    DEFAULT_PROFILE_SECS = 30
+    DEFAULT_PROFILE_TRIGGER = StackProfiler.prefix
+
+    parser = optparse.OptionParser('python %s [options] [backfill FIERY_IP=DUMP_FILE ...  | '
+                                   'resolve FIERY_IP=MAX_ID ... | '
+                                   'resolve-backfill FIERY_IP=MAX_ID ...]' % sys.argv[0])
+    parser.add_option('-L', '--csv-load', dest='csv_load',  
+            default=None, 
+            help='Load Fiery ip, username, pwd from csv file')
+    parser.add_option('-D', '--csv-dump', dest='csv_dump',  
+            default=None, 
+            help='Dump Fiery ip, username, pwd to csv file')            
+    parser.add_option('-B', '--fiery-batch-size', dest='fiery_batch_size', type='int',
+            default=DEFAULT_FIERY_BATCH_SIZE, 
+            help='Number of jobs to request in each call to Fiery')
+    parser.add_option('-M', '--fiery-max-batch-size', dest='fiery_max_batch_size', type='int',
+            default=DEFAULT_FIERY_MAX_BATCH_SIZE, 
+            help='Largest number of jobs to request in each call to Fiery when draining a backlog')
+    parser.add_option('--no-drain', action='store_false', dest='drain',
+            default=True,
+            help='Fetch one batch per Fiery per poll instead of draining backlogs without sleeping')
+    parser.add_option('-b', '--bootstrap', action='store_true', dest='bootstrap',
+            default=False,
+            help='Start recording Fierys that have not been recorded before from their latest job '
+                 'instead of from the start of their job history')
+    parser.add_option('--fiery-connect-timeout', dest='fiery_connect_timeout', type='float',
+            default=DEFAULT_FIERY_CONNECT_TIMEOUT,
+            help='Seconds to wait when connecting to a Fiery')
+    parser.add_option('--fiery-read-timeout', dest='fiery_read_timeout', type='float',
+            default=DEFAULT_FIERY_READ_TIMEOUT,
+            help='Seconds to wait for a Fiery to respond')
+    parser.add_option('-n', '--fiery-threads', dest='fiery_threads', type='int',
+            default=DEFAULT_FIERY_THREADS,
+            help='Maximum number of Fierys to poll at the same time')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+            default=DEFAULT_WORKERS,
+            help='Number of worker processes to share the Fierys between. 0 to poll all Fierys in '
+                 'this process')
+    parser.add_option('-K', '--fiery-api-key', dest='fiery_api_key_file', 
+            default=DEFAULT_FIERY_API_KEY_FILE, 
+            help='Path of Fiery API key file')        
+    parser.add_option('-S', '--fiery-ip', dest='fiery_ip', 
+            default=DEFAULT_FIERY_IP, 
+            help='Network name or IP address of Fiery to monitor')
+    parser.add_option('-U', '--fiery-user', dest='fiery_user', 
+            default=DEFAULT_FIERY_USER, 
+            help='Fiery username')
+    parser.add_option('-P', '--fiery-pwd', dest='fiery_pwd', 
+            default=DEFAULT_FIERY_PWD, 
+            help='Fiery password')
+    parser.add_option('-s', '--papercut-ip', dest='papercut_ip', 
+            default=DEFAULT_PAPERCUT_IP,
+            help='Network name or IP address of PaperCut server') 
+    parser.add_option('-o', '--papercut-port', dest='papercut_port', type='int', 
+            default=DEFAULT_PAPERCUT_PORT, 
+            help='PaperCut port')
+    parser.add_option('-p', '--papercut-pwd', dest='papercut_pwd', 
+            default=DEFAULT_PAPERCUT_PWD, 
+            help='PaperCut admin password')
+    parser.add_option('-a', '--papercut-account', dest='papercut_account', 
+            default=DEFAULT_PAPERCUT_ACCOUNT, 
+            help='Name of PaperCut shared account to log Fiery prints in')
+    parser.add_option('-m', '--papercut-multicall-size', dest='papercut_multicall_size', 
+            type='int', default=DEFAULT_PAPERCUT_MULTICALL_SIZE, 
+            help='Number of jobs to record in each PaperCut request. 1 disables system.multicall')
+    parser.add_option('--papercut-connections', dest='papercut_connections', type='int',
+            default=DEFAULT_PAPERCUT_CONNECTIONS,
+            help='Number of keep-alive connections to PaperCut server')
+    parser.add_option('--papercut-timeout', dest='papercut_timeout', type='float',
+            default=DEFAULT_PAPERCUT_TIMEOUT,
+            help='Seconds to wait for PaperCut server to respond')
+    parser.add_option('--claim-ttl-secs', dest='claim_ttl_secs', type='int',
+            default=DEFAULT_CLAIM_TTL_SECS,
+            help='Time a standby instance of this script waits to take over after this one crashes')
+    parser.add_option('-t', '--sleep-secs', dest='sleep_secs', type='int', 
+            default=DEFAULT_SLEEP_SECS, 
+            help='Initial sleep time between successive polls of a Fiery')    
+    parser.add_option('--min-sleep-secs', dest='min_sleep_secs', type='int', 
+            default=DEFAULT_MIN_SLEEP_SECS,
+            help='Shortest sleep time between polls of a busy Fiery')    
+    parser.add_option('--max-sleep-secs', dest='max_sleep_secs', type='int', 
+            default=DEFAULT_MAX_SLEEP_SECS,
+            help='Longest sleep time between polls of an idle Fiery')    
+    parser.add_option('--reconnect-min-secs', dest='reconnect_min_secs', type='int',
+            default=DEFAULT_RECONNECT_MIN_SECS,
+            help='Delay before first retrying a Fiery that could not be logged in to')
+    parser.add_option('--reconnect-max-secs', dest='reconnect_max_secs', type='int',
+            default=DEFAULT_RECONNECT_MAX_SECS,
+            help='Longest delay between retries of a Fiery that could not be logged in to')
+    parser.add_option('--converters', dest='converters', type='int',
+            default=DEFAULT_CONVERTERS,
+            help='Number of threads converting Fiery jobs to PaperCut jobs')
+    parser.add_option('--recorders', dest='recorders', type='int',
+            default=DEFAULT_RECORDERS,
+            help='Number of threads recording jobs on PaperCut')
+    parser.add_option('--pipeline-queue-size', dest='pipeline_queue_size', type='int',
+            default=DEFAULT_PIPELINE_QUEUE_SIZE,
+            help='Number of pages of jobs waiting for each converter or recorder thread')
+    parser.add_option('--read-ahead', dest='read_ahead', type='int',
+            default=DEFAULT_READ_AHEAD,
+            help='Number of pages of jobs to fetch from a backlogged Fiery ahead of recording')
+    parser.add_option('--reject-retries', dest='reject_retries', type='int',
+            default=DEFAULT_REJECT_RETRIES,
+            help='Number of times a job that PaperCut rejects is fetched again before it is '
+                 'skipped')
+    parser.add_option('-j', '--journal', dest='journal', 
+            default=DEFAULT_JOURNAL,
+            help='Local journal of Fiery recording state. Empty string to disable')
+    parser.add_option('--spool', dest='spool', 
+            default=DEFAULT_SPOOL,
+            help='Directory to keep jobs in while PaperCut can\'t be reached. Empty string to exit '
+                 'when PaperCut can\'t be reached')
+    parser.add_option('--config-sync-secs', dest='config_sync_secs', type='int', 
+            default=DEFAULT_CONFIG_SYNC_SECS,
+            help='Time between saves of journaled Fiery state to the PaperCut config')
+    parser.add_option('--backfill-checkpoint', dest='backfill_checkpoint', 
+            default=DEFAULT_BACKFILL_CHECKPOINT,
+            help='Local journal of backfill progress')
+    parser.add_option('--backfill-rate', dest='backfill_rate', type='float', 
+            default=DEFAULT_BACKFILL_RATE,
+            help='Maximum number of jobs per second to backfill. 0 for no limit')
+    parser.add_option('--backfill-polled', action='store_true', dest='backfill_polled', 
+            default=False,
+            help='Backfill the jobs of Fierys that this script has polled, up to their max_id. '
+                 'Jobs that were recorded on this PaperCut server are recorded twice')
+    parser.add_option('--metrics-port', dest='metrics_port', type='int', 
+            default=DEFAULT_METRICS_PORT,
+            help='Serve metrics in Prometheus format on http://127.0.0.1:<port>/metrics. '
+                 'With --workers, worker i serves them on port + i. 0 to disable')
+    parser.add_option('--lag-alert-secs', dest='lag_alert_secs', type='int', 
+            default=DEFAULT_LAG_ALERT_SECS,
+            help='Log an error when jobs from a Fiery are recorded this long after they printed. '
+                 '0 to disable')
+    parser.add_option('--profile-secs', dest='profile_secs', type='int', 
+            default=DEFAULT_PROFILE_SECS,
+            help='Length of the profiles taken on SIGUSR1 or when the --profile-trigger file is '
+                 'touched')
+    parser.add_option('--profile-trigger', dest='profile_trigger', 
+            default=DEFAULT_PROFILE_TRIGGER,
+            help='Take a profile whenever this file is created or touched. Empty string to '
+                 'disable')
+    parser.add_option('--job-log-rate', dest='job_log_rate', type='int', 
+            default=DEFAULT_JOB_LOG_RATE,
+            help='Most "Recording job" lines to log per second. 0 for no limit')
+    parser.add_option('--log-json', action='store_true', dest='log_json', 
+            default=False, 
+            help='Write %s as one JSON object per line' % LOG_FILE)
+    parser.add_option('-d', '--debug', action='store_true', dest='debug', 
+            default=False, 
+            help='Enable debug logging')     
+    parser.add_option('-v', '--view', action='store_true', dest='view', 
+            default=False, 
+            help='View Fiery tracking on PaperCut server. This can be done while this '
+                 'script is running')                 
+
+    options,args = parser.parse_args()
+    setup_logging(options.debug, options.log_json, options.job_log_rate)
+
+    # 
+    # We can't check command line params as they are optional (i.e. args is empty) 
+    # so we just print them to stdout.
+    #  
+    print('-' * 80)
+    print(__doc__)
+    print('     --help for more information')
+    print('-' * 80)
+    log_info('Options')    
+    log_info(options.__dict__)
+    log_info('-' * 80)
+
+    return options,args
+
+
+#
+# Backfill
+#
+class RateLimiter:
+    """Paces work done by several threads to a combined rate
+            rate: Units of work per second. 0 for no limit
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def wait(self, n):
+        """Wait until n more units of work can be done without going over the rate"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def parse_backfill_args(args):
+    """Parse the FIERY_IP=DUMP_FILE arguments of the backfill subcommand
+        Returns: list of (Fiery ip, dump file path) or None if args are invalid
+    """
+    if not args:
+        log_error('backfill needs one or more FIERY_IP=DUMP_FILE arguments')
+        return None
+    dump_list = []
+    for arg in args:
+        fiery_ip, _, path = arg.partition('=')
+        if not fiery_ip or not path:
+            log_error('Backfill argument "%s" is not of the form FIERY_IP=DUMP_FILE' % arg)
+            return None
+        if not os.path.isfile(path):
+            log_error('Backfill dump file "%s" does not exist' % path)
+            return None
+        dump_list.append((fiery_ip, path))
+    return dump_list
+
+
+def parse_resolve_args(args):
+    """Parse the FIERY_IP=MAX_ID arguments of the resolve and resolve-backfill subcommands
+        Returns: list of (Fiery ip, max_id) or None if args are invalid
+    """
+    if not args:
+        log_error('resolve needs one or more FIERY_IP=MAX_ID arguments')
+        return None
+    resolutions = []
+    for arg in args:
+        fiery_ip, _, max_id = arg.partition('=')
+        try:
+            resolutions.append((fiery_ip, int(max_id)))
+        except ValueError:
+            fiery_ip = None
+        if not fiery_ip:
+            log_error('Resolve argument "%s" is not of the form FIERY_IP=MAX_ID' % arg)
+            return None
+    return resolutions
+
+
+def resolve_fierys(papercut, journal, resolutions, save_config):
+    """Fix the states of Fierys whose jobs may or may not have been recorded, once the PaperCut
+        Job Log has been checked
+            journal: FieryJournal of the Fiery states. May be None if save_config is True
+            resolutions: list of (Fiery ip, id of the last job from the Fiery in the Job Log)
+            save_config: Save the states in the PaperCut config too, as for the polling loop
+        Returns: True on success
+    """
+    for fiery_ip, max_id in resolutions:
+        if save_config:
+            if fiery_ip not in papercut.load_fiery_ip_list():
+                log_error('Fiery %s is not tracked on PaperCut' % fiery_ip)
+                return False
+            fiery = papercut.load_fiery(fiery_ip)
+        else:
+            if fiery_ip not in journal.states:
+                log_error('Fiery %s has not been backfilled' % fiery_ip)
+                return False
+            fiery = FieryState(ip=fiery_ip)
+            journal.restore(fiery, log=False)
+        log_info('Resolved Fiery %s: max_id=%s, pending_max_id=%s => max_id=%d' % (fiery_ip, 
+                 fiery.max_id, fiery.pending_max_id, max_id))
+        fiery.max_id = max_id
+        fiery.pending_max_id = None
+        if journal:
+            journal.save(fiery)
+        if save_config:
+            papercut.save_fiery(fiery)
+    return True
+
+
+def iter_dump_pages(path, page_size):
+    """Read the jobs in a saved Fiery cost API response a page at a time
+            path: Path of a file containing a JSON list of Fiery jobs like costoutput.json
+        Yields: Lists of up to page_size jobs sorted by id, with only the fields in FIERY_JOB_KEYS
+        The file is decoded incrementally so dumps of any size can be read.
+    """
+    with open(path, 'rb') as f:
+        chunks = iter(lambda: f.read(FieryConnection.chunk_size), '')
+        page = []
+        for job in iter_json_list(chunks):
+            page.append({k: job[k] for k in FIERY_JOB_KEYS if k in job})
+            if len(page) >= page_size:
+                yield sorted(page, key=lambda x: x['id'])
+                page = []
+        if page:
+            yield sorted(page, key=lambda x: x['id'])
+
+
+class Backfill:
+    """Records saved Fiery cost API responses on PaperCut without polling the Fierys
+            papercut: PaperCut to record the jobs on. Its journal is set to checkpoint
+            checkpoint: FieryJournal of backfill progress. It is kept apart from the Fiery states 
+                of the polling loop
+            num_recorders: Number of dump files that are recorded at the same time
+            rate: Maximum number of jobs recorded per second, 0 for no limit
+            polled: Backfill jobs that the polling loop has recorded
+
+        Dump files for different Fierys are recorded in parallel on num_recorders threads. Dump 
+        files for the same Fiery are recorded one after another on the same thread in the order
+        they are given.
+        Progress is checkpointed after every page with the same pending_max_id protocol and 
+        index of recorded jobs as the polling loop, so an interrupted backfill carries on where 
+        it stopped when it is run again with the same dump files. Jobs with ids at or below the 
+        highest id backfilled from a Fiery are taken to be done, so each Fiery's dumps should be 
+        given in id order.
+        Backfilling a Fiery's jobs that the polling loop has already recorded records them twice, 
+        so backfills are for history that was never polled. Jobs from a Fiery that was added with
+        --bootstrap are only backfilled up to its bootstrap_id. A Fiery that was polled from the 
+        start of its job history is not backfilled unless polled is True, in which case its jobs
+        are backfilled up to its max_id.
+    """
+
+    # Number of jobs recorded at a time
+    page_size = 1000
+
+    def __init__(self, papercut, checkpoint, num_recorders, rate, polled=False):
+        self.papercut = papercut
+        self.checkpoint = checkpoint
+        self.num_recorders = num_recorders
+        self.limiter = RateLimiter(rate)
+        self.polled = polled
+        self.lock = threading.Lock()
+        self.exc_info = None
+        # {ip: highest id the polling loop leaves to the backfill or None for all ids}
+        self.live_max_ids = {}
+        # {ip: FieryState of backfill progress}
+        self.states = {}
+        # recorded: jobs sent to PaperCut. non_printing: jobs that PaperCut doesn't log
+        self.stats = {'recorded': 0, 'skipped': 0, 'non_printing': 0, 'rejected': 0}
+        papercut.set_journal(checkpoint, None)
+
+    def run(self, dump_list):
+        """Record the jobs in dump_list
+            dump_list: list of (Fiery ip, dump file path)
+            Re-raises any exception raised on the recorder threads
+        """
+        # Fierys tracked by the polling loop
+        for fiery_ip in sorted(set(fiery_ip for fiery_ip, _ in dump_list)):
+            max_id = self.live_max_id(fiery_ip)
+            self.live_max_ids[fiery_ip] = max_id
+            fiery = FieryState(fiery_ip)
+            self.checkpoint.restore(fiery)
+            check_consistency(fiery)
+            self.states[fiery_ip] = fiery
+            log_info('Backfilling Fiery %s jobs with ids > %s%s' % (fiery_ip, fiery.max_id,
+                     ' and <= %d' % max_id if max_id is not None else ''))
+
+        start = time.time()
+        recorders = PipelineStage('backfill', self._backfill_dump, self.num_recorders, 
+                                  len(dump_list), self._error)
+        for fiery_ip, path in dump_list:
+            recorders.put(fiery_ip, (fiery_ip, path))
+        recorders.close(finish=True)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+        secs = time.time() - start
+        log_info('Backfilled %d jobs from %d dump files in %.1f sec (%.1f jobs/sec). %d jobs '
+                 'were skipped, %d were non-printing jobs and %d were rejected by PaperCut' % (
+                 self.stats['recorded'], len(dump_list), secs, 
+                 self.stats['recorded'] / max(secs, 1e-3), self.stats['skipped'], 
+                 self.stats['non_printing'], self.stats['rejected']))
+
+    def live_max_id(self, fiery_ip):
+        """Returns: Highest id of the jobs from Fiery fiery_ip that the polling loop leaves to the 
+                backfill or None for all ids
+            Exits if the polling loop has recorded all of the Fiery's jobs and polled is False
+        """
+        live = FieryState.from_dict(self.papercut.store.get(fiery_ip))
+        if live.max_id is None:
+            return None
+        if self.polled:
+            return live.max_id
+        if live.bootstrap_id is not None:
+            return live.bootstrap_id
+        log_error('Fiery %s has been polled from the start of its job history so its jobs with '
+                  'ids <= %d are already recorded on PaperCut. Backfilling them would record them '
+                  'twice. Use --backfill-polled to backfill them anyway.', fiery_ip, live.max_id)
+        exit(EXIT_BAD_ARG)
+
+    def _error(self, exc_info):
+        """Stop backfilling and have run() re-raise exc_info"""
+        with self.lock:
+            if not self.exc_info:
+                self.exc_info = exc_info
+
+    def _count(self, key, n):
+        with self.lock:
+            self.stats[key] += n
+
+    def _backfill_dump(self, item):
+        """Runs on the recorder threads"""
+        fiery_ip, path = item
+        fiery = self.states[fiery_ip]
+        live_max_id = self.live_max_ids[fiery_ip]
+        log_info('Backfilling Fiery %s from "%s"' % (fiery_ip, path))
+        for page in iter_dump_pages(path, Backfill.page_size):
+            fiery_jobs = [job for job in page
+                          if (fiery.max_id is None or job['id'] > fiery.max_id) and
+                             (live_max_id is None or job['id'] <= live_max_id)]
+            self._count('skipped', len(page) - len(fiery_jobs))
+            id_details_list = self.papercut.converter.convert_batch(fiery_jobs)
+            self._count('non_printing', len(fiery_jobs) - len(id_details_list))
+            while fiery_jobs and not self.exc_info:
+                self.limiter.wait(len(fiery_jobs))
+                if self.papercut.record_jobs(fiery, fiery_jobs, id_details_list):
+                    self._count('recorded', len(id_details_list))
+                    break
+                # fiery.max_id was left before the first rejected job. Skip it and record the 
+                # jobs after it
+                remaining, _ = trim_jobs(fiery.max_id, fiery_jobs, [])
+                rejected_id = remaining[0]['id']
+                self._count('recorded', sum(1 for job_id, _ in id_details_list 
+                                            if job_id < rejected_id))
+                self._count('rejected', 1)
+                fiery.max_id = rejected_id
+                self.papercut.note_fiery(fiery)
+                fiery_jobs = remaining[1:]
+                id_details_list = [(job_id, job_details) for job_id, job_details 
+                                   in id_details_list if job_id > rejected_id]
+            if self.exc_info:
+                return
+        log_info('Backfilled Fiery %s from "%s". max_id=%s' % (fiery_ip, path, fiery.max_id))
+
+
+#
+# Multi-process sharding
+#
+class ShardSupervisor:
+    """Shares the Fierys in fiery_list between worker processes and restarts workers that stop
+            options: Command line options. Passed on to the workers
+            papercut: PaperCut connection that holds the claim on the PaperCut server. 
+                The workers claim it with the same uid so the claim holds for the whole group
+            fiery_list: Fiery states that have been checked for consistency and saved in the 
+                PaperCut config
+
+        Each worker runs run_shard() with its own Fiery connections, pipeline, PaperCut connection 
+        and journal. A worker that stops is restarted after a delay that doubles each time it 
+        stops soon after starting. All workers are stopped if one of them stops with an exit code 
+        in FATAL_EXITS or this process loses its claim on the PaperCut server.
+    """
+
+    # Delays before restarting a worker
+    min_restart_secs = 5
+    max_restart_secs = 300
+    # Worker exit codes that restarting won't fix
+    FATAL_EXITS = (EXIT_NO_FIERY_API_KEY, EXIT_MULTIPLE_INSTANCE, EXIT_INCONSISTENT, 
+                   EXIT_INVALID_JOB_LIST)
+
+    def __init__(self, options, papercut, fiery_list):
+        self.options = options
+        self.papercut = papercut
+        fiery_ip_list = sorted(fiery.ip for fiery in fiery_list)
+        num_workers = max(1, min(options.workers, len(fiery_ip_list)))
+        self.shards = [fiery_ip_list[i::num_workers] for i in range(num_workers)]
+        self.workers = [None] * num_workers
+        self.start_times = [0.0] * num_workers
+        self.restart_times = [0.0] * num_workers
+        # Number of times each worker has stopped soon after starting
+        self.failures = [0] * num_workers
+        self.stopping = False
+        # Signal for run() to send to the workers. Set by forward_signal()
+        self.forward_signum = None
+
+    def stop(self):
+        """Ask run() to stop the workers and return
+            This only sets a flag so that it can be called from a signal handler
+        """
+        self.stopping = True
+
+    def run(self):
+        """Run the workers until stop() is called
+            Exits if a worker stops with a fatal exit code or the claim is lost
+        """
+        log_info('Sharing %d Fierys between %d worker processes' % (
+                 sum(len(shard) for shard in self.shards), len(self.shards)))
+        last_claim_time = time.time()
+        try:
+            while not self.stopping:
+                now = time.time()
+                try:
+                    for shard, worker in enumerate(self.workers):
+                        if worker is None:
+                            if now >= self.restart_times[shard]:
+                                self.start(shard)
+                        elif not worker.is_alive():
+                            self.workers[shard] = None
+                            self.restart(shard, worker.exitcode)
+                    signum, self.forward_signum = self.forward_signum, None
+                    if signum is not None:
+                        self.signal_workers(signum)
+                    if now >= last_claim_time + self.options.sleep_secs:
+                        self.papercut.check_claim()
+                        last_claim_time = now
+                except PAPERCUT_ERRORS, e:
+                    # The workers spool their jobs until PaperCut is back
+                    log_error('Could not check claim on PaperCut server: %s' % e)
+                time.sleep(1.0)
+        finally:
+            self.terminate()
+
+    def start(self, shard):
+        """Start the worker for shard"""
+        # Don't let a restarted worker take back a claim that another instance now holds
+        self.papercut.check_claim()
+        worker = multiprocessing.Process(target=run_shard, name='shard-%d' % shard,
+                    args=(self.options, self.papercut.uid, shard, self.shards[shard]))
+        worker.start()
+        self.workers[shard] = worker
+        self.start_times[shard] = time.time()
+        log_info('Started worker %d pid=%d with %d Fierys' % (shard, worker.pid, 
+                 len(self.shards[shard])))
+
+    def restart(self, shard, exitcode):
+        """Schedule a restart of the worker for shard, which stopped with exitcode"""
+        if exitcode in ShardSupervisor.FATAL_EXITS:
+            log_error('Worker %d stopped with exit code %d. Stopping all workers' % (shard, 
+                      exitcode))
+            exit(exitcode)
+        now = time.time()
+        if now - self.start_times[shard] > ShardSupervisor.max_restart_secs:
+            self.failures[shard] = 0
+        delay = min(ShardSupervisor.max_restart_secs, 
+                    ShardSupervisor.min_restart_secs * 2 ** self.failures[shard])
+        self.failures[shard] += 1
+        self.restart_times[shard] = now + delay
+        log_error('Worker %d stopped with exit code %s. Restarting it in %d sec' % (shard,
+                  exitcode, delay))
+
+    def forward_signal(self, signum):
+        """Ask run() to send signal signum to the workers
+            This only sets a flag so that it can be called from a signal handler
+        """
+        self.forward_signum = signum
+
+    def signal_workers(self, signum):
+        """Send signal signum to all running workers"""
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    def terminate(self):
+        """Stop all workers. Each finishes recording the jobs it is recording"""
+        workers = [worker for worker in self.workers if worker is not None]
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def run_shard(options, uid, shard, fiery_ip_list):
+    """Worker process of a ShardSupervisor. Records the jobs from the Fierys in fiery_ip_list
+            uid: The supervisor's uid for claiming the PaperCut server
+            shard: Index of the worker
+    """
+    # Don't run the supervisor's SIGTERM handler. run_fierys() installs the worker's handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    setup_logging(options.debug, options.log_json, options.job_log_rate)
+    try:
+        _run_shard(options, uid, shard, fiery_ip_list)
+    finally:
+        # Worker processes exit without running atexit handlers
+        stop_logging()
+
+
+def _run_shard(options, uid, shard, fiery_ip_list):
+    papercut = connect_papercut(options, uid)
+    if options.journal:
+        # Each worker has its own journal. They are merged into the main journal on startup
+        journal = FieryJournal(shard_path(options.journal, shard))
+        papercut.set_journal(journal, options.config_sync_secs)
+
+    fiery_list = [papercut.load_fiery(fiery_ip) for fiery_ip in fiery_ip_list]
+    check_consistency_list(fiery_list)
+    spool_path = shard_path(options.spool, shard) if options.spool else None
+    if options.metrics_port:
+        start_metrics_server(options.metrics_port + shard)
+    run_fierys(options, papercut, fiery_list, spool_path)
+
+
+def connect_papercut(options, uid=None, claim=True, wait_for_claim=True):
+    """Connect to the PaperCut server given in options and exit if we can't
+        uid: uid to claim the PaperCut server with. None for a new one
+        claim: False to connect without claiming the PaperCut server
+        wait_for_claim: False to exit if another instance of this script has claimed it
+    """
+    PaperCut.multicall_size = options.papercut_multicall_size
+    PaperCut.num_connections = options.papercut_connections
+    PaperCut.timeout = options.papercut_timeout
+    PaperCut.claim_ttl = options.claim_ttl_secs
+    FieryStateStore.num_groups = max(1, options.workers)
+    papercut = PaperCut(options.papercut_ip, options.papercut_port, options.papercut_pwd, 
+                        options.papercut_account, uid, claim, wait_for_claim)  
+    if not papercut.connected:
+        log_error('Could not connect to PaperCut: papercut=%s' % papercut) 
+        exit(EXIT_CANNOT_CONNECT_PAPERCUT)
+    return papercut
+
+
+def main():
+    """Top level processing
+    """
+    
+    setup_logging()
+        
+    logging.info(' Starting '.join(['=' * 30] * 2))
+
+    options,args = process_command_line()
+
+    command = args[0] if args else None
+    command_args = None
+    if command == 'backfill':
+        command_args = parse_backfill_args(args[1:])
+        if not command_args:
+            exit(EXIT_BAD_ARG)
+    elif command in ('resolve', 'resolve-backfill'):
+        command_args = parse_resolve_args(args[1:])
+        if not command_args:
+            exit(EXIT_BAD_ARG)
+    elif command:
+        log_error('Unknown command "%s"' % command)
+        exit(EXIT_BAD_ARG)
+
+    # Initialize PaperCut. Viewing the Fiery states doesn't claim it so it can be done while 
+    # this script is running. The commands exit rather than wait for the running script to stop,
+    # which would then become the standby if it was restarted
+    papercut = connect_papercut(options, claim=bool(command) or not options.view,
+                                wait_for_claim=not command)
+    try:
+        run_command(options, papercut, command, command_args)
+    finally:
+        # Let a standby instance take over straight away
+        papercut.release_claim()
+
+
+def run_command(options, papercut, command, command_args):
+    """Run command, or the polling loop if command is None, on papercut
+        command_args: Parsed arguments of command
+    """
+    if command == 'backfill':
+        # Saved Fiery jobs are recorded with their own checkpoint, apart from the polling loop
+        backfill = Backfill(papercut, FieryJournal(options.backfill_checkpoint), 
+                            options.recorders, options.backfill_rate, options.backfill_polled)
+        backfill.run(command_args)
+        exit(EXIT_SUCCESS)
+    if command == 'resolve-backfill':
+        if not resolve_fierys(papercut, FieryJournal(options.backfill_checkpoint), command_args, 
+                              False):
+            exit(EXIT_BAD_ARG)
+        exit(EXIT_SUCCESS)
+
+    if options.view:
+        # The journals belong to any instance of this script that is running, so this shows the 
+        # Fiery states as last saved in the PaperCut config
+        papercut.describe_state()
+        exit(EXIT_SUCCESS)
+
+    # Fiery states in the local journal are more recent than those in the PaperCut config.
+    # The journals of worker processes from the last run are more recent still
+    if options.journal:
+        journal = FieryJournal(options.journal)
+        for path in sorted(glob.glob(shard_path(options.journal, '*'))):
+            journal.absorb(path)
+        papercut.set_journal(journal, options.config_sync_secs)
+
+    if command == 'resolve':
+        if not resolve_fierys(papercut, papercut.journal, command_args, True):
+            exit(EXIT_BAD_ARG)
+        exit(EXIT_SUCCESS)
+
+    # Fetch the list of Fiery states stored on PaperCut  
+    fiery_list = papercut.load_fiery_list()  
+
+    # We will check consistency throughout this script
+    check_consistency_list(fiery_list)  
+
+    if options.csv_load:
+        # Load Fiery IPs, usernames and passwords from csv file
+        fiery_list = load_fierys_csv(options.csv_load)
+        if not fiery_list:
+            log_error('Could not load Fierys from csv file="%s"' % options.csv_load)
+            exit(EXIT_CANNOT_LOAD_CSV)    
+
+        # Update with fiery_list any state stored for these Fierys on PaperCut
+        for fiery in fiery_list:
+            pc_fiery = papercut.load_fiery(fiery.ip)
+            check_consistency(pc_fiery)
+            fiery.max_id = pc_fiery.max_id
+            fiery.bootstrap_id = pc_fiery.bootstrap_id
+
+        # Save Fierys to PaperCut config       
+        papercut.save_fiery_list(fiery_list)
+
+    if options.fiery_ip or options.fiery_user or options.fiery_pwd:
+        if not (options.fiery_ip and options.fiery_user and options.fiery_pwd):
+            log_error('If any of fiery_ip, fiery_user or fiery_pwd is specified then all must be')
+            exit(EXIT_BAD_ARG)
+        if options.csv_load:
+            log_error('If any of fiery_ip, fiery_user or fiery_pwd is specified then csv_load may not be')
+            exit(EXIT_BAD_ARG)   
+
+        fiery = FieryState(options.fiery_ip, options.fiery_user, options.fiery_pwd)
+        pc_fiery = papercut.load_fiery(fiery.ip)
+        check_consistency(pc_fiery)
+        fiery.max_id = pc_fiery.max_id
+        fiery.bootstrap_id = pc_fiery.bootstrap_id
+
+        fiery_list = [fiery]    
+        
+    # We will check consistency throughout this script
+    check_consistency_list(fiery_list)    
+
+    # Clean up the Fierys   
+    for fiery in fiery_list:
+        fiery.pending_max_id = None
+        assert fiery.ip, 'Invalid fiery=%s' % fiery     
+
+    if options.csv_dump:
+        if not dump_fierys_csv(options.csv_dump, fiery_list):
+            exit(EXIT_CANNOT_DUMP_CSV)
+
+    # Check that we have at least one Fiery
+
+    log_info('fiery_list=%s' % fiery_list)  
+    if not fiery_list:
+       log_error('No Fierys specified. Nothing to do.')
+       exit(EXIT_NO_FIERYS)        
+
+    # Record any jobs that were spooled while PaperCut could not be reached in the last run
+    if options.spool:
+        for path in [options.spool] + sorted(glob.glob(shard_path(options.spool, '*'))):
+            if not os.path.isdir(path):
+                continue
+            spool = JobSpool(path)
+            try:
+                drain_spool(papercut, spool, fiery_list)
+            except PaperCutUnavailable, e:
+                log_error('Could not record spooled jobs: %s' % e)
+                exit(EXIT_CANNOT_CONNECT_PAPERCUT)
+            spool.close()
+            if path != options.spool:
+                os.rmdir(path)
+
+    # We now have a valid Fiery list
+    # So we save it to the PaperCut config
+    papercut.save_fiery_list(fiery_list) 
+
+    if options.metrics_port and options.workers <= 0:
+        start_metrics_server(options.metrics_port)
+
+    if options.workers > 0:
+        supervisor = ShardSupervisor(options, papercut, fiery_list)
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.stop())
+        if hasattr(signal, 'SIGUSR1'):
+            # The workers do the work so they are the ones to profile
+            signal.signal(signal.SIGUSR1, 
+                          lambda signum, frame: supervisor.forward_signal(signal.SIGUSR1))
+            signal.siginterrupt(signal.SIGUSR1, False)
+        supervisor.run()
+    else:
+        run_fierys(options, papercut, fiery_list, options.spool)
+    log_info('Stopped')
+
+
+def run_fierys(options, papercut, fiery_list, spool_path=None):
+    """Record the jobs from the Fierys in fiery_list on papercut until we are stopped
+        fiery_list: Fiery states that have been checked for consistency
+        spool_path: Directory to spool jobs in while PaperCut can't be reached or None to stop
+            when it can't be reached
+    """
+
+    #
+    # Initialize connections to all Fierys in  fiery_list
+    # 
+    api_key = fiery_load_api_key(options.fiery_api_key_file)
+    if not api_key:
+        exit(EXIT_NO_FIERY_API_KEY)
+
+    FieryConnection.set_api_key(api_key)    
+    FieryConnection.batch_size = options.fiery_batch_size
+    FieryConnection.min_batch_size = min(FieryConnection.min_batch_size, options.fiery_batch_size)
+    FieryConnection.max_batch_size = max(options.fiery_max_batch_size, options.fiery_batch_size)
+    FieryConnection.drain = options.drain
+    FieryConnection.connect_timeout = options.fiery_connect_timeout
+    FieryConnection.read_timeout = options.fiery_read_timeout
+
+    log_debug('Fiery API Key file="%s"', options.fiery_api_key_file)   
+    log_debug('Fiery API Key="%s"', api_key) 
+
+    attempted_connection_list = [FieryConnection(f) for f in fiery_list]
+    fiery_connection_list = [f for f in attempted_connection_list if f.connected]
+    failed_connection_list = [f for f in attempted_connection_list if not f.connected]
+
+    log_info('Attempted to login to %d Fierys. %d succeeded, %d failed' % (
+        len(attempted_connection_list), 
+        len(fiery_connection_list),
+        len(failed_connection_list)
+    )) 
+    log_debug('=' * 80)  
+
+    # Fierys are polled concurrently on this pool of threads
+    pool = WorkerPool(options.fiery_threads)
+
+    # Fierys that could not be logged in to are retried in the background
+    reconnector = FieryReconnector(options.reconnect_min_secs, options.reconnect_max_secs)
+
+    # Each Fiery is polled at a rate that follows the rate at which it prints jobs
+    min_sleep_secs = min(options.min_sleep_secs, options.sleep_secs)
+    max_sleep_secs = max(options.max_sleep_secs, options.sleep_secs)
+    scheduler = FieryScheduler(options.sleep_secs, min_sleep_secs, max_sleep_secs)
+
+    #
+    # We now have connections and valid Fiery states in PaperCut so we are ready to go
+    #
+
+    #
+    # Main loop
+    #   Poll each Fiery when it is due for a list of jobs printed since the last time we polled it.
+    #   Polls run concurrently and a slow Fiery does not hold up the others.
+    #   If there are any new jobs   
+    #       convert them and record them in PaperCut, one page at a time per Fiery
+    #   Keep polling Fierys that returned a full page until they have caught up, fetching the next
+    #   page while the previous one is being recorded.
+    #   Fierys that lose their connection are retried by reconnector until they log in again.
+    #   Jobs are spooled while PaperCut can't be reached and recorded when it can.
+    #   Check that we still hold the claim on PaperCut every sleep_secs.
+    #
+    IngestionEngine.num_converters = options.converters
+    IngestionEngine.num_recorders = options.recorders
+    IngestionEngine.queue_size = options.pipeline_queue_size
+    IngestionEngine.read_ahead = max(1, options.read_ahead)
+    IngestionEngine.bootstrap = options.bootstrap
+    IngestionEngine.reject_retries = options.reject_retries
+    spool = JobSpool(spool_path) if spool_path else None
+    papercut.freshness = FreshnessTracker(options.lag_alert_secs)
+    engine = IngestionEngine(papercut, pool, scheduler, reconnector, options.sleep_secs, spool)
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.stop())
+
+    # Profiles of the running process are taken on demand
+    StackProfiler.secs = options.profile_secs
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.request())
+        # Don't fail the PaperCut requests made on this thread with EINTR
+        signal.siginterrupt(signal.SIGUSR1, False)
+    if options.profile_trigger:
+        PROFILER.watch(options.profile_trigger)
+    engine.run(fiery_connection_list, failed_connection_list)
+
+
+#
+# Execution starts here
+#    
+if __name__ == '__main__':
+    main()
+
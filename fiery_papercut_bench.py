@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for fiery_papercut.py
+
+    Runs against the local stand-in servers in fiery_papercut_fake.py so no Fiery or PaperCut
+    server is needed.
+
+    Usage:
+        python fiery_papercut_bench.py sessions     Per-poll latency with and without keep-alive
+        python fiery_papercut_bench.py convert      Fiery to PaperCut job conversion speed
+        python fiery_papercut_bench.py e2e [-- fiery_papercut.py options]
+                                                    Throughput, lag and RPCs per job of 
+                                                    fiery_papercut.py recording a fleet of Fierys
+"""
+from __future__ import division
+import collections
+import datetime
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+import fiery_papercut
+from fiery_papercut import FieryConnection, FieryState, JobConverter
+from fiery_papercut_fake import FakeFiery, FakePaperCut, load_job_templates, make_job
+
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fiery_papercut.py')
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name, latencies):
+    print '%-12s n=%d mean=%.2f ms p50=%.2f ms p99=%.2f ms' % (name, len(latencies),
+            1000 * sum(latencies) / len(latencies),
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99))
+
+
+def bench_sessions(options):
+    """Compare per-poll latency of a new connection per request with FieryConnection's
+        keep-alive session
+    """
+    fake_fiery = FakeFiery(num_jobs=options.num_jobs or 10)
+    try:
+        FieryConnection.set_api_key('bench')
+        FieryConnection.batch_size = options.batch_size
+        FieryConnection.drain = False
+        fiery = FieryState(fake_fiery.address, 'admin', 'password', max_id=-1)
+        fiery_connection = FieryConnection(fiery)
+        assert fiery_connection.connected, fiery_connection.failure
+
+        # Before: a module-level requests.get() per poll as fetch_jobs() used to do
+        headers = {'Cookie': '_session_id=%s;' % fiery_connection.session_cookie}
+        full_url = '%s/api/v1/cost?start_id=0&count=%d' % (fiery_connection.url,
+                   options.batch_size)
+        before = []
+        for _ in range(options.num_polls):
+            start = time.time()
+            r = requests.get(full_url, headers=headers, verify=False)
+            r.json()
+            before.append(time.time() - start)
+
+        # After: fetch_jobs() on a keep-alive session
+        after = []
+        for _ in range(options.num_polls):
+            start = time.time()
+            fiery_jobs = fiery_connection.fetch_jobs()
+            after.append(time.time() - start)
+            assert fiery_jobs is not None, fiery_connection.failure
+
+        report('new conn', before)
+        report('keep-alive', after)
+        print 'speedup=%.1fx' % (sum(before) / sum(after))
+    finally:
+        fake_fiery.close()
+
+
+#
+# The per-job conversion from before JobConverter, frozen here so that bench_convert() keeps 
+# comparing against it as fiery_papercut.py changes. convert_job() and the time conversion are 
+# unchanged apart from the handling of invalid date-times.
+#
+def original_convert_time(fiery_time):
+    """convert_time() without the fast path or cache"""
+    try:
+        tm = time.strptime(fiery_time, '%H:%M %b %d, %Y')  
+        dt = datetime.datetime(*tm[:6])
+        return dt.isoformat().replace(':', '').replace('-', '')
+    except ValueError:
+        return '11111111T111111'
+
+
+ORIGINAL_FIERY_PAPERCUT_MAP = {
+    'printer': lambda job: job['fiery'],
+    'user': lambda job: fiery_papercut.first_non_empty([job.get('username', None), 
+                            job.get('authuser', None), 'blank on Fiery']),
+    'comment': lambda job: 'Fiery id: %s' % job['id'],
+    'time': lambda job: original_convert_time(job['date']),
+    'document-name': lambda job: job['title'],
+    'document-size-kb': lambda job: int(job['size'])//1024,
+    'paper-size-name': lambda job: job['media size'],
+    'copies': lambda job: int(job['copies printed']),
+    'total-pages': lambda job: (int(job['total blank pages printed'])
+                              + int(job['total bw pages printed'])
+                              + int(job['total color pages printed'])),
+    'total-color-pages': lambda job: int(job['total color pages printed']),
+    'duplex': lambda job: fiery_papercut.convert_boolean(job['duplex printed']),
+}
+
+
+def original_convert_job(fiery_job):
+    """Convert a Fiery job to a PaperCut job"""
+    pc_job = {k:ORIGINAL_FIERY_PAPERCUT_MAP[k](fiery_job) for k in ORIGINAL_FIERY_PAPERCUT_MAP} 
+    pc_job['grayscale'] = 'TRUE' if pc_job['total-color-pages'] > 0 else 'FALSE'
+    return pc_job 
+
+
+def convert_per_job(fiery_jobs, server, account_name):
+    """Job conversion as PaperCut._record_jobs_int() used to do it, one job at a time
+        Non-printing jobs are skipped before conversion as some of them have no 'media size'
+    """
+    id_details_list = []
+    for fiery_job in fiery_jobs:
+        if ORIGINAL_FIERY_PAPERCUT_MAP['total-pages'](fiery_job) <= 0:
+            continue
+        job = original_convert_job(fiery_job)
+        job['server'] = server
+        job['shared-account'] = account_name
+        job_details = ','.join('%s=%s' % (k,v) for k,v in job.items())
+        id_details_list.append((fiery_job['id'], job_details))
+    return id_details_list
+
+
+def bench_convert(options):
+    """Compare per-job conversion through FIERY_PAPERCUT_MAP with JobConverter.convert_batch()"""
+    num_jobs = options.num_jobs or 100000
+    templates = load_job_templates()
+    # Keep only the fields that FieryConnection.fetch_jobs() keeps
+    fiery_jobs = [{k: job[k] for k in fiery_papercut.FIERY_JOB_KEYS if k in job} 
+                  for job in (make_job(templates, i) for i in range(num_jobs))]
+    server, account_name = 'localhost', 'Fiery.account'
+
+    start = time.time()
+    before = convert_per_job(fiery_jobs, server, account_name)
+    before_secs = time.time() - start
+
+    converter = JobConverter(server, account_name)
+    start = time.time()
+    after = converter.convert_batch(fiery_jobs)
+    after_secs = time.time() - start
+
+    # Both must give the same key=value pairs for the same jobs
+    assert [i for i, _ in before] == [i for i, _ in after]
+    for (_, b), (_, a) in zip(before, after):
+        assert sorted(b.split(',')) == sorted(a.split(',')), (b, a)
+
+    print '%-12s %d jobs in %.3f sec, %.0f jobs/sec' % ('per job', num_jobs, before_secs,
+            num_jobs / before_secs)
+    print '%-12s %d jobs in %.3f sec, %.0f jobs/sec' % ('batch', num_jobs, after_secs,
+            num_jobs / after_secs)
+    print 'speedup=%.1fx' % (before_secs / after_secs)
+
+
+def bench_e2e(options, script_args):
+    """Run fiery_papercut.py against a fleet of fake Fierys and a fake PaperCut server
+        script_args: Extra command line arguments for fiery_papercut.py
+
+        Each Fiery starts with num_jobs jobs and prints job_rate more per second for secs 
+        seconds. Once the Fierys stop printing, fiery_papercut.py is given drain_secs to record
+        everything before it is stopped.
+        Lag is the time from a job finishing printing to it being recorded on PaperCut.
+    """
+    templates = load_job_templates()
+    total_pages = fiery_papercut.FIERY_PAPERCUT_MAP['total-pages']
+    # PaperCut doesn't log non-printing jobs
+    printing = [total_pages(job) > 0 for job in templates]
+
+    papercut = FakePaperCut(latency=options.papercut_latency)
+    fakes = [FakeFiery(num_jobs=options.num_jobs or 0, rate=options.job_rate, 
+                       latency=options.fiery_latency, error_rate=options.fiery_error_rate, 
+                       name='Fake-%03d' % i) 
+             for i in range(options.num_fierys)]
+    fiery_of = {fake.name: fake for fake in fakes}
+    work_dir = tempfile.mkdtemp()
+    try:
+        key_path = os.path.join(work_dir, 'fiery.api.key')
+        with open(key_path, 'wb') as f:
+            f.write('bench')
+        csv_path = os.path.join(work_dir, 'fierys.csv')
+        with open(csv_path, 'wb') as f:
+            for fake in fakes:
+                f.write('%s,admin,password\n' % fake.address)
+
+        args = [sys.executable, SCRIPT_PATH, '-o', str(papercut.port), '-K', key_path, 
+                '-L', csv_path, '-t', '1'] + script_args
+        with open(os.path.join(work_dir, 'out.txt'), 'wb') as out:
+            start = time.time()
+            for fake in fakes:
+                # Start printing when fiery_papercut.py starts, not when the fake was created
+                fake.start_time = start
+            process = subprocess.Popen(args, cwd=work_dir, stdout=out, stderr=subprocess.STDOUT)
+            try:
+                time.sleep(options.secs)
+                for fake in fakes:
+                    fake.pause()
+                num_expected = sum(printing[i % len(printing)] 
+                                   for fake in fakes for i in range(fake.num_printed()))
+                complete = papercut.wait_for_jobs(num_expected, options.drain_secs)
+            finally:
+                if process.poll() is None:
+                    process.terminate()
+                process.wait()
+
+        jobs = list(papercut.jobs)
+        counts = papercut.counts
+        recorded = collections.Counter((printer, job_id) for _, printer, job_id in jobs)
+        lags = [t - fiery_of[printer].print_time(job_id) for t, printer, job_id in jobs]
+        secs = max(t for t, _, _ in jobs) - start if jobs else 0.0
+        fiery_requests = sum(fake.counts['cost'] for fake in fakes)
+        fiery_errors = sum(fake.counts['errors'] for fake in fakes)
+        num_jobs = max(1, len(recorded))
+
+        print '%-12s fierys=%d jobs=%d in %.1f sec, %.0f jobs/sec, exit code=%s' % ('e2e', 
+                len(fakes), len(recorded), secs, len(recorded) / max(secs, 1e-3), 
+                process.returncode)
+        if lags:
+            report('lag', lags)
+        print '%-12s PaperCut: %.3f requests/job, %.3f processJob calls/job, %d config calls' % (
+                'rpcs', counts['requests'] / num_jobs, counts['api.processJob'] / num_jobs,
+                counts['api.getConfigValue'] + counts['api.setConfigValue'])
+        print '%-12s Fiery: %.3f cost requests/job, %d failed, %d logins' % ('', 
+                fiery_requests / num_jobs, fiery_errors, 
+                sum(fake.counts['login'] for fake in fakes))
+        print '%-12s expected=%d missing=%d recorded twice=%d' % ('check', num_expected, 
+                num_expected - len(recorded), len(jobs) - len(recorded))
+        if not complete:
+            print 'Not all jobs were recorded. See the log in %s' % work_dir
+            work_dir = None
+    finally:
+        for fake in fakes:
+            fake.close()
+        papercut.close()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'sessions': bench_sessions,
+    'convert': bench_convert,
+    'e2e': bench_e2e,
+}
+
+
+def main():
+    parser = optparse.OptionParser('python %s [options] %s' % (sys.argv[0],
+                                   '|'.join(sorted(BENCHMARKS))))
+    parser.add_option('-n', '--num-polls', dest='num_polls', type='int', default=200,
+            help='Number of Fiery polls to time')
+    parser.add_option('-j', '--num-jobs', dest='num_jobs', type='int', default=None,
+            help='Number of jobs on each fake Fiery or to convert')
+    parser.add_option('-B', '--batch-size', dest='batch_size', type='int', default=10,
+            help='Number of jobs to request in each call to Fiery')
+    parser.add_option('-f', '--fierys', dest='num_fierys', type='int', default=10,
+            help='e2e: Number of fake Fierys')
+    parser.add_option('-r', '--job-rate', dest='job_rate', type='float', default=2.0,
+            help='e2e: Number of jobs each Fiery prints per second')
+    parser.add_option('-s', '--secs', dest='secs', type='float', default=30.0,
+            help='e2e: Number of seconds the Fierys print for')
+    parser.add_option('--drain-secs', dest='drain_secs', type='float', default=60.0,
+            help='e2e: Maximum time to wait for the jobs to be recorded after printing stops')
+    parser.add_option('--fiery-latency', dest='fiery_latency', type='float', default=0.0,
+            help='e2e: Seconds added to each Fiery cost API response')
+    parser.add_option('--fiery-error-rate', dest='fiery_error_rate', type='float', default=0.0,
+            help='e2e: Fraction of Fiery cost API requests that fail')
+    parser.add_option('--papercut-latency', dest='papercut_latency', type='float', default=0.0,
+            help='e2e: Seconds added to each PaperCut XML-RPC response')
+    options, args = parser.parse_args()
+
+    if not args or args[0] not in BENCHMARKS or (len(args) > 1 and args[0] != 'e2e'):
+        parser.print_help()
+        sys.exit(fiery_papercut.EXIT_BAD_ARG)
+
+    requests.packages.urllib3.disable_warnings()
+    if args[0] == 'e2e':
+        # Arguments after -- are passed on to fiery_papercut.py
+        bench_e2e(options, args[1:])
+    else:
+        BENCHMARKS[args[0]](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+    Local stand-ins for the servers that fiery_papercut.py talks to.
+
+    Used by fiery_papercut_bench.py and fiery_papercut_unittest.py to measure and test 
+    fiery_papercut.py without Fiery hardware or a PaperCut server.
+
+    FakeFiery serves the Fiery cost accounting API over HTTPS with a self-signed certificate.
+    Its jobs are copies of the jobs in costoutput.json with new ids. It can print new jobs at a 
+    steady rate, respond slowly and fail some requests.
+
+    FakePaperCut serves the parts of the PaperCut XML-RPC API that fiery_papercut.py uses, 
+    including system.multicall. It keeps the recorded jobs and config values in memory and 
+    counts the requests made to it.
+"""
+from __future__ import division
+import BaseHTTPServer
+import collections
+import copy
+import json
+import os
+import random
+import re
+import shutil
+import SimpleXMLRPCServer
+import SocketServer
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urlparse
+import xmlrpclib
+
+
+COST_OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'costoutput.json')
+
+
+def load_job_templates(path=COST_OUTPUT_PATH):
+    """Load the list of example Fiery jobs in path"""
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def make_job(templates, job_id):
+    """Return a Fiery job with id job_id shaped like one of the jobs in templates"""
+    job = copy.deepcopy(templates[job_id % len(templates)])
+    job['id'] = job_id
+    return job
+
+
+def make_certificate(cert_dir):
+    """Create a self-signed certificate for localhost in cert_dir
+        Returns: (certificate path, private key path)
+    """
+    cert_path = os.path.join(cert_dir, 'fake.crt')
+    key_path = os.path.join(cert_dir, 'fake.key')
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-keyout', key_path, '-out', cert_path, '-days', '1',
+                               '-subj', '/CN=localhost'],
+                              stdout=devnull, stderr=devnull)
+    return cert_path, key_path
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that drop connections without a TLS close_notify are expected
+        pass
+
+
+class FakeFieryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the /live/login and /live/api/v1/cost Fiery API calls"""
+
+    # HTTP/1.1 so that clients can keep their connections alive
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, code, body, headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fiery = self.server.fiery
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        fiery.count('login')
+        if self.path != '/live/login':
+            self.send_body(404, '{}')
+            return
+        session_id = fiery.new_session()
+        self.send_body(200, '{}', {'Set-Cookie': '_session_id=%s; path=/' % session_id})
+
+    def do_GET(self):
+        fiery = self.server.fiery
+        fiery.count('cost')
+        if fiery.latency:
+            time.sleep(fiery.latency)
+        if random.random() < fiery.error_rate:
+            fiery.count('errors')
+            self.send_body(500, '{}')
+            return
+        url = urlparse.urlparse(self.path)
+        if url.path != '/live/api/v1/cost':
+            self.send_body(404, '{}')
+            return
+        m = re.search('_session_id=([^ ;]+)', self.headers.getheader('Cookie') or '')
+        if not m or not fiery.has_session(m.group(1)):
+            self.send_body(401, '{}')
+            return
+        query = urlparse.parse_qs(url.query)
+        start_id = int(query['start_id'][0])
+        count = int(query['count'][0])
+        self.send_body(200, json.dumps(fiery.get_jobs(start_id, count)))
+
+
+class FakeFiery:
+    """A Fiery cost accounting API server running on a background thread
+            num_jobs: Number of jobs the Fiery has printed when it starts
+            rate: Number of new jobs printed per second after it starts
+            latency: Seconds added to the response time of each cost API request
+            error_rate: Fraction of cost API requests that fail with HTTP code 500
+            name: Fiery name in the jobs, which PaperCut records as the printer. 
+                Defaults to the address
+            address: host:port to use as the Fiery ip in FieryState
+        Jobs printed before the Fiery starts are timestamped with the start time.
+    """
+
+    def __init__(self, num_jobs=0, port=0, rate=0.0, latency=0.0, error_rate=0.0, name=None):
+        self.templates = load_job_templates()
+        self.num_jobs = num_jobs
+        self.rate = rate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.start_time = time.time()
+        # Time the Fiery stopped printing or None if it is still printing
+        self.stop_time = None
+        self.sessions = set()
+        # Number of each kind of request: 'login', 'cost' and 'errors'
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.cert_dir = tempfile.mkdtemp()
+        cert_path, key_path = make_certificate(self.cert_dir)
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), FakeFieryHandler)
+        self.httpd.socket = ssl.wrap_socket(self.httpd.socket, certfile=cert_path,
+                                            keyfile=key_path, server_side=True)
+        self.httpd.fiery = self
+        self.address = '127.0.0.1:%d' % self.httpd.server_address[1]
+        self.name = name or self.address
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_session(self):
+        session_id = os.urandom(8).encode('hex')
+        with self.lock:
+            self.sessions.add(session_id)
+        return session_id
+
+    def has_session(self, session_id):
+        with self.lock:
+            return session_id in self.sessions
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def num_printed(self, now=None):
+        """Returns: Number of jobs printed so far"""
+        now = now if now is not None else time.time()
+        if self.stop_time is not None:
+            now = min(now, self.stop_time)
+        return self.num_jobs + int(max(0.0, now - self.start_time) * self.rate)
+
+    def print_time(self, job_id):
+        """Returns: Time that job job_id finished printing"""
+        if job_id < self.num_jobs or not self.rate:
+            return self.start_time
+        return self.start_time + (job_id - self.num_jobs + 1) / self.rate
+
+    def pause(self):
+        """Stop printing new jobs"""
+        self.stop_time = time.time()
+
+    def get_jobs(self, start_id, count):
+        """Return the printed jobs with ids start_id, start_id + 1, ... up to count jobs"""
+        end_id = min(start_id + count, self.num_printed())
+        jobs = []
+        for i in range(start_id, end_id):
+            job = make_job(self.templates, i)
+            job['fiery'] = self.name
+            printed = self.print_time(i)
+            job['timestamp done printing'] = '%d:%06d' % (int(printed), 
+                                                          int(printed % 1 * 1000000))
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.cert_dir, ignore_errors=True)
+
+
+class FakePaperCutHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """Serves the PaperCut XML-RPC API path and counts HTTP requests"""
+
+    rpc_paths = ('/rpc/api/xmlrpc',)
+    # HTTP/1.1 so that clients can keep their connections alive
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        papercut = self.server.papercut
+        papercut.count('requests')
+        if papercut.latency:
+            time.sleep(papercut.latency)
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class FakePaperCutServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def _dispatch(self, method, params):
+        # Called for each call in a system.multicall too
+        self.papercut.count(method)
+        return SimpleXMLRPCServer.SimpleXMLRPCServer._dispatch(self, method, params)
+
+
+class FakePaperCut:
+    """A PaperCut XML-RPC API server running on a background thread
+            port: Port to listen on. 0 for any free port
+            latency: Seconds added to the response time of each HTTP request
+            jobs: list of (time recorded, printer, Fiery id) of the jobs recorded by processJob
+            config: {name: value} of the PaperCut config values
+            counts: Number of HTTP 'requests' and number of calls of each API method
+    """
+
+    def __init__(self, port=0, latency=0.0):
+        self.latency = latency
+        self.jobs = []
+        self.config = {}
+        self.accounts = set()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.recorded = threading.Condition(self.lock)
+        self.server = FakePaperCutServer(('127.0.0.1', port), FakePaperCutHandler, 
+                                         logRequests=False, allow_none=True)
+        self.server.papercut = self
+        self.server.register_multicall_functions()
+        for name in ['processJob', 'getConfigValue', 'setConfigValue', 'isSharedAccountExists', 
+                     'addNewSharedAccount']:
+            self.server.register_function(getattr(self, name), 'api.%s' % name)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def processJob(self, auth_token, job_details):
+        # The comment can come before the printer, so look for each separately
+        printer = re.search(r'(?:^|,)printer=([^,]*)', job_details)
+        comment = re.search(r'(?:^|,)comment=Fiery id: (\d+)', job_details)
+        if not printer or not comment:
+            raise xmlrpclib.Fault(1, 'Invalid job details: %s' % job_details)
+        with self.lock:
+            self.jobs.append((time.time(), printer.group(1), int(comment.group(1))))
+            self.recorded.notify_all()
+        return True
+
+    def getConfigValue(self, auth_token, name):
+        with self.lock:
+            return self.config.get(name, '')
+
+    def setConfigValue(self, auth_token, name, value):
+        with self.lock:
+            self.config[name] = value
+        return True
+
+    def isSharedAccountExists(self, auth_token, account_name):
+        with self.lock:
+            return account_name in self.accounts
+
+    def addNewSharedAccount(self, auth_token, account_name):
+        with self.lock:
+            self.accounts.add(account_name)
+        return True
+
+    def wait_for_jobs(self, num_jobs, timeout):
+        """Wait until num_jobs jobs have been recorded or timeout seconds have passed
+            Returns: True if num_jobs jobs were recorded
+        """
+        end_time = time.time() + timeout
+        with self.lock:
+            while len(self.jobs) < num_jobs:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                self.recorded.wait(min(remaining, 1.0))
+            return True
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,584 @@
+# -*- coding: utf-8 -*-
+"""
+    Unit tests for fiery_papercut.py
+
+    Runs against temporary directories and the local stand-in PaperCut server in
+    fiery_papercut_fake.py so no Fiery or PaperCut server is needed.
+    (fiery_papercut_test.py is a manual test against real hardware.)
+
+    Usage:
+        python fiery_papercut_unittest.py [-v] [TestCase[.test_method] ...]
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+import fiery_papercut
+from fiery_papercut import (FieryJournal, FieryState, FieryStateStore, IdRanges, JobSpool,
+                            PaperCut, iter_json_list)
+from fiery_papercut_fake import FakePaperCut
+
+
+# fiery_papercut logs through the root logger. Keep the expected errors out of the test output
+logging.getLogger().addHandler(logging.NullHandler())
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Runs each test in a new temporary directory, self.dir"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='fiery_papercut_unittest.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+#
+# iter_json_list
+#
+def chunked(text, size):
+    """Returns: text split into chunks of size characters"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class IterJsonListTest(unittest.TestCase):
+
+    def test_elements_in_any_chunking(self):
+        elements = [1, -2.5e3, 'a "quoted", [bracketed] string\\', {'a': [1, {'b': '}]'}]},
+                    [], {}, None, True, False, u'é']
+        text = json.dumps(elements)
+        for size in (1, 2, 3, 7, len(text)):
+            self.assertEqual(list(iter_json_list(chunked(text, size))), elements, size)
+
+    def test_empty_list(self):
+        for text in ('[]', ' [ ] ', '\n[\n]\n'):
+            self.assertEqual(list(iter_json_list(chunked(text, 1))), [])
+
+    def test_number_split_across_chunks(self):
+        self.assertEqual(list(iter_json_list(['[12', '34, 5', '6]'])), [1234, 56])
+
+    def test_not_a_list(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_list(['{"a": 1}']))
+
+    def test_truncated(self):
+        for text in ('', '[', '[1, 2', '[1, 2,', '[{"a": 1', '["abc'):
+            with self.assertRaises(ValueError):
+                list(iter_json_list(chunked(text, 2)))
+
+    def test_missing_comma(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_list(['[1 2]']))
+
+    def test_trailing_comma(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_list(['[1, ]']))
+
+    def test_malformed_element(self):
+        for text in ('[{"a": }]', '[1, {"a" 1}, 2]', '[tru]', '[1, nul, 2]', '[{"a": 1]}]'):
+            with self.assertRaises(ValueError):
+                list(iter_json_list(chunked(text, 3)))
+
+    def test_malformed_element_reported_straight_away(self):
+        """The elements before a malformed element are yielded and the error is raised without
+            reading the chunks after the element
+        """
+        read = []
+        def chunks():
+            for chunk in ['[1, 2, {"a": ', '}, ', '3', ', 4]']:
+                read.append(chunk)
+                yield chunk
+        elements = iter_json_list(chunks())
+        self.assertEqual([next(elements), next(elements)], [1, 2])
+        with self.assertRaises(ValueError):
+            next(elements)
+        self.assertEqual(len(read), 2)
+
+
+#
+# IdRanges
+#
+class IdRangesTest(unittest.TestCase):
+
+    def test_add_merges_overlapping_and_touching_ranges(self):
+        ids = IdRanges()
+        ids.add_range(10, 12)
+        ids.add_range(20, 20)
+        ids.add_range(1, 3)
+        self.assertEqual(ids.ranges(), [[1, 3], [10, 12], [20, 20]])
+        ids.add_range(13, 14)
+        self.assertEqual(ids.ranges(), [[1, 3], [10, 14], [20, 20]])
+        ids.add_range(4, 19)
+        self.assertEqual(ids.ranges(), [[1, 20]])
+        ids.add_range(5, 6)
+        self.assertEqual(ids.ranges(), [[1, 20]])
+        self.assertEqual(len(ids), 1)
+
+    def test_contains(self):
+        ids = IdRanges([[1, 3], [10, 12]])
+        self.assertEqual([i for i in range(15) if i in ids], [1, 2, 3, 10, 11, 12])
+        self.assertNotIn(5, IdRanges())
+
+    def test_discard_to(self):
+        ids = IdRanges([[1, 3], [10, 12], [20, 25]])
+        ids.discard_to(2)
+        self.assertEqual(ids.ranges(), [[3, 3], [10, 12], [20, 25]])
+        ids.discard_to(11)
+        self.assertEqual(ids.ranges(), [[12, 12], [20, 25]])
+        ids.discard_to(15)
+        self.assertEqual(ids.ranges(), [[20, 25]])
+        ids.discard_to(25)
+        self.assertEqual(ids.ranges(), [])
+        self.assertEqual(len(ids), 0)
+
+    def test_id_ranges(self):
+        self.assertEqual(fiery_papercut.id_ranges([5, 1, 2, 3, 7, 8, 3]),
+                         [[1, 3], [5, 5], [7, 8]])
+        self.assertEqual(fiery_papercut.id_ranges([]), [])
+
+
+#
+# FieryJournal
+#
+class FieryJournalTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.journal_path = self.path('papercut.fiery.journal')
+
+    def reopen(self, **kwargs):
+        return FieryJournal(self.journal_path, **kwargs)
+
+    def restored(self, journal, ip):
+        """Returns: (FieryState of ip restored from journal, uncertain ids)"""
+        fiery = FieryState(ip=ip)
+        uncertain = journal.restore(fiery)
+        return fiery, uncertain
+
+    def num_lines(self):
+        with open(self.journal_path, 'rb') as f:
+            return len(f.readlines())
+
+    def test_replay_of_saved_state(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10))
+        journal.save(FieryState(ip='b', max_id=5))
+        journal.save(FieryState(ip='a', max_id=20))
+        fiery, uncertain = self.restored(self.reopen(), 'a')
+        self.assertEqual((fiery.max_id, fiery.pending_max_id, uncertain), (20, None, None))
+        fiery, _ = self.restored(self.reopen(), 'b')
+        self.assertEqual(fiery.max_id, 5)
+        fiery, _ = self.restored(self.reopen(), 'c')
+        self.assertEqual(fiery.max_id, None)
+
+    def test_restore_of_interrupted_recording(self):
+        """Pending jobs after the last commit are recorded again, skipping the recorded ones"""
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10, pending_max_id=30))
+        journal.sending('a', 11, 15)
+        journal.record('a', [11, 12, 13, 14, 15], commit_id=15, sending=(16, 20))
+        journal.record('a', [16, 18], sending=None)
+
+        journal = self.reopen()
+        fiery, uncertain = self.restored(journal, 'a')
+        self.assertEqual((fiery.max_id, fiery.pending_max_id, uncertain), (15, None, None))
+        self.assertEqual([i for i in range(10, 22) if journal.is_recorded('a', i)],
+                         [11, 12, 13, 14, 15, 16, 18])
+
+    def test_saved_state_drops_recorded_ids_below_max_id(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10, pending_max_id=20))
+        journal.record('a', [11, 12, 15])
+        journal.save(FieryState(ip='a', max_id=12))
+        for journal in (journal, self.reopen()):
+            self.assertFalse(journal.is_recorded('a', 11))
+            self.assertTrue(journal.is_recorded('a', 15))
+
+    def test_batch_being_sent_is_replayed_as_uncertain(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10, pending_max_id=30))
+        journal.sending('a', 11, 15)
+        journal.record('a', range(11, 16), commit_id=15, sending=(16, 20))
+        # Killed while sending 16 to 20
+
+        journal = self.reopen()
+        fiery, uncertain = self.restored(journal, 'a')
+        self.assertEqual(uncertain, [16, 20])
+        self.assertEqual((fiery.max_id, fiery.pending_max_id), (15, 20))
+
+    def test_finished_batch_is_not_uncertain(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10, pending_max_id=15))
+        journal.sending('a', 11, 15)
+        journal.record('a', range(11, 16), commit_id=15)
+        journal.save(FieryState(ip='a', max_id=15))
+        fiery, uncertain = self.restored(self.reopen(), 'a')
+        self.assertEqual((fiery.max_id, uncertain), (15, None))
+
+    def test_held_batch_stays_uncertain(self):
+        """A held Fiery stays uncertain across restarts and compactions until its state is
+            saved with no pending jobs
+        """
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10, pending_max_id=30))
+        journal.hold(FieryState(ip='a', max_id=12, pending_max_id=20), 13, 20)
+        for _ in range(2):
+            journal = self.reopen()
+            fiery, uncertain = self.restored(journal, 'a')
+            self.assertEqual(uncertain, [13, 20])
+            self.assertEqual((fiery.max_id, fiery.pending_max_id), (12, 20))
+            # The restored state is saved again when the script starts
+            journal.save(fiery)
+
+        # Resolved: jobs up to 16 were recorded
+        journal.save(FieryState(ip='a', max_id=16))
+        fiery, uncertain = self.restored(self.reopen(), 'a')
+        self.assertEqual((fiery.max_id, fiery.pending_max_id, uncertain), (16, None, None))
+
+    def test_compaction_keeps_state(self):
+        journal = self.reopen(max_lines=20)
+        for max_id in range(0, 100, 10):
+            journal.save(FieryState(ip='a', max_id=max_id))
+        journal.save(FieryState(ip='b', max_id=0, pending_max_id=50))
+        journal.record('b', [1, 2, 3, 7], commit_id=3)
+        journal.hold(FieryState(ip='c', max_id=5, pending_max_id=9), 6, 9)
+        journal.save(FieryState(ip='d', max_id=0, pending_max_id=9))
+        journal.sending('d', 1, 9)
+        for _ in range(30):
+            journal.save(FieryState(ip='e', max_id=1))
+        self.assertLessEqual(self.num_lines(), 20)
+
+        journal = self.reopen(max_lines=20)
+        fiery, uncertain = self.restored(journal, 'a')
+        self.assertEqual((fiery.max_id, uncertain), (90, None))
+        fiery, uncertain = self.restored(journal, 'b')
+        self.assertEqual((fiery.max_id, uncertain), (3, None))
+        self.assertTrue(journal.is_recorded('b', 7))
+        self.assertFalse(journal.is_recorded('b', 5))
+        fiery, uncertain = self.restored(journal, 'c')
+        self.assertEqual((fiery.max_id, uncertain), (5, [6, 9]))
+        fiery, uncertain = self.restored(journal, 'd')
+        self.assertEqual((fiery.max_id, uncertain), (0, [1, 9]))
+        # Opening a journal compacts it to a line for each Fiery state, commit, index, held batch
+        # and batch being sent
+        self.assertEqual(self.num_lines(), 9)
+
+    def test_torn_last_line_is_ignored(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10))
+        with open(self.journal_path, 'ab') as f:
+            f.write('["state", "a", 2')
+        fiery, _ = self.restored(self.reopen(), 'a')
+        self.assertEqual(fiery.max_id, 10)
+
+    def test_absorb(self):
+        journal = self.reopen()
+        journal.save(FieryState(ip='a', max_id=10))
+        shard_path = self.path('shard.journal')
+        shard = FieryJournal(shard_path)
+        shard.save(FieryState(ip='b', max_id=0, pending_max_id=20))
+        shard.record('b', [1, 2, 5], commit_id=2)
+        shard.hold(FieryState(ip='c', max_id=3, pending_max_id=8), 4, 8)
+
+        journal.absorb(shard_path)
+        self.assertFalse(os.path.exists(shard_path))
+        journal = self.reopen()
+        self.assertEqual(self.restored(journal, 'a')[0].max_id, 10)
+        self.assertEqual(self.restored(journal, 'b')[0].max_id, 2)
+        self.assertTrue(journal.is_recorded('b', 5))
+        self.assertEqual(self.restored(journal, 'c')[1], [4, 8])
+
+
+#
+# JobSpool
+#
+def jobs(job_ids):
+    return [{'id': job_id, 'timestamp done printing': '%d:0' % job_id} for job_id in job_ids]
+
+
+def id_details(job_ids):
+    return [[job_id, 'comment=Fiery id: %d' % job_id] for job_id in job_ids]
+
+
+class JobSpoolTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.spool_path = self.path('papercut.fiery.spool')
+
+    def drain(self, spool):
+        """Returns: [(ip, job ids, id_details_list)] of all the pages taken from spool"""
+        pages = []
+        while True:
+            page = spool.peek()
+            if page is None:
+                return pages
+            ip, fiery_job_list, id_details_list = page
+            pages.append((ip, [job['id'] for job in fiery_job_list], id_details_list))
+            spool.pop()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.spool_path) if name.endswith('.seg'))
+
+    def test_pages_are_taken_in_order(self):
+        spool = JobSpool(self.spool_path)
+        spool.append('a', jobs([1, 2]), id_details([1]))
+        spool.append('b', jobs([7]), id_details([7]))
+        spool.append('a', jobs([3]), id_details([3]))
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(spool.next_id('a'), 4)
+        self.assertEqual(spool.next_id('c'), None)
+        ip, fiery_job_list, _ = spool.peek()
+        self.assertEqual(fiery_job_list, jobs([1, 2]))
+        self.assertEqual(self.drain(spool), [('a', [1, 2], id_details([1])),
+                                             ('b', [7], id_details([7])),
+                                             ('a', [3], id_details([3]))])
+        self.assertEqual(spool.next_id('a'), None)
+        self.assertEqual(self.segments(), [])
+
+    def test_replay(self):
+        # Two pages per segment
+        spool = JobSpool(self.spool_path, segment_bytes=100)
+        for job_id in range(10):
+            spool.append('a', jobs([job_id]), id_details([job_id]))
+        for _ in range(3):
+            spool.pop()
+        spool.close()
+        self.assertEqual(len(self.segments()), 4)
+
+        # Only the position of the first page in the spool is lost so the pages taken from 
+        # the first segment that is still in use are replayed
+        spool = JobSpool(self.spool_path, segment_bytes=100)
+        self.assertEqual(len(spool), 8)
+        self.assertEqual(spool.next_id('a'), 10)
+        spool.append('a', jobs([10]), id_details([10]))
+        self.assertEqual([job_ids for _, job_ids, _ in self.drain(spool)],
+                         [[job_id] for job_id in range(2, 11)])
+        spool.close()
+        self.assertEqual(len(JobSpool(self.spool_path)), 0)
+
+    def test_replay_skips_torn_and_corrupted_lines(self):
+        spool = JobSpool(self.spool_path)
+        spool.append('a', jobs([1]), id_details([1]))
+        spool.append('a', jobs([2]), id_details([2]))
+        spool.close()
+        segment_path = os.path.join(self.spool_path, self.segments()[0])
+        with open(segment_path, 'rb') as f:
+            lines = f.readlines()
+        with open(segment_path, 'wb') as f:
+            # A bit flip in the first page and a torn page after the last one
+            f.write(lines[0].replace('Fiery id: 1', 'Fiery id: 9'))
+            f.write(lines[1])
+            f.write(lines[1][:len(lines[1]) // 2])
+
+        spool = JobSpool(self.spool_path)
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(self.drain(spool), [('a', [2], id_details([2]))])
+
+    def test_replay_of_pages_without_print_times(self):
+        os.makedirs(self.spool_path)
+        payload = json.dumps(['a', [1, 2], id_details([1])])
+        with open(os.path.join(self.spool_path, '00000000.seg'), 'wb') as f:
+            f.write('%08x %s\n' % (zlib.crc32(payload) & 0xffffffff, payload))
+        spool = JobSpool(self.spool_path)
+        _, fiery_job_list, _ = spool.peek()
+        self.assertEqual([job.get('timestamp done printing') for job in fiery_job_list],
+                         [None, None])
+
+    def test_discard(self):
+        spool = JobSpool(self.spool_path)
+        spool.append('a', jobs([1]), id_details([1]))
+        spool.append('b', jobs([5]), id_details([5]))
+        spool.append('a', jobs([2]), id_details([2]))
+        spool.discard('a')
+        spool.append('a', jobs([1]), id_details([1]))
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(spool.next_id('a'), 2)
+        spool.close()
+
+        # The discarded pages stay discarded when the spool is replayed
+        spool = JobSpool(self.spool_path)
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(self.drain(spool), [('b', [5], id_details([5])),
+                                             ('a', [1], id_details([1]))])
+        self.assertEqual(self.segments(), [])
+
+    def test_append_if_spooling(self):
+        spool = JobSpool(self.spool_path)
+        self.assertFalse(spool.append_if_spooling('a', jobs([1]), id_details([1])))
+        spool.offline = True
+        self.assertTrue(spool.append_if_spooling('a', jobs([1]), id_details([1])))
+        spool.offline = False
+        # Later pages from a Fiery with spooled pages are spooled so its jobs stay in order
+        self.assertTrue(spool.append_if_spooling('a', jobs([2]), id_details([2])))
+        self.assertFalse(spool.append_if_spooling('b', jobs([1]), id_details([1])))
+        self.assertEqual(len(spool), 2)
+
+
+#
+# PaperCut and FieryStateStore against FakePaperCut
+#
+class FakePaperCutTestCase(unittest.TestCase):
+    """Runs each test against a new FakePaperCut, self.fake"""
+
+    def setUp(self):
+        self.saved = {(cls, name): getattr(cls, name) for cls, name in [
+                      (PaperCut, 'claim_ttl'), (PaperCut, 'claim_confirm_secs'),
+                      (FieryStateStore, 'chunk_size'), (FieryStateStore, 'num_groups')]}
+        self.fake = FakePaperCut()
+        self.papercuts = []
+
+    def tearDown(self):
+        for papercut in self.papercuts:
+            papercut.release_claim()
+            papercut.server.close()
+        self.fake.close()
+        for (cls, name), value in self.saved.items():
+            setattr(cls, name, value)
+
+    def connect(self, claim=True, wait_for_claim=True):
+        papercut = PaperCut('127.0.0.1', self.fake.port, 'password', 'Fiery.account',
+                            claim=claim, wait_for_claim=wait_for_claim)
+        self.papercuts.append(papercut)
+        return papercut
+
+    def config(self, key):
+        return self.fake.getConfigValue(None, key)
+
+    def num_sets(self):
+        return self.fake.counts['api.setConfigValue']
+
+
+class ClaimTest(FakePaperCutTestCase):
+
+    def test_parse_claim(self):
+        self.assertEqual(PaperCut.parse_claim(''), (None, None))
+        self.assertEqual(PaperCut.parse_claim(None), (None, None))
+        self.assertEqual(PaperCut.parse_claim('abc+/=:1234.500'), ('abc+/=', 1234.5))
+        # Claims by older versions of this script have no expiry
+        self.assertEqual(PaperCut.parse_claim('abc+/='), ('abc+/=', None))
+        self.assertEqual(PaperCut.parse_claim('abc:def'), ('abc:def', None))
+
+    def test_claim_and_release(self):
+        papercut = self.connect()
+        uid, expiry = PaperCut.parse_claim(self.config(PaperCut.FIERY_CLAIM))
+        self.assertEqual(uid, papercut.uid)
+        self.assertAlmostEqual(expiry, time.time() + PaperCut.claim_ttl, delta=5)
+        papercut.release_claim()
+        self.assertEqual(self.config(PaperCut.FIERY_CLAIM), '')
+
+    def test_standby_takes_over_expired_lease(self):
+        PaperCut.claim_ttl = 1
+        PaperCut.claim_confirm_secs = 0.1
+        active = self.connect()
+        # The active instance dies without releasing its claim
+        active.renewer.stop()
+        active.claiming = False
+
+        start = time.time()
+        standby = self.connect()
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertEqual(standby.read_claim()[0], standby.uid)
+        self.assertFalse(active.renew_claim())
+
+    def test_standby_takes_over_released_claim_straight_away(self):
+        PaperCut.claim_ttl = 60
+        PaperCut.claim_confirm_secs = 0.1
+        active = self.connect()
+        active.release_claim()
+        start = time.time()
+        standby = self.connect()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(standby.read_claim()[0], standby.uid)
+
+    def test_claim_from_older_version_is_taken_over(self):
+        PaperCut.claim_confirm_secs = 0.1
+        self.fake.setConfigValue(None, PaperCut.FIERY_CLAIM, 'olduid')
+        papercut = self.connect()
+        self.assertEqual(papercut.read_claim()[0], papercut.uid)
+
+    def test_command_does_not_wait_for_claim(self):
+        self.connect()
+        with self.assertRaises(SystemExit) as context:
+            self.connect(wait_for_claim=False)
+        self.assertEqual(context.exception.code, fiery_papercut.EXIT_MULTIPLE_INSTANCE)
+
+    def test_view_does_not_claim(self):
+        active = self.connect()
+        self.connect(claim=False)
+        self.assertEqual(active.read_claim()[0], active.uid)
+
+
+class FieryStateStoreTest(FakePaperCutTestCase):
+
+    def fierys(self, n):
+        return [FieryState('10.0.0.%d' % i, 'admin', 'pw', max_id=i) for i in range(n)]
+
+    def test_legacy_states_are_migrated(self):
+        fiery_ips = ['10.0.0.1', '10.0.0.2']
+        self.fake.setConfigValue(None, PaperCut.FIERY_LIST, repr(fiery_ips))
+        for i, ip in enumerate(fiery_ips):
+            self.fake.setConfigValue(None, PaperCut.config_key(ip),
+                                     repr({'username': 'admin', 'password': 'pw', 'max_id': i}))
+        store = FieryStateStore(self.connect(claim=False))
+        self.assertEqual(store.ips(), fiery_ips)
+        self.assertEqual(store.get('10.0.0.2'), {'username': 'admin', 'password': 'pw',
+                                                 'max_id': 1})
+
+        store.save([FieryState('10.0.0.1', 'admin', 'pw', max_id=7)])
+        self.assertEqual(json.loads(self.config(PaperCut.FIERY_STATE)),
+                         {'generation': 0, 'chunks': 1})
+        store = FieryStateStore(self.connect(claim=False))
+        self.assertEqual(store.ips(), fiery_ips)
+        self.assertEqual(store.get('10.0.0.1')['max_id'], 7)
+        self.assertEqual(store.get('10.0.0.2')['max_id'], 1)
+
+    def test_chunks(self):
+        FieryStateStore.chunk_size = 2
+        FieryStateStore.num_groups = 2
+        store = FieryStateStore(self.connect(claim=False))
+        fiery_list = self.fierys(5)
+        store.save_list(fiery_list)
+        # 5 Fierys in chunks of 2 need 3 chunks, rounded up to a multiple of num_groups
+        self.assertEqual(json.loads(self.config(PaperCut.FIERY_STATE)),
+                         {'generation': 0, 'chunks': 4})
+        for i in range(4):
+            chunk = json.loads(self.config(FieryStateStore.chunk_key(0, i)))
+            self.assertLessEqual(len(chunk), 2)
+
+        # Saving a Fiery rewrites only its chunk, and only if its state changed
+        num_sets = self.num_sets()
+        fiery_list[3].max_id = 100
+        store.save([fiery_list[3]])
+        self.assertEqual(self.num_sets(), num_sets + 1)
+        store.save([fiery_list[3]])
+        self.assertEqual(self.num_sets(), num_sets + 1)
+
+        store = FieryStateStore(self.connect(claim=False))
+        self.assertEqual(store.ips(), sorted(fiery.ip for fiery in fiery_list))
+        self.assertEqual(store.get(fiery_list[3].ip)['max_id'], 100)
+
+    def test_new_fiery_starts_new_generation(self):
+        FieryStateStore.chunk_size = 2
+        store = FieryStateStore(self.connect(claim=False))
+        fiery_list = self.fierys(3)
+        store.save_list(fiery_list[:2])
+        store.save(fiery_list[2:])
+        self.assertEqual(json.loads(self.config(PaperCut.FIERY_STATE)),
+                         {'generation': 1, 'chunks': 2})
+        # The old generation's chunk is emptied
+        self.assertEqual(self.config(FieryStateStore.chunk_key(0, 0)), '')
+        store = FieryStateStore(self.connect(claim=False))
+        self.assertEqual([store.get(fiery.ip)['max_id'] for fiery in fiery_list], [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()